@@ -0,0 +1,276 @@
+# end to end benchmarks for the collector -> db-collector -> AI pipeline
+#
+# replays recorded readings through db-collector's POST / and the AI endpoints, and measures how retraining grows
+# with the size of the datasets. start the services first, against a throwaway database:
+#
+#   docker compose -f benchmarks/docker-compose.yaml up -d --build
+#   python benchmarks/benchmark.py run --output benchmarks/results/before.json
+#   python benchmarks/benchmark.py compare benchmarks/results/before.json benchmarks/results/after.json
+#
+# every run is written as json, compare exits non zero when a metric got worse by more than the tolerance
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+import aiohttp
+import numpy
+
+from readings import Replay, load_readings
+import retrainScaling
+
+FORMAT = 1
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+Request = Callable[[aiohttp.ClientSession], Awaitable]
+
+
+def percentiles(seconds: List[float]) -> Dict[str, float]:
+    if not seconds:
+        return {"mean": 0, "p50": 0, "p90": 0, "p99": 0, "max": 0}
+    values = numpy.asarray(seconds)
+    return {"mean": float(values.mean()), "p50": float(numpy.percentile(values, 50)),
+            "p90": float(numpy.percentile(values, 90)), "p99": float(numpy.percentile(values, 99)),
+            "max": float(values.max())}
+
+
+async def timed(session: aiohttp.ClientSession, request: Request) -> Tuple[Optional[float], Optional[str]]:
+    started = time.perf_counter()
+    try:
+        async with request(session) as response:
+            await response.read()
+            if response.status >= 400:
+                return None, f"HTTP {response.status}"
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        return None, type(e).__name__
+    return time.perf_counter() - started, None
+
+
+def summarize(results: List[Tuple[Optional[float], Optional[str]]], seconds: float) -> dict:
+    latencies = [latency for latency, error in results if latency is not None]
+    errors: Dict[str, int] = {}
+    for latency, error in results:
+        if error is not None:
+            errors[error] = errors.get(error, 0) + 1
+    return {
+        "requests": len(results),
+        "errors": sum(errors.values()),
+        "errorKinds": errors,
+        "requestsPerSecond": len(latencies) / seconds if seconds else 0,
+        "seconds": percentiles(latencies)
+    }
+
+
+async def closed_loop(session: aiohttp.ClientSession, requests: List[Request], concurrency: int) -> dict:
+    # a fixed number of clients sending their next request as soon as the last one returned
+    queue = list(reversed(requests))
+    results = []
+
+    async def client():
+        while queue:
+            results.append(await timed(session, queue.pop()))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return summarize(results, time.perf_counter() - started)
+
+
+async def open_loop(session: aiohttp.ClientSession, next_request: Callable[[], Request], rate: float,
+                    duration: float) -> dict:
+    # requests go out on schedule whether or not the earlier ones came back, like the collectors do
+    tasks = []
+    started = time.perf_counter()
+    for i in range(max(int(rate * duration), 1)):
+        delay = started + i / rate - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(timed(session, next_request())))
+    results = await asyncio.gather(*tasks)
+    summary = summarize(results, time.perf_counter() - started)
+    return {"rate": rate, **summary, "keptUp": summary["errors"] == 0 and summary["requestsPerSecond"] >= rate * 0.95}
+
+
+def tick(url: str, reading: dict) -> Request:
+    return lambda session: session.post(url, params=reading)
+
+
+def get(url: str, params: dict = None) -> Request:
+    return lambda session: session.get(url, params=params)
+
+
+def post_json(url: str, body) -> Request:
+    return lambda session: session.post(url, json=body)
+
+
+def endpoints(collectorUrl: Optional[str], aiUrl: Optional[str], replay: Replay) -> Dict[str, Callable[[], Request]]:
+    # name -> factory for the next request, every tick carries the next recorded reading
+    def reading() -> dict:
+        return replay.next()
+
+    scenarios = {}
+    if collectorUrl:
+        scenarios["db-collector POST /"] = lambda: tick(f"{collectorUrl}/", reading())
+    if aiUrl:
+        years = list(range(2025, 2101, 5))
+        scenarios["ai POST /tick"] = lambda: tick(f"{aiUrl}/tick", reading())
+        scenarios["ai POST /population"] = lambda: tick(f"{aiUrl}/population", {
+            key: value for key, value in reading().items() if key in ("population", "populationGrowthThisYear")})
+        scenarios["ai GET /populationBy"] = lambda: get(f"{aiUrl}/populationBy/2050", {"nowPopulation": 8100000000})
+        scenarios["ai GET /totalCo2EmissionsBy"] = lambda: get(f"{aiUrl}/totalCo2EmissionsBy/2050",
+                                                               {"nowTotalCo2Emissions": 1.7e12})
+        scenarios["ai GET /energyProductionBy"] = lambda: get(f"{aiUrl}/energyProductionBy/2050", {
+            "fossilEnergyTWh": 100, "renewableEnergyTWh": 10, "populationGrowth": 200000})
+        scenarios["ai GET /annualTempAnomaly"] = lambda: get(f"{aiUrl}/annualTempAnomaly/37000000000")
+        scenarios["ai POST /batch/populationBy"] = lambda: post_json(f"{aiUrl}/batch/populationBy", {
+            "years": years, "nowPopulation": 8100000000})
+    return scenarios
+
+
+async def http_benchmarks(arguments) -> dict:
+    replay = Replay(load_readings(arguments.readings))
+    scenarios = endpoints(arguments.collector_url, arguments.ai_url, replay)
+    results = {"latency": {}, "throughput": []}
+    timeout = aiohttp.ClientTimeout(total=arguments.timeout)
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+        for name, request in scenarios.items():
+            # a few untimed requests first, so the first one doesn't pay for connecting and warming the caches
+            await closed_loop(session, [request() for _ in range(arguments.warmup)], arguments.concurrency)
+            summary = await closed_loop(session, [request() for _ in range(arguments.requests)],
+                                        arguments.concurrency)
+            results["latency"][name] = summary
+            print(f"{name:<32} p50 {summary['seconds']['p50'] * 1000:8.2f}ms  "
+                  f"p99 {summary['seconds']['p99'] * 1000:8.2f}ms  {summary['requestsPerSecond']:8.1f}/s  "
+                  f"{summary['errors']} errors")
+
+        # the whole pipeline at rising tick rates, until it falls behind
+        name = "db-collector POST /" if arguments.collector_url else "ai POST /tick"
+        if name in scenarios:
+            for rate in arguments.rates:
+                summary = await open_loop(session, scenarios[name], rate, arguments.duration)
+                results["throughput"].append({"endpoint": name, **summary})
+                print(f"{name} at {rate:g}/s: {summary['requestsPerSecond']:.1f}/s done, "
+                      f"p99 {summary['seconds']['p99'] * 1000:.1f}ms, {summary['errors']} errors")
+                if not summary["keptUp"] and not arguments.keep_going:
+                    break
+    return results
+
+
+def environment() -> dict:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True,
+                                check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {"commit": commit, "python": platform.python_version(), "platform": platform.platform(),
+            "cpus": os.cpu_count()}
+
+
+def run(arguments):
+    result = {
+        "format": FORMAT,
+        "started": datetime.now(timezone.utc).isoformat(),
+        "environment": environment(),
+        "parameters": {key: value for key, value in vars(arguments).items() if key != "command"}
+    }
+    suites = set(arguments.suites)
+    if suites & {"latency", "throughput"}:
+        http = asyncio.run(http_benchmarks(arguments))
+        if "latency" in suites:
+            result["latency"] = http["latency"]
+        if "throughput" in suites:
+            result["throughput"] = http["throughput"]
+    if "retrain" in suites:
+        result["retrain"] = retrainScaling.run(arguments.sizes)
+
+    os.makedirs(os.path.dirname(os.path.abspath(arguments.output)), exist_ok=True)
+    with open(arguments.output, "w") as file:
+        json.dump(result, file, indent=1)
+    print("Wrote", arguments.output)
+
+
+def metrics(result: dict) -> Dict[str, Tuple[float, bool]]:
+    # flattened metric name -> (value, whether higher is better)
+    values = {}
+    for name, summary in result.get("latency", {}).items():
+        for stat in ("p50", "p99"):
+            values[f"latency {name} {stat}"] = (summary["seconds"][stat], False)
+        values[f"latency {name} errors"] = (summary["errors"], False)
+    for summary in result.get("throughput", []):
+        values[f"throughput {summary['endpoint']} at {summary['rate']:g}/s"] = (summary["requestsPerSecond"], True)
+    for summary in result.get("retrain", []):
+        for key in ("importSeconds", "seedSeconds", "retrainSeconds", "appendSeconds", "retrainRssBytes"):
+            values[f"retrain {summary['rows']} rows {key}"] = (summary[key], False)
+    return values
+
+
+def compare(arguments) -> int:
+    with open(arguments.baseline) as file:
+        baseline = metrics(json.load(file))
+    with open(arguments.candidate) as file:
+        candidate = metrics(json.load(file))
+
+    regressions = 0
+    for name in sorted(baseline.keys() & candidate.keys()):
+        (before, higherIsBetter), (after, _) = baseline[name], candidate[name]
+        if before == after:
+            change = 0.0
+        else:
+            change = (after - before) / abs(before) if before else float("inf")
+        worse = -change if higherIsBetter else change
+        # tiny latencies are mostly noise, they have to move by more than the floor as well
+        significant = abs(after - before) > arguments.floor or not name.startswith("latency")
+        regressed = worse > arguments.tolerance and significant
+        regressions += regressed
+        print(f"{'REGRESSED' if regressed else '':<10}{name:<70} {before:>14.6g} -> {after:<14.6g} {change:+.1%}")
+    for name in sorted(baseline.keys() ^ candidate.keys()):
+        print(f"{'':<10}{name:<70} only in {'baseline' if name in baseline else 'candidate'}")
+
+    print(f"{regressions} regression(s) beyond {arguments.tolerance:.0%}")
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the collector -> db-collector -> AI pipeline")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    runCommand = commands.add_parser("run", help="run the benchmarks and write the results as json")
+    runCommand.add_argument("--suites", nargs="+", choices=["latency", "throughput", "retrain"],
+                            default=["latency", "throughput", "retrain"])
+    runCommand.add_argument("--collector-url", default=os.getenv("COLLECTOR_URL", "http://127.0.0.1:8168"),
+                            help="db-collector, empty to skip it")
+    runCommand.add_argument("--ai-url", default=os.getenv("AI_URL", "http://127.0.0.1:8157"),
+                            help="AI service, empty to skip it")
+    runCommand.add_argument("--readings", default=os.path.join(ROOT, "data.csv"),
+                            help="recorded readings to replay, data.csv or train/data.csv")
+    runCommand.add_argument("--requests", type=int, default=500, help="timed requests per endpoint")
+    runCommand.add_argument("--warmup", type=int, default=20)
+    runCommand.add_argument("--concurrency", type=int, default=8)
+    runCommand.add_argument("--rates", type=float, nargs="+", default=[1, 2, 5, 10, 20, 50, 100],
+                            help="ticks per second for the throughput run")
+    runCommand.add_argument("--duration", type=float, default=20, help="seconds at every tick rate")
+    runCommand.add_argument("--keep-going", action="store_true", help="keep raising the rate after falling behind")
+    runCommand.add_argument("--timeout", type=float, default=60)
+    runCommand.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000, 1000000],
+                            help="dataset rows for the retrain run")
+    runCommand.add_argument("--output", default=os.path.join(
+        ROOT, "benchmarks", "results", f"{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"))
+
+    compareCommand = commands.add_parser("compare", help="compare two runs, exits 1 on a regression")
+    compareCommand.add_argument("baseline")
+    compareCommand.add_argument("candidate")
+    compareCommand.add_argument("--tolerance", type=float, default=0.2, help="relative change that counts")
+    compareCommand.add_argument("--floor", type=float, default=0.001,
+                                help="seconds a latency has to change by before it counts")
+
+    arguments = parser.parse_args()
+    if arguments.command == "run":
+        run(arguments)
+    else:
+        sys.exit(compare(arguments))
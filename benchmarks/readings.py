@@ -0,0 +1,49 @@
+# recorded worldometer readings (data.csv, train/data.csv) turned into the ticks the collector would send
+import csv
+from typing import Dict, List
+
+# data.csv only recorded the year's population growth and annual co2, the rest is filled in around them
+BASE_POPULATION = 8_000_000_000
+FOSSIL_ENERGY_MWH = 1.0e8
+RENEWABLE_ENERGY_MWH = 1.0e7
+SAMPLE_SECONDS = 5
+# every replay of the file is shifted by this much, so a replayed reading can be told apart from the first pass
+PASS_OFFSET = 1_000_000
+
+
+def load_readings(path: str) -> List[Dict[str, float]]:
+    with open(path, newline='') as file:
+        reader = csv.reader(file)
+        next(reader)
+        rows = [(int(float(growth)), float(co2)) for growth, co2 in reader if growth]
+    if not rows:
+        raise ValueError(f"No readings in {path}")
+
+    readings = []
+    firstGrowth = rows[0][0]
+    for i, (growth, co2) in enumerate(rows):
+        readings.append({
+            "population": BASE_POPULATION + growth,
+            "populationGrowthThisYear": growth,
+            "populationGrowthToday": growth - firstGrowth,
+            "currentCo2Emissions": co2,
+            "fossilEnergyMWh": FOSSIL_ENERGY_MWH + i * SAMPLE_SECONDS * 4000,
+            "renewableEnergyMWh": RENEWABLE_ENERGY_MWH + i * SAMPLE_SECONDS * 600
+        })
+    return readings
+
+
+class Replay:
+    # hands out the readings in order, looping over the file as often as needed
+    def __init__(self, readings: List[Dict[str, float]]):
+        self.readings = readings
+        self.position = 0
+
+    def next(self) -> Dict[str, float]:
+        passes, index = divmod(self.position, len(self.readings))
+        self.position += 1
+        reading = dict(self.readings[index])
+        offset = passes * PASS_OFFSET
+        reading["population"] += offset
+        reading["populationGrowthThisYear"] += offset
+        return reading
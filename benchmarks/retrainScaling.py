@@ -0,0 +1,84 @@
+# how retraining the population model grows with the size of its dataset. every size runs in a fresh process so
+# the peak memory of one doesn't hide in the next
+import os
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from typing import Dict, List
+
+import numpy
+
+AI_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "realtimeco2-ai")
+MODEL = "population"
+# samples the service would have collected between two retrains
+NEW_SAMPLES = 1000
+
+
+def max_rss() -> int:
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage if sys.platform == "darwin" else usage * 1024
+
+
+def write_dataset(path: str, rows: int, seed: int = 0):
+    # a year of timestamps every 30 seconds against a slowly bending population curve, like the collector samples
+    random = numpy.random.default_rng(seed)
+    timestamps = 1.7e9 + numpy.arange(rows, dtype=float) * 30
+    years = (timestamps - 1.7e9) / 31536000
+    population = 8.0e9 + 7.0e7 * years - 1.0e5 * years * years + random.normal(0, 2.0e3, rows)
+    numpy.savetxt(path, numpy.column_stack([timestamps, numpy.round(population)]), delimiter=",",
+                  header="Year,Population", comments="", fmt="%.1f")
+
+
+def measure(rows: int) -> Dict[str, float]:
+    sys.path.insert(0, os.path.abspath(AI_FOLDER))
+    import compactModel
+    import training
+    from sampleStore import SampleStore
+
+    result = {"rows": rows}
+    with tempfile.TemporaryDirectory() as root:
+        dataFolder, modelsFolder = os.path.join(root, "data"), os.path.join(root, "models")
+        os.makedirs(dataFolder)
+        os.makedirs(modelsFolder)
+        write_dataset(os.path.join(dataFolder, f"{MODEL}.csv"), rows)
+        # a model straight out of the notebooks, the first retrain has to seed it from the whole dataset
+        compactModel.write(os.path.join(modelsFolder, f"{MODEL}.json"), compactModel.LinearModel(0, [0, 0]))
+        result["csvBytes"] = os.path.getsize(os.path.join(dataFolder, f"{MODEL}.csv"))
+        result["startRssBytes"] = max_rss()
+
+        started = time.perf_counter()
+        store = SampleStore(dataFolder)
+        dataset = store.dataset(MODEL)
+        result["importSeconds"] = time.perf_counter() - started
+        result["importRssBytes"] = max_rss()
+
+        started = time.perf_counter()
+        training.seed_job(modelsFolder, dataFolder, MODEL)
+        result["seedSeconds"] = time.perf_counter() - started
+        result["seedRssBytes"] = max_rss()
+
+        last = dataset.column(0)[-1]
+        started = time.perf_counter()
+        for i in range(NEW_SAMPLES):
+            dataset.append([last + (i + 1) * 30, 8.1e9 + i])
+        result["appendSeconds"] = (time.perf_counter() - started) / NEW_SAMPLES
+
+        started = time.perf_counter()
+        training.retrain_job(modelsFolder, dataFolder, MODEL)
+        result["retrainSeconds"] = time.perf_counter() - started
+        result["retrainRssBytes"] = max_rss()
+    return result
+
+
+def run(sizes: List[int]) -> List[Dict[str, float]]:
+    results = []
+    for rows in sizes:
+        with ProcessPoolExecutor(1, mp_context=get_context("spawn")) as pool:
+            result = pool.submit(measure, rows).result()
+        print(f"retrain {rows:>9} rows: import {result['importSeconds']:.3f}s, seed {result['seedSeconds']:.3f}s, "
+              f"retrain {result['retrainSeconds'] * 1000:.1f}ms, peak rss {result['retrainRssBytes'] / 2 ** 20:.0f}MB")
+        results.append(result)
+    return results
@@ -0,0 +1,118 @@
+# compact json format for linear models, so serving them needs nothing but numpy
+#
+# a model file MODELS_FOLDER/<name>.json holds the intercept and coefficients, plus the running statistics of an
+# online model so it can keep learning. models that aren't linear (the random forest) stay pickles. existing
+# pickles are converted with:
+#
+#   python compactModel.py export [model ...]
+import argparse
+import json
+import os
+import pickle
+from datetime import datetime, timezone
+from typing import Any, Optional
+
+import numpy
+
+from onlineRegression import Moments, OnlineLinearRegression
+
+FORMAT = 1
+
+
+class LinearModel:
+    # the prediction half of sklearn's LinearRegression, X is the already expanded feature matrix
+    def __init__(self, intercept: float, coef):
+        self.intercept_ = float(intercept)
+        self.coef_ = numpy.asarray(coef, dtype=float)
+
+    def predict(self, X):
+        return numpy.asarray(X, dtype=float).reshape(-1, len(self.coef_)) @ self.coef_ + self.intercept_
+
+
+def exportable(model: Any) -> bool:
+    coef = getattr(model, "coef_", None)
+    return coef is not None and numpy.ndim(coef) == 1 and numpy.ndim(getattr(model, "intercept_", None)) == 0
+
+
+def moments_to_dict(moments: Moments) -> dict:
+    return {"count": moments.count, "mean": moments.mean.tolist(), "comoment": moments.comoment.tolist()}
+
+
+def moments_from_dict(state: dict) -> Moments:
+    moments = Moments(len(state["mean"]))
+    moments.count = state["count"]
+    moments.mean = numpy.asarray(state["mean"], dtype=float)
+    moments.comoment = numpy.asarray(state["comoment"], dtype=float)
+    return moments
+
+
+def to_dict(model: Any) -> dict:
+    state = {
+        "format": FORMAT,
+        "created": datetime.now(timezone.utc).isoformat(),
+        "intercept": float(model.intercept_),
+        "coef": numpy.asarray(model.coef_, dtype=float).tolist()
+    }
+    if isinstance(model, OnlineLinearRegression):
+        state["online"] = {
+            "testSize": model.test_size,
+            "seen": model.seen,
+            "train": moments_to_dict(model.train),
+            "test": moments_to_dict(model.test)
+        }
+    return state
+
+
+def from_dict(state: dict) -> Any:
+    if state.get("format", 0) > FORMAT:
+        raise ValueError(f"Model format {state['format']} is newer than this service understands ({FORMAT})")
+    if "online" not in state:
+        return LinearModel(state["intercept"], state["coef"])
+
+    online = state["online"]
+    model = OnlineLinearRegression(features=len(state["coef"]), test_size=online["testSize"])
+    model.seen = online["seen"]
+    model.train = moments_from_dict(online["train"])
+    model.test = moments_from_dict(online["test"])
+    model.coef_ = numpy.asarray(state["coef"], dtype=float)
+    model.intercept_ = float(state["intercept"])
+    return model
+
+
+def load(path: str) -> Any:
+    with open(path) as file:
+        return from_dict(json.load(file))
+
+
+def write(path: str, model: Any):
+    # written next to the old file and renamed over it so readers never see half a model
+    temp = f"{path}.{os.getpid()}.tmp"
+    with open(temp, "w") as file:
+        json.dump(to_dict(model), file)
+    os.replace(temp, path)
+
+
+def export(folder: str, name: str) -> Optional[str]:
+    # unpickling is the one place that may still need scikit-learn
+    with open(os.path.join(folder, f"{name}.pkl"), 'rb') as file:
+        model = pickle.load(file)
+    if not exportable(model):
+        return None
+    path = os.path.join(folder, f"{name}.json")
+    write(path, model)
+    return path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Convert pickled linear models to the compact json format")
+    parser.add_argument("--folder", default=os.getenv("MODELS_FOLDER", "models"))
+    commands = parser.add_subparsers(dest="command", required=True)
+    exportCommand = commands.add_parser("export")
+    exportCommand.add_argument("models", nargs="*")
+    arguments = parser.parse_args()
+
+    names = arguments.models or sorted(file[:-len(".pkl")] for file in os.listdir(arguments.folder)
+                                       if file.endswith(".pkl"))
+    for name in names:
+        path = export(arguments.folder, name)
+        print(f"{name}: {path}" if path else f"{name}: not a linear model, kept as a pickle")
@@ -0,0 +1,63 @@
+# bounded LRU + TTL memoization of forecasts, keyed by the versions of the models they were computed with
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, List, Sequence
+
+
+class ForecastCache:
+    def __init__(self, maxsize: int = 4096, ttl: float = 300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_many(self, keys: Sequence[Hashable], compute: Callable[[List[int]], List[Any]]) -> List[Any]:
+        # compute is only called once, with the positions of every key that wasn't cached
+        now = time.monotonic()
+        values = [None] * len(keys)
+        missing = []
+
+        with self.lock:
+            for i, key in enumerate(keys):
+                entry = self.entries.get(key)
+                if entry is not None and entry[0] > now:
+                    self.entries.move_to_end(key)
+                    values[i] = entry[1]
+                    self.hits += 1
+                else:
+                    missing.append(i)
+                    self.misses += 1
+
+        if not missing:
+            return values
+
+        computed = compute(missing)
+        with self.lock:
+            for i, value in zip(missing, computed):
+                values[i] = value
+                self.entries[keys[i]] = (now + self.ttl, value)
+                self.entries.move_to_end(keys[i])
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+        return values
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hitRate": self.hits / lookups if lookups else 0
+        }
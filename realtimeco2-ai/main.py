@@ -1,83 +1,299 @@
-from datetime import date, datetime
+from datetime import datetime, timezone
 
 import numpy
-from fastapi import FastAPI
-from sklearn.linear_model import LinearRegression
-from sklearn.preprocessing import PolynomialFeatures
-from sklearn.model_selection import train_test_split
+from fastapi import FastAPI, Query
+from pydantic import BaseModel
 
-import pandas as pd
-import pickle
 import time, os
+from contextlib import asynccontextmanager
+from typing import Callable, Dict, List, Optional, Sequence
+
+import metrics
+from forecastCache import ForecastCache
+from modelRegistry import ModelRegistry
+from onlineRegression import OnlineLinearRegression
+from retrainScheduler import RetrainScheduler, load_policies
+from sampleStore import SampleStore
+from training import TRAINABLE_MODELS, features, polynomial, retrain_job, seed_job, unseen
+from workPools import WorkPools
 
 DATA_FOLDER = os.getenv('DATA_FOLDER', 'data')
 MODELS_FOLDER = os.getenv('MODELS_FOLDER', 'models')
+FORECAST_BUCKET_SECONDS = int(os.getenv('FORECAST_BUCKET_SECONDS', 30))
+# a /tick/bulk with at least this many readings is a backfill and refits the models before predicting it, smaller
+# uploads leave retraining to the scheduler
+BULK_REFIT_READINGS = int(os.getenv('BULK_REFIT_READINGS', 500))
 
-poly = PolynomialFeatures(degree=2, include_bias=False)
-app = FastAPI()
+registry = ModelRegistry(MODELS_FOLDER)
+store = SampleStore(DATA_FOLDER)
+forecasts = ForecastCache(int(os.getenv('FORECAST_CACHE_SIZE', 4096)), float(os.getenv('FORECAST_CACHE_TTL', 300)))
+
+pools = WorkPools(int(os.getenv('IO_THREADS', 4)), int(os.getenv('TRAIN_PROCESSES', 1)),
+                  int(os.getenv('TRAIN_NICE', 10)))
+
+
+async def trainable(name: str) -> OnlineLinearRegression:
+    model = registry.get(name)
+    if isinstance(model, OnlineLinearRegression):
+        return model
+    # normally seeded by a training process on startup, this is only the fallback if that failed
+    await pools.train(seed_job, MODELS_FOLDER, DATA_FOLDER, name)
+    return await pools.io(registry.get, name)
+
+
+def pending(name: str) -> int:
+    # a model that was never seeded has seen nothing, the retrain this triggers seeds it in a training process
+    model = registry.get(name)
+    seen = model.seen if isinstance(model, OnlineLinearRegression) else 0
+    return len(store.dataset(TRAINABLE_MODELS[name][0])) - seen
+
+
+def drift(name: str) -> float:
+    # mean absolute error on the unseen samples relative to their mean magnitude
+    model = registry.get(name)
+    if not isinstance(model, OnlineLinearRegression):
+        return float("inf")
+    featureAxis, targetAxis = unseen(store, name, model)
+    if len(targetAxis) == 0 or not numpy.any(targetAxis):
+        return 0.0
+    error = numpy.abs(model.predict(features(name, featureAxis)) - targetAxis)
+    return float(error.mean() / numpy.abs(targetAxis).mean())
+
+
+async def retrain(name: str):
+    # trained and published by a training process, the next registry.get() here picks the new version up
+    before = registry.versions.get(name)
+    version = await pools.train(retrain_job, MODELS_FOLDER, DATA_FOLDER, name)
+    await pools.io(registry.get, name)
+    if version != before:
+        metrics.MODEL_REFITS.labels(name).inc()
+
+
+async def append(dataset: str, row: List[float]):
+    await pools.io(store.dataset(dataset).append, row)
+
+
+scheduler = RetrainScheduler(load_policies(TRAINABLE_MODELS), pending, drift, retrain, offload=pools.io,
+                             leaderLock=os.path.join(MODELS_FOLDER, ".scheduler.lock"))
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await pools.io(registry.load_all)
+    for name in TRAINABLE_MODELS:
+        await trainable(name)
+    scheduler.start()
+    yield
+    await scheduler.stop()
+    pools.shutdown()
+
+
+app = FastAPI(lifespan=lifespan)
+app.middleware("http")(metrics.instrument)
+
+
+class YearsRequest(BaseModel):
+    years: List[int]
+
+
+class PopulationByRequest(YearsRequest):
+    nowPopulation: int = 0
+
+
+class TotalCo2EmissionsByRequest(YearsRequest):
+    nowTotalCo2Emissions: float = 0
+
+
+class PopulationsRequest(BaseModel):
+    populations: List[int]
+
+
+class PopulationGrowthsRequest(BaseModel):
+    populationGrowths: List[int]
+
+
+class EmissionsRequest(BaseModel):
+    emissionsAnnual: List[int]
+
+
+class Reading(BaseModel):
+    time: datetime
+    population: int
+    populationGrowthThisYear: int
+    populationGrowthToday: int
+    currentCo2Emissions: float
+    fossilEnergyMWh: float
+    renewableEnergyMWh: float
+
+
+class BulkTickRequest(BaseModel):
+    readings: List[Reading]
+    years: List[int] = [2030, 2050]
+
+
+def column(values) -> numpy.ndarray:
+    return numpy.asarray(values, dtype=float).reshape(-1, 1)
+
+
+def predict(name: str, values, model=None) -> numpy.ndarray:
+    # timed per model for /metrics, by default with the version that is published right now
+    return metrics.timed_predict(name, model if model is not None else registry.get(name), values)
+
+
+def year_end_timestamps(years) -> numpy.ndarray:
+    # the readings are utc, a year boundary in the server's local time would shift with its timezone
+    return numpy.array([int(datetime(int(year), 12, 31, tzinfo=timezone.utc).timestamp()) for year in years],
+                       dtype=numpy.int64)
+
+
+def integers(predicted: numpy.ndarray) -> List[int]:
+    return predicted.astype(numpy.int64).tolist()
+
+
+def cached(name: str, models: Sequence[str], items: list, compute: Callable[[list], list], *arguments,
+           timeBucketed: bool = False) -> list:
+    # the model versions are part of the key, so a retrain makes every older entry unreachable
+    prefix = (name, tuple(registry.version(model) for model in models), arguments,
+              int(time.time() // FORECAST_BUCKET_SECONDS) if timeBucketed else None)
+    return forecasts.get_many([(prefix, item) for item in items],
+                              lambda missing: compute([items[i] for i in missing]))
+
+
+def predict_population_by(years: List[int], nowPopulation: int = 0) -> List[dict]:
+    return cached("populationBy", ["population", "population-increase"], list(years),
+                  lambda missing: compute_population_by(missing, nowPopulation), nowPopulation, timeBucketed=True)
+
+
+def compute_population_by(years: List[int], nowPopulation: int = 0) -> List[dict]:
+    nowTimeStamp = int(datetime.now().timestamp())
+    if nowPopulation == 0:
+        nowPopulation = int(predict("population", polynomial(column([nowTimeStamp])))[0])
+    return population_by_readings(years, [nowPopulation], [nowTimeStamp])[0]
+
+
+def population_by_readings(years: List[int], nowPopulations, nowTimeStamps) -> List[List[dict]]:
+    # the forecasts for every year as seen from every reading, the models run once over all of them
+    populationModel = registry.get("population")
+    growthModel = registry.get("population-increase")
+
+    yearTimeStamps = year_end_timestamps(years)
+    previousYearTimeStamps = year_end_timestamps([year - 1 for year in years])
+    nowPopulations = numpy.asarray(nowPopulations, dtype=numpy.int64).reshape(-1, 1)
+    nowTimeStamps = numpy.asarray(nowTimeStamps, dtype=numpy.int64).reshape(-1, 1)
+
+    populationPredicted = numpy.array(integers(
+        predict("population", polynomial(column(yearTimeStamps)), populationModel)))
+    previousPopulationPredicted = numpy.array(integers(
+        predict("population", polynomial(column(previousYearTimeStamps)), populationModel)))
+    populationGrowthPredicted = integers(
+        predict("population-increase", polynomial(column(yearTimeStamps - previousYearTimeStamps)), growthModel))
+    # a row per reading, a column per year
+    populationGrowthPredictedFromNow = numpy.array(integers(
+        predict("population-increase", polynomial(column(yearTimeStamps - nowTimeStamps)), growthModel)
+    )).reshape(len(nowTimeStamps), len(years))
+
+    populationGrowthCalculated = (populationPredicted - previousPopulationPredicted).tolist()
+    populationGrowthCalculatedFromNow = (populationPredicted - nowPopulations).tolist()
+    populationGrowthPercent = (populationGrowthPredictedFromNow / nowPopulations * 100).tolist()
+    calculatedPopulationGrowthPercent = ((populationPredicted - nowPopulations) / nowPopulations * 100).tolist()
+    populationGrowthPredictedFromNow = populationGrowthPredictedFromNow.tolist()
+
+    return [
+        [
+            {
+                "year": year,
+                "populationPredicted": int(populationPredicted[i]),
+                "populationGrowthPredicted": populationGrowthPredicted[i],
+                "populationGrowthCalculated": populationGrowthCalculated[i],
+                "populationGrowthPredictedFromNow": populationGrowthPredictedFromNow[reading][i],
+                "populationGrowthCalculatedFromNow": populationGrowthCalculatedFromNow[reading][i],
+                "populationGrowthPercent": populationGrowthPercent[reading][i],
+                "calculatedPopulationGrowthPercent": calculatedPopulationGrowthPercent[reading][i]
+            } for i, year in enumerate(years)
+        ] for reading in range(len(nowTimeStamps))
+    ]
+
+
+def predict_energy_production(populationGrowths) -> Dict[str, List[int]]:
+    growthAxis = column(populationGrowths)
+    return {
+        "totalFossilEnergyPredicted": integers(
+            predict("population_increase_vs_total_fossil_energy", growthAxis)),
+        "totalRenewableEnergyPredicted": integers(
+            predict("population_increase_vs_total_renewable_energy", growthAxis)),
+        "windEnergyPredicted": integers(predict("population_increase_vs_wind", growthAxis)),
+        "hydroEnergyPredicted": integers(predict("population_increase_vs_hydropower", growthAxis)),
+        "solarEnergyPredicted": integers(predict("population_increase_vs_solar", growthAxis)),
+        "otherRenewablesEnergyPredicted": integers(
+            predict("population_increase_vs_other_renewables", growthAxis)),
+    }
+
+
+def predict_energy_production_by(years: List[int]) -> List[dict]:
+    populationGrowthPredicted = [prediction["populationGrowthPredicted"] for prediction in predict_population_by(years)]
+    predicted = predict_energy_production(populationGrowthPredicted)
+    return [{"year": year, **{key: values[i] for key, values in predicted.items()}} for i, year in enumerate(years)]
+
+
+def predict_total_co2_emissions(populations) -> List[int]:
+    return integers(predict("population_vs_total_co2", polynomial(column(populations))))
+
+
+def predict_total_co2_emissions_by(years: List[int], nowTotalCo2Emissions: float = 0) -> List[dict]:
+    return cached("totalCo2EmissionsBy", ["population", "population-increase", "population_vs_total_co2"],
+                  list(years), lambda missing: compute_total_co2_emissions_by(missing, nowTotalCo2Emissions),
+                  nowTotalCo2Emissions, timeBucketed=True)
+
+
+def compute_total_co2_emissions_by(years: List[int], nowTotalCo2Emissions: float = 0) -> List[dict]:
+    populationBy = [prediction["populationPredicted"] for prediction in predict_population_by(years)]
+    totalCo2EmissionsPredicted = predict_total_co2_emissions(populationBy)
+
+    return [
+        {
+            "year": year,
+            "totalCo2EmissionsPredicted": totalCo2EmissionsPredicted[i],
+            "totalCo2EmissionsGrowthPercent": (
+                totalCo2EmissionsPredicted[i] / nowTotalCo2Emissions) * 100 if nowTotalCo2Emissions != 0 else 0
+        } for i, year in enumerate(years)
+    ]
+
+
+def predict_annual_emissions(populationGrowths) -> List[int]:
+    return cached("annualEmissionsByYear", ["population_increase_vs_annual_co2"], list(populationGrowths),
+                  lambda missing: integers(predict("population_increase_vs_annual_co2", column(missing))))
+
+
+def predict_temp_anomaly(emissionsAnnual) -> List[float]:
+    return cached("annualTempAnomaly", ["annualtemp-annualco2"], list(emissionsAnnual),
+                  lambda missing: predict("annualtemp-annualco2", column(missing)).tolist())
 
 
 @app.get("/energyProductionBy/{year}")
 async def energy_production_by_year(year: int, fossilEnergyTWh: float, renewableEnergyTWh: float,
                                     populationGrowth: int):
-    totalFossilModel = pickle.load(open(f'{MODELS_FOLDER}/population_increase_vs_total_fossil_energy.pkl', 'rb'))
-    totalRenewableModel = pickle.load(open(f'{MODELS_FOLDER}/population_increase_vs_total_renewable_energy.pkl', 'rb'))
-    windModel = pickle.load(open(f'{MODELS_FOLDER}/population_increase_vs_wind.pkl', 'rb'))
-    hydroModel = pickle.load(open(f'{MODELS_FOLDER}/population_increase_vs_hydropower.pkl', 'rb'))
-    solarModel = pickle.load(open(f'{MODELS_FOLDER}/population_increase_vs_solar.pkl', 'rb'))
-    otherModel = pickle.load(open(f'{MODELS_FOLDER}/population_increase_vs_other_renewables.pkl', 'rb'))
-
-    populationGrowthPredicted = (await population_by_year(year))["populationGrowthPredicted"]
-
-    totalFossilEnergyPredicted = int(totalFossilModel.predict([[populationGrowthPredicted]])[0])
-    totalRenewableEnergyPredicted = int(totalRenewableModel.predict([[populationGrowthPredicted]])[0])
-    windEnergyPredicted = int(windModel.predict([[populationGrowthPredicted]])[0])
-    hydroEnergyPredicted = int(hydroModel.predict([[populationGrowthPredicted]])[0])
-    solarEnergyPredicted = int(solarModel.predict([[populationGrowthPredicted]])[0])
-    otherRenewablesEnergyPredicted = int(otherModel.predict([[populationGrowthPredicted]])[0])
-
-    totalEnergyDataset = pd.read_csv(f'{DATA_FOLDER}/population_increase_vs_total_energy.csv')
-    totalEnergyDataset = pd.concat(
-        [totalEnergyDataset, pd.DataFrame([[populationGrowth, fossilEnergyTWh, renewableEnergyTWh]],
-                                          columns=totalEnergyDataset.columns)], ignore_index=True)
-
-    # update model - total energy
-    populationIncreaseAxis = totalEnergyDataset[["Population Increase"]].values
-    totalFossilEnergyAxis = totalEnergyDataset["Total Fossil Fuel (TWh, direct energy)"].values
-    totalRenewableEnergyAxis = totalEnergyDataset["Total Renewable (TWh, direct energy)"].values
-
-    populationIncreaseAxisTrain1, populationIncreaseAxisTest1, totalFossilEnergyAxisTrain, totalFossilEnergyAxisTest = train_test_split(
-        populationIncreaseAxis, totalFossilEnergyAxis,
-        test_size=0.15,
-        random_state=0)
-    populationIncreaseAxisTrain2, populationIncreaseAxisTest2, totalRenewableEnergyAxisTrain, totalRenewableEnergyAxisTest = train_test_split(
-        populationIncreaseAxis, totalRenewableEnergyAxis,
-        test_size=0.15,
-        random_state=0)
-
-    totalFossilModel.fit(populationIncreaseAxisTrain1, totalFossilEnergyAxisTrain)
-    totalRenewableModel.fit(populationIncreaseAxisTrain2, totalRenewableEnergyAxisTrain)
-
-    totalFossilEnergyAccuracy = totalFossilModel.score(populationIncreaseAxisTest1, totalFossilEnergyAxisTest)
-    totalRenewableEnergyAccuracy = totalRenewableModel.score(populationIncreaseAxisTest2, totalRenewableEnergyAxisTest)
-
-    # save model
-    pickle.dump(totalFossilModel, open(f'{MODELS_FOLDER}/population_increase_vs_total_fossil_energy.pkl', 'wb'))
-    pickle.dump(totalRenewableModel, open(f'{MODELS_FOLDER}/population_increase_vs_total_renewable_energy.pkl', 'wb'))
-
-    totalEnergyDataset.to_csv(f'{DATA_FOLDER}/population_increase_vs_total_energy.csv', index=False)
+    totalFossilModel = await trainable("population_increase_vs_total_fossil_energy")
+    totalRenewableModel = await trainable("population_increase_vs_total_renewable_energy")
+
+    predicted = predict_energy_production_by([year])[0]
+
+    await append("population_increase_vs_total_energy", [populationGrowth, renewableEnergyTWh, fossilEnergyTWh])
+
+    # the models are updated in the background by the retrain scheduler
+    totalFossilEnergyAccuracy = totalFossilModel.score()
+    totalRenewableEnergyAccuracy = totalRenewableModel.score()
 
     return {
         "year": year,
         "fossilEnergyTWh": fossilEnergyTWh,
         "renewableEnergyTWh": renewableEnergyTWh,
         "populationGrowth": populationGrowth,
-        "totalFossilEnergyPredicted": totalFossilEnergyPredicted,
-        "totalRenewableEnergyPredicted": totalRenewableEnergyPredicted,
-        "windEnergyPredicted": windEnergyPredicted,
-        "hydroEnergyPredicted": hydroEnergyPredicted,
-        "solarEnergyPredicted": solarEnergyPredicted,
-        "otherRenewablesEnergyPredicted": otherRenewablesEnergyPredicted,
+        "totalFossilEnergyPredicted": predicted["totalFossilEnergyPredicted"],
+        "totalRenewableEnergyPredicted": predicted["totalRenewableEnergyPredicted"],
+        "windEnergyPredicted": predicted["windEnergyPredicted"],
+        "hydroEnergyPredicted": predicted["hydroEnergyPredicted"],
+        "solarEnergyPredicted": predicted["solarEnergyPredicted"],
+        "otherRenewablesEnergyPredicted": predicted["otherRenewablesEnergyPredicted"],
         "totalFossilEnergyAccuracy": totalFossilEnergyAccuracy,
         "totalRenewableEnergyAccuracy": totalRenewableEnergyAccuracy
     }
@@ -85,131 +301,97 @@ async def energy_production_by_year(year: int, fossilEnergyTWh: float, renewable
 
 @app.get("/annualTempAnomaly/{emissionsAnnual}")
 async def annual_temp_anomaly(emissionsAnnual: int):
-    model = pickle.load(open(f'{MODELS_FOLDER}/annualtemp-annualco2.pkl', 'rb'))
-
-    annualTempAnomalyPredicted = model.predict([[emissionsAnnual]])[0]
-
     return {
         "emissionsAnnual": emissionsAnnual,
-        "annualTempAnomalyPredicted": annualTempAnomalyPredicted
+        "annualTempAnomalyPredicted": predict_temp_anomaly([emissionsAnnual])[0]
     }
 
 
 @app.get("/totalCo2EmissionsBy/{year}")
 async def total_co2_emissions_by_year(year: int, nowTotalCo2Emissions: float = 0):
-    model = pickle.load(open(f'{MODELS_FOLDER}/population_vs_total_co2.pkl', 'rb'))
+    return predict_total_co2_emissions_by([year], nowTotalCo2Emissions)[0]
 
-    populationBy = (await population_by_year(year))["populationPredicted"]
-    populationBy = numpy.array(populationBy).reshape(-1, 1)
 
-    totalCo2EmissionsPredicted = int(model.predict(poly.fit_transform(populationBy))[0])
+@app.get("/populationBy/{year}")
+async def population_by_year(year: int, nowPopulation: int = 0):
+    return predict_population_by([year], nowPopulation)[0]
 
-    return {
-        "year": year,
-        "totalCo2EmissionsPredicted": totalCo2EmissionsPredicted,
-        "totalCo2EmissionsGrowthPercent": (
-                                                  totalCo2EmissionsPredicted / nowTotalCo2Emissions) * 100 if nowTotalCo2Emissions != 0 else 0
-    }
 
+# batch versions of the forecasts, every model is evaluated once over the whole array
+@app.post("/batch/populationBy")
+async def batch_population_by(request: PopulationByRequest):
+    return predict_population_by(request.years, request.nowPopulation)
 
-@app.get("/populationBy/{year}")
-async def population_by_year(year: int, nowPopulation: int = 0):
-    populationModel = pickle.load(open(f'{MODELS_FOLDER}/population.pkl', 'rb'))
-    growthModel = pickle.load(open(f'{MODELS_FOLDER}/population-increase.pkl', 'rb'))
 
-    nowTimeStamp = int(datetime.now().timestamp())
-    yearTimeStamp = int(datetime(year, 12, 31).timestamp())
-    previousYearTimeStamp = int(datetime(year - 1, 12, 31).timestamp())
-    yearTimeStampArray = numpy.array([yearTimeStamp]).reshape(-1, 1)
-    previousYearTimeStampArray = numpy.array([previousYearTimeStamp]).reshape(-1, 1)
-    currentTimeStampArray = numpy.array([yearTimeStamp - previousYearTimeStamp]).reshape(-1, 1)
-    fromNowTimeStampArray = numpy.array([yearTimeStamp - nowTimeStamp]).reshape(-1, 1)
+@app.post("/batch/energyProductionBy")
+async def batch_energy_production_by(request: YearsRequest):
+    return predict_energy_production_by(request.years)
 
-    if nowPopulation == 0:
-        nowPopulation = int(
-            populationModel.predict(poly.fit_transform(numpy.array([nowTimeStamp]).reshape(-1, 1)))[0])
 
-    populationPredicted = int(populationModel.predict(poly.fit_transform(yearTimeStampArray))[0])
-    previousPopulationPredicted = int(populationModel.predict(poly.fit_transform(previousYearTimeStampArray))[0])
-    populationGrowthPredicted = int(growthModel.predict(poly.fit_transform(currentTimeStampArray))[0])
-    populationGrowthPredictedFromNow = int(growthModel.predict(poly.fit_transform(fromNowTimeStampArray))[0])
+@app.post("/batch/energyProduction")
+async def batch_energy_production(request: PopulationGrowthsRequest):
+    predicted = predict_energy_production(request.populationGrowths)
+    return [{"populationGrowth": growth, **{key: values[i] for key, values in predicted.items()}}
+            for i, growth in enumerate(request.populationGrowths)]
 
-    return {
-        "year": year,
-        "populationPredicted": populationPredicted,
-        "populationGrowthPredicted": populationGrowthPredicted,
-        "populationGrowthCalculated": populationPredicted - previousPopulationPredicted,
-        "populationGrowthPredictedFromNow": populationGrowthPredictedFromNow,
-        "populationGrowthCalculatedFromNow": populationPredicted - nowPopulation,
-        "populationGrowthPercent": (populationGrowthPredictedFromNow / nowPopulation) * 100,
-        "calculatedPopulationGrowthPercent": ((populationPredicted - nowPopulation) / nowPopulation) * 100
-    }
+
+@app.post("/batch/totalCo2EmissionsBy")
+async def batch_total_co2_emissions_by(request: TotalCo2EmissionsByRequest):
+    return predict_total_co2_emissions_by(request.years, request.nowTotalCo2Emissions)
+
+
+@app.post("/batch/totalCo2Emissions")
+async def batch_total_co2_emissions(request: PopulationsRequest):
+    return [{"population": population, "totalCo2EmissionsPredicted": predicted}
+            for population, predicted in zip(request.populations, predict_total_co2_emissions(request.populations))]
+
+
+@app.post("/batch/annualEmissionsByYear")
+async def batch_annual_emissions_by_year(request: PopulationGrowthsRequest):
+    emissionsPredicted = predict_annual_emissions(request.populationGrowths)
+    return [{"yearPopulationGrowth": growth, "emissionsPredicted": predicted}
+            for growth, predicted in zip(request.populationGrowths, emissionsPredicted)]
+
+
+@app.post("/batch/annualTempAnomaly")
+async def batch_annual_temp_anomaly(request: EmissionsRequest):
+    return [{"emissionsAnnual": emissions, "annualTempAnomalyPredicted": predicted}
+            for emissions, predicted in zip(request.emissionsAnnual, predict_temp_anomaly(request.emissionsAnnual))]
 
 
 @app.post("/population")
 async def population(population: int, populationGrowthThisYear: int):
-    populationModel = pickle.load(open(f'{MODELS_FOLDER}/population.pkl', 'rb'))
-    growthModel = pickle.load(open(f'{MODELS_FOLDER}/population-increase.pkl', 'rb'))
+    return await record_population(population, populationGrowthThisYear)
+
+
+async def record_population(population: int, populationGrowthThisYear: int) -> dict:
+    populationModel = await trainable("population")
+    growthModel = await trainable("population-increase")
 
     nowTimeStamp = int(datetime.now().timestamp())
-    previousYearTimeStamp = int(datetime(date.today().year - 1, 12, 31).timestamp())
+    year = datetime.now(timezone.utc).year
+    previousYearTimeStamp, endOfYearTimeStamp = year_end_timestamps([year - 1, year]).tolist()
     nowTimeStampArray = numpy.array([nowTimeStamp]).reshape(-1, 1)
-    endOfYearTimeStamp = int(datetime(date.today().year, 12, 31).timestamp())
     yearEndTimeStampArray = numpy.array([endOfYearTimeStamp]).reshape(-1, 1)
     endOfYearTimeStampArray = numpy.array([endOfYearTimeStamp - previousYearTimeStamp]).reshape(-1, 1)
     currentTimeStampArray = numpy.array([nowTimeStamp - previousYearTimeStamp]).reshape(-1, 1)
 
     nowPopulationPredicted = int(
-        populationModel.predict(poly.fit_transform(nowTimeStampArray))[0])
+        predict("population", polynomial(nowTimeStampArray), populationModel)[0])
     nowPopulationGrowthPredicted = int(
-        growthModel.predict(poly.fit_transform(currentTimeStampArray))[0])
+        predict("population-increase", polynomial(currentTimeStampArray), growthModel)[0])
     endOfYearPopulationPredicted = int(
-        populationModel.predict(poly.fit_transform(yearEndTimeStampArray))[0])
+        predict("population", polynomial(yearEndTimeStampArray), populationModel)[0])
     endOfYearPopulationGrowthPredicted = int(
-        growthModel.predict(poly.fit_transform(endOfYearTimeStampArray))[0])
-
-    # write new data to csv
-    populationData = pd.read_csv(f'{DATA_FOLDER}/population.csv')
-    growthData = pd.read_csv(f'{DATA_FOLDER}/population-increase.csv')
-    populationData = pd.concat(
-        [populationData, pd.DataFrame([[nowTimeStamp, population]], columns=populationData.columns)], ignore_index=True)
-    growthData = pd.concat(
-        [growthData,
-         pd.DataFrame([[nowTimeStamp - previousYearTimeStamp, populationGrowthThisYear]], columns=growthData.columns)],
-        ignore_index=True)
-
-    # update model - population
-    timeAxis = populationData.iloc[:, :-1].values
-    populationAxis = populationData.iloc[:, 1].values
-
-    timeAxis = poly.fit_transform(timeAxis.reshape(-1, 1))
-
-    timeAxisTrain, timeAxisTest, populationAxisTrain, populationAxisTest = train_test_split(timeAxis, populationAxis,
-                                                                                            test_size=0.15,
-                                                                                            random_state=0)
-    populationModel.fit(timeAxisTrain, populationAxisTrain)
-    populationAccuracy = populationModel.score(timeAxisTest, populationAxisTest)
-
-    # save model
-    pickle.dump(populationModel, open(f'{MODELS_FOLDER}/population.pkl', 'wb'))
-    populationData.to_csv(f'{DATA_FOLDER}/population.csv', index=False)
-
-    # update model - growth
-    timeAxis = growthData.iloc[:, :-1].values
-    growthAxis = growthData.iloc[:, 1].values
+        predict("population-increase", polynomial(endOfYearTimeStampArray), growthModel)[0])
 
-    timeAxis = poly.fit_transform(timeAxis.reshape(-1, 1))
+    # append new data to the datasets
+    await append("population", [nowTimeStamp, population])
+    await append("population-increase", [nowTimeStamp - previousYearTimeStamp, populationGrowthThisYear])
 
-    timeAxisTrain, timeAxisTest, growthAxisTrain, growthAxisTest = train_test_split(timeAxis, growthAxis,
-                                                                                    test_size=0.15,
-                                                                                    random_state=0)
-
-    growthModel.fit(timeAxisTrain, growthAxisTrain)
-    growthAccuracy = growthModel.score(timeAxisTest, growthAxisTest)
-
-    # save model
-    pickle.dump(growthModel, open(f'{MODELS_FOLDER}/population-increase.pkl', 'wb'))
-    growthData.to_csv(f'{DATA_FOLDER}/population-increase.csv', index=False)
+    # the models are updated in the background by the retrain scheduler
+    populationAccuracy = populationModel.score()
+    growthAccuracy = growthModel.score()
 
     return {
         "population": population,
@@ -225,45 +407,25 @@ async def population(population: int, populationGrowthThisYear: int):
 
 @app.get("/annualEmissionsByYear")
 async def annualEmissionsByYear(yearPopulationGrowth: int):
-    model = pickle.load(open(f'{MODELS_FOLDER}/population_increase_vs_annual_co2.pkl', 'rb'))
-
-    emissionsPredicted = int(model.predict([[yearPopulationGrowth]])[0])
-
     return {
         "yearPopulationGrowth": yearPopulationGrowth,
-        "emissionsPredicted": emissionsPredicted
+        "emissionsPredicted": predict_annual_emissions([yearPopulationGrowth])[0]
     }
 
 
 @app.post("/annualEmissions")
 async def annualEmissions(currentPopulationGrowth: int, endOfYearPopulationGrowth: int, currentCo2Emissions: float):
-    model = pickle.load(open(f'{MODELS_FOLDER}/population_increase_vs_annual_co2.pkl', 'rb'))
+    name = "population_increase_vs_annual_co2"
+    model = await trainable(name)
 
-    currentEmissionsPredicted = int(model.predict([[currentPopulationGrowth]])[0])
-    endOfYearEmissionsPredicted = int(model.predict([[endOfYearPopulationGrowth]])[0])
+    currentEmissionsPredicted = int(predict(name, [[currentPopulationGrowth]], model)[0])
+    endOfYearEmissionsPredicted = int(predict(name, [[endOfYearPopulationGrowth]], model)[0])
 
-    # write new data to csv
-    populationIncrease_annualco2_data = pd.read_csv(f'{DATA_FOLDER}/population_increase_vs_annual_co2.csv')
+    # append new data to the dataset
+    await append("population_increase_vs_annual_co2", [currentPopulationGrowth, currentCo2Emissions])
 
-    populationIncrease_annualco2_data = pd.concat(
-        [populationIncrease_annualco2_data, pd.DataFrame([[currentPopulationGrowth, currentCo2Emissions]],
-                                                         columns=populationIncrease_annualco2_data.columns)],
-        ignore_index=True)
-
-    # update model
-    populationIncreaseAxis = populationIncrease_annualco2_data.iloc[:, :-1].values
-    annualEmissionsAxis = populationIncrease_annualco2_data.iloc[:, 1].values
-
-    populationIncreaseAxisTrain, timeAxisTest, annualEmissionsTrain, annualEmissionsTest = train_test_split(
-        populationIncreaseAxis, annualEmissionsAxis,
-        test_size=0.15,
-        random_state=0)
-    model.fit(populationIncreaseAxisTrain, annualEmissionsTrain)
-    accuracy = model.score(timeAxisTest, annualEmissionsTest)
-
-    # save model
-    pickle.dump(model, open(f'{MODELS_FOLDER}/population_increase_vs_annual_co2.pkl', 'wb'))
-    populationIncrease_annualco2_data.to_csv(f'{DATA_FOLDER}/population_increase_vs_annual_co2.csv', index=False)
+    # the model is updated in the background by the retrain scheduler
+    accuracy = model.score()
 
     return {
         "currentPopulationGrowth": currentPopulationGrowth,
@@ -277,33 +439,17 @@ async def annualEmissions(currentPopulationGrowth: int, endOfYearPopulationGrowt
 
 @app.post("/totalEmissions")
 async def totalEmissions(currentPopulation: int, endOfYearPopulation: int):
-    model = pickle.load(open(f'{MODELS_FOLDER}/population_vs_total_co2.pkl', 'rb'))
+    name = "population_vs_total_co2"
+    model = await trainable(name)
 
     currentPopulationGrowthArray = numpy.array([currentPopulation]).reshape(-1, 1)
     endOfYearPopulationGrowthArray = numpy.array([endOfYearPopulation]).reshape(-1, 1)
 
-    currentTotalEmissionsPredicted = int(model.predict(poly.fit_transform(currentPopulationGrowthArray))[0])
-    endOfYearTotalEmissionsPredicted = int(model.predict(poly.fit_transform(endOfYearPopulationGrowthArray))[0])
-
-    # write new data to csv
-    population_totalco2_data = pd.read_csv(f'{DATA_FOLDER}/population_vs_total_co2.csv')
+    currentTotalEmissionsPredicted = int(predict(name, polynomial(currentPopulationGrowthArray), model)[0])
+    endOfYearTotalEmissionsPredicted = int(predict(name, polynomial(endOfYearPopulationGrowthArray), model)[0])
 
-    # update model
-    populationAxis = population_totalco2_data.iloc[:, :-1].values
-    totalEmissionsAxis = population_totalco2_data.iloc[:, 1].values
-
-    populationAxis = poly.fit_transform(populationAxis.reshape(-1, 1))
-
-    populationAxisTrain, populationAxisTest, totalEmissionsAxisTrain, totalEmissionsAxisTest = train_test_split(
-        populationAxis, totalEmissionsAxis,
-        test_size=0.3,
-        random_state=0)
-    model.fit(populationAxisTrain, totalEmissionsAxisTrain)
-    accuracy = model.score(populationAxisTest, totalEmissionsAxisTest)
-
-    # save model
-    pickle.dump(model, open(f'{MODELS_FOLDER}/population_vs_total_co2.pkl', 'wb'))
-    population_totalco2_data.to_csv(f'{DATA_FOLDER}/population_vs_total_co2.csv', index=False)
+    # this endpoint adds no sample to the dataset, so the model is already up to date
+    accuracy = model.score()
 
     return {
         "currentPopulation": currentPopulation,
@@ -312,3 +458,198 @@ async def totalEmissions(currentPopulation: int, endOfYearPopulation: int):
         "endOfYearTotalCo2EmissionsPredicted": endOfYearTotalEmissionsPredicted,
         "accuracy": accuracy
     }
+
+
+# every model behind the 2030/2050 forecasts, db-collector tells its own retrains apart from ones that moved a value
+FORECAST_MODELS = ["population", "population-increase", "population_vs_total_co2", "population_increase_vs_annual_co2",
+                   "annualtemp-annualco2", "population_increase_vs_total_fossil_energy",
+                   "population_increase_vs_total_renewable_energy", "population_increase_vs_wind",
+                   "population_increase_vs_hydropower", "population_increase_vs_solar",
+                   "population_increase_vs_other_renewables"]
+
+
+@app.post("/tick")
+async def tick(population: int, populationGrowthThisYear: int, populationGrowthToday: int, currentCo2Emissions: float,
+               fossilEnergyMWh: float, renewableEnergyMWh: float, years: List[int] = Query([2030, 2050])):
+    # everything db-collector used to chain over HTTP for one reading, evaluated in process
+    fossilEnergyTWh = fossilEnergyMWh / 1000000
+    renewableEnergyTWh = renewableEnergyMWh / 1000000
+
+    predictionPopulation = await record_population(population, populationGrowthThisYear)
+    predictionAnnualEmissions = await annualEmissions(populationGrowthThisYear,
+                                                      predictionPopulation["endOfYearPopulationGrowthPredicted"],
+                                                      currentCo2Emissions)
+    predictionTotalEmissions = await totalEmissions(population, predictionPopulation["endOfYearPopulationPredicted"])
+
+    await append("population_increase_vs_total_energy", [populationGrowthToday, renewableEnergyTWh, fossilEnergyTWh])
+
+    energyProductionBy = predict_energy_production_by(years)
+    populationBy = predict_population_by(years, population)
+    totalCo2EmissionsBy = predict_total_co2_emissions_by(years, predictionTotalEmissions["totalCo2EmissionsPredicted"])
+    annualEmissionsBy = predict_annual_emissions([forecast["populationGrowthCalculated"] for forecast in populationBy])
+    tempAnomalyBy = predict_temp_anomaly(annualEmissionsBy)
+
+    return {
+        "population": predictionPopulation,
+        "annualEmissions": predictionAnnualEmissions,
+        "totalEmissions": predictionTotalEmissions,
+        "totalFossilEnergyAccuracy": (await trainable("population_increase_vs_total_fossil_energy")).score(),
+        "totalRenewableEnergyAccuracy": (await trainable("population_increase_vs_total_renewable_energy")).score(),
+        "modelVersions": {name: registry.version(name) for name in FORECAST_MODELS},
+        "forecasts": [
+            {
+                "year": year,
+                "energyProduction": energyProductionBy[i],
+                "populationBy": populationBy[i],
+                "co2EmissionsBy": {
+                    "totalCo2EmissionsPredicted": totalCo2EmissionsBy[i]["totalCo2EmissionsPredicted"],
+                    "annualCo2EmissionsPredicted": annualEmissionsBy[i],
+                    "tempAnomalyPredicted": tempAnomalyBy[i]
+                }
+            } for i, year in enumerate(years)
+        ]
+    }
+
+
+def extend_datasets(samples: Dict[str, numpy.ndarray]):
+    for dataset, rows in samples.items():
+        store.dataset(dataset).extend(rows)
+
+
+@app.post("/tick/bulk")
+async def tick_bulk(request: BulkTickRequest):
+    # /tick for many readings at once: every reading's samples are appended in one write per dataset and the
+    # models answer for every reading at its own time. a backfill refits each model once over all of it first
+    readings, years = request.readings, request.years
+    if not readings:
+        return {"modelVersions": {name: registry.version(name) for name in FORECAST_MODELS}, "ticks": []}
+
+    # readings without a timezone were sampled in utc
+    times = [reading.time.astimezone(timezone.utc) if reading.time.tzinfo else reading.time.replace(tzinfo=timezone.utc)
+             for reading in readings]
+    timeStamps = numpy.array([int(readingTime.timestamp()) for readingTime in times], dtype=numpy.int64)
+    yearEndTimeStamps = year_end_timestamps([readingTime.year for readingTime in times])
+    previousYearTimeStamps = year_end_timestamps([readingTime.year - 1 for readingTime in times])
+    populations = numpy.array([reading.population for reading in readings], dtype=numpy.int64)
+    growthsThisYear = numpy.array([reading.populationGrowthThisYear for reading in readings], dtype=numpy.int64)
+    growthsToday = numpy.array([reading.populationGrowthToday for reading in readings], dtype=float)
+    co2Emissions = numpy.array([reading.currentCo2Emissions for reading in readings], dtype=float)
+    fossilEnergyTWh = numpy.array([reading.fossilEnergyMWh for reading in readings], dtype=float) / 1000000
+    renewableEnergyTWh = numpy.array([reading.renewableEnergyMWh for reading in readings], dtype=float) / 1000000
+
+    await pools.io(extend_datasets, {
+        "population": numpy.column_stack([timeStamps, populations]),
+        "population-increase": numpy.column_stack([timeStamps - previousYearTimeStamps, growthsThisYear]),
+        "population_increase_vs_annual_co2": numpy.column_stack([growthsThisYear, co2Emissions]),
+        "population_increase_vs_total_energy": numpy.column_stack([growthsToday, renewableEnergyTWh,
+                                                                   fossilEnergyTWh])
+    })
+    if len(readings) >= BULK_REFIT_READINGS:
+        await scheduler.retrain_now(TRAINABLE_MODELS)
+
+    populationModel = await trainable("population")
+    growthModel = await trainable("population-increase")
+    annualModel = await trainable("population_increase_vs_annual_co2")
+    totalModel = await trainable("population_vs_total_co2")
+
+    populationPredicted = integers(predict("population", polynomial(column(timeStamps)), populationModel))
+    growthPredicted = integers(predict("population-increase", polynomial(column(timeStamps - previousYearTimeStamps)),
+                                       growthModel))
+    endOfYearPopulationPredicted = integers(predict("population", polynomial(column(yearEndTimeStamps)),
+                                                    populationModel))
+    endOfYearGrowthPredicted = integers(predict(
+        "population-increase", polynomial(column(yearEndTimeStamps - previousYearTimeStamps)), growthModel))
+    emissionsPredicted = integers(predict("population_increase_vs_annual_co2", column(growthsThisYear), annualModel))
+    endOfYearEmissionsPredicted = integers(predict("population_increase_vs_annual_co2",
+                                                   column(endOfYearGrowthPredicted), annualModel))
+    totalEmissionsPredicted = integers(predict("population_vs_total_co2", polynomial(column(populations)),
+                                               totalModel))
+    endOfYearTotalEmissionsPredicted = integers(predict("population_vs_total_co2",
+                                                        polynomial(column(endOfYearPopulationPredicted)), totalModel))
+    populationAccuracy, growthAccuracy = populationModel.score(), growthModel.score()
+    annualAccuracy, totalAccuracy = annualModel.score(), totalModel.score()
+    fossilAccuracy = (await trainable("population_increase_vs_total_fossil_energy")).score()
+    renewableAccuracy = (await trainable("population_increase_vs_total_renewable_energy")).score()
+
+    # the year forecasts only depend on the reading through its population and time
+    energyProductionBy = predict_energy_production_by(years)
+    populationBy = population_by_readings(years, populations, timeStamps)
+    totalCo2EmissionsBy = predict_total_co2_emissions_by(years)
+    annualEmissionsBy = predict_annual_emissions([forecast["populationGrowthCalculated"]
+                                                  for forecast in populationBy[0]])
+    tempAnomalyBy = predict_temp_anomaly(annualEmissionsBy)
+    co2EmissionsBy = [
+        {
+            "totalCo2EmissionsPredicted": totalCo2EmissionsBy[i]["totalCo2EmissionsPredicted"],
+            "annualCo2EmissionsPredicted": annualEmissionsBy[i],
+            "tempAnomalyPredicted": tempAnomalyBy[i]
+        } for i in range(len(years))
+    ]
+
+    return {
+        "modelVersions": {name: registry.version(name) for name in FORECAST_MODELS},
+        "ticks": [
+            {
+                "time": reading.time,
+                "population": {
+                    "population": reading.population,
+                    "populationGrowthThisYear": reading.populationGrowthThisYear,
+                    "populationPredicted": populationPredicted[r],
+                    "populationGrowthThisYearPredicted": growthPredicted[r],
+                    "endOfYearPopulationPredicted": endOfYearPopulationPredicted[r],
+                    "endOfYearPopulationGrowthPredicted": endOfYearGrowthPredicted[r],
+                    "populationAccuracy": populationAccuracy,
+                    "growthAccuracy": growthAccuracy
+                },
+                "annualEmissions": {
+                    "currentPopulationGrowth": reading.populationGrowthThisYear,
+                    "currentEmissions": reading.currentCo2Emissions,
+                    "endOfYearPopulationGrowth": endOfYearGrowthPredicted[r],
+                    "currentEmissionsPredicted": emissionsPredicted[r],
+                    "endOfYearEmissionsPredicted": endOfYearEmissionsPredicted[r],
+                    "accuracy": annualAccuracy
+                },
+                "totalEmissions": {
+                    "currentPopulation": reading.population,
+                    "endOfYearPopulation": endOfYearPopulationPredicted[r],
+                    "totalCo2EmissionsPredicted": totalEmissionsPredicted[r],
+                    "endOfYearTotalCo2EmissionsPredicted": endOfYearTotalEmissionsPredicted[r],
+                    "accuracy": totalAccuracy
+                },
+                "totalFossilEnergyAccuracy": fossilAccuracy,
+                "totalRenewableEnergyAccuracy": renewableAccuracy,
+                "forecasts": [
+                    {
+                        "year": year,
+                        "energyProduction": energyProductionBy[i],
+                        "populationBy": populationBy[r][i],
+                        "co2EmissionsBy": co2EmissionsBy[i]
+                    } for i, year in enumerate(years)
+                ]
+            } for r, reading in enumerate(readings)
+        ]
+    }
+
+
+@app.get("/cache")
+async def cache_stats():
+    return forecasts.stats()
+
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    # the gauges are read when scraped, everything else is recorded as it happens
+    for name, version in list(registry.versions.items()):
+        metrics.MODEL_VERSION.labels(name).set(version)
+    for name, dataset in list(store.datasets.items()):
+        metrics.DATASET_ROWS.labels(name).set(len(dataset))
+    cacheStats = forecasts.stats()
+    for stat in ("size", "hits", "misses", "evictions"):
+        metrics.FORECAST_CACHE.labels(stat).set(cacheStats[stat])
+    return metrics.render()
+
+
+@app.get("/pools")
+async def pool_stats():
+    # queue wait versus run time of the i/o threads and training processes
+    return pools.summary()
@@ -0,0 +1,110 @@
+# prometheus metrics for GET /metrics, and an optional profiler for slow requests
+#
+# with several uvicorn workers point PROMETHEUS_MULTIPROC_DIR at an empty folder they share, a scrape then adds up
+# every worker instead of showing whichever one answered it.
+# PROFILE_SLOW_REQUESTS=<seconds> profiles a sample of requests with pyinstrument (when it's installed) and keeps
+# the ones that took longer as html in PROFILE_FOLDER
+import asyncio
+import os
+import random
+import re
+import time
+from datetime import datetime
+from typing import Optional
+
+from fastapi import Request
+from fastapi.responses import Response
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram,
+                               generate_latest, multiprocess)
+
+PROFILE_SLOW_REQUESTS = float(os.getenv("PROFILE_SLOW_REQUESTS", 0))
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", 0.1))
+PROFILE_FOLDER = os.getenv("PROFILE_FOLDER", "profiles")
+PROFILES_KEPT = int(os.getenv("PROFILES_KEPT", 50))
+
+# predictions take microseconds and retrains seconds, the default buckets only start at 5ms
+BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5,
+           10, 30, 60)
+
+REQUEST_SECONDS = Histogram("ai_request_seconds", "Time to answer a request", ["method", "route", "status"],
+                            buckets=BUCKETS)
+SLOW_REQUESTS = Counter("ai_slow_requests_total", "Profiled requests slower than PROFILE_SLOW_REQUESTS", ["route"])
+PREDICT_SECONDS = Histogram("ai_predict_seconds", "Time spent in a model's predict()", ["model"], buckets=BUCKETS)
+MODEL_LOAD_SECONDS = Histogram("ai_model_load_seconds", "Time to read a model version from disk", ["model"],
+                               buckets=BUCKETS)
+MODEL_VERSION = Gauge("ai_model_version", "Version of the model being served", ["model"], multiprocess_mode="max")
+MODEL_REFITS = Counter("ai_model_refits_total", "Retrains that published a new model version", ["model"])
+DATASET_ROWS = Gauge("ai_dataset_rows", "Samples in a dataset", ["dataset"], multiprocess_mode="max")
+POOL_WAIT_SECONDS = Histogram("ai_pool_wait_seconds", "Time a job queued for a free thread or process", ["pool"],
+                              buckets=BUCKETS)
+POOL_RUN_SECONDS = Histogram("ai_pool_run_seconds", "Time a job ran in a thread or process", ["pool", "job"],
+                             buckets=BUCKETS)
+# only refreshed when the worker itself answers a scrape, so they're reported per worker
+FORECAST_CACHE = Gauge("ai_forecast_cache", "Forecast cache counters", ["stat"], multiprocess_mode="liveall")
+
+profilerMissing = False
+
+
+def route_of(request: Request) -> str:
+    # the route template, /populationBy/{year} rather than every year on its own
+    route = request.scope.get("route")
+    return getattr(route, "path", "unmatched")
+
+
+def start_profiler():
+    global profilerMissing
+    if not PROFILE_SLOW_REQUESTS or profilerMissing or random.random() >= PROFILE_SAMPLE_RATE:
+        return None
+    try:
+        from pyinstrument import Profiler
+    except ImportError:
+        print("pyinstrument is not installed, slow requests won't be profiled")
+        profilerMissing = True
+        return None
+    profiler = Profiler(async_mode="enabled", interval=0.001)
+    profiler.start()
+    return profiler
+
+
+def save_profile(profiler, route: str, seconds: float):
+    html = profiler.output_html()
+    os.makedirs(PROFILE_FOLDER, exist_ok=True)
+    slug = re.sub(r"[^A-Za-z0-9]+", "_", route)
+    name = f"{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}{slug}-{int(seconds * 1000)}ms.html"
+    with open(os.path.join(PROFILE_FOLDER, name), "w") as file:
+        file.write(html)
+    for old in sorted(os.listdir(PROFILE_FOLDER))[:-PROFILES_KEPT]:
+        os.remove(os.path.join(PROFILE_FOLDER, old))
+
+
+async def instrument(request: Request, call_next):
+    profiler = start_profiler()
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        seconds = time.perf_counter() - started
+        route = route_of(request)
+        REQUEST_SECONDS.labels(request.method, route, str(status)).observe(seconds)
+        if profiler is not None:
+            profiler.stop()
+            if seconds >= PROFILE_SLOW_REQUESTS:
+                SLOW_REQUESTS.labels(route).inc()
+                await asyncio.to_thread(save_profile, profiler, route, seconds)
+
+
+def timed_predict(name: str, model, values):
+    started = time.perf_counter()
+    predicted = model.predict(values)
+    PREDICT_SECONDS.labels(name).observe(time.perf_counter() - started)
+    return predicted
+
+
+def render(registry: Optional[CollectorRegistry] = None) -> Response:
+    if registry is None and os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return Response(generate_latest(registry or REGISTRY), media_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,164 @@
+# keep every trained model resident in memory instead of unpickling it on each request
+#
+# every model is a folder MODELS_FOLDER/<name>/ of immutable version files (1.json, 2.json, ... or .pkl) and a
+# CURRENT file naming the live one. a new version is written under its own name and then published by renaming a
+# new CURRENT over the old one, so any number of workers can share the folder without ever reading half a model.
+# flat <name>.json / <name>.pkl files from before are still loaded until the model is first replaced
+import fcntl
+import os
+import pickle
+import threading
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import compactModel
+import metrics
+
+# linear models found as pickles are rewritten as compact json the first time they're loaded
+COMPACT_MODELS = os.getenv("COMPACT_MODELS", "1") == "1"
+# old versions are kept around for a while, a worker may still be reading one
+MODEL_VERSIONS_KEPT = int(os.getenv("MODEL_VERSIONS_KEPT", 5))
+# scores of the last offline training run, written by train/trainModels.py
+MANIFEST = "manifest.json"
+
+
+class ModelRegistry:
+    def __init__(self, folder: str):
+        self.folder = folder
+        self.models: Dict[str, Any] = {}
+        self.stamps: Dict[str, Tuple[int, int, int]] = {}
+        self.versions: Dict[str, int] = {}
+        self.lock = threading.RLock()
+
+    def directory(self, name: str) -> str:
+        return os.path.join(self.folder, name)
+
+    def pointer(self, name: str) -> str:
+        return os.path.join(self.directory(name), "CURRENT")
+
+    def current(self, name: str) -> Optional[str]:
+        try:
+            with open(self.pointer(name)) as file:
+                return file.read().strip()
+        except FileNotFoundError:
+            return None
+
+    def path(self, name: str) -> str:
+        current = self.current(name)
+        if current is not None:
+            return os.path.join(self.directory(name), current)
+        # the compact file wins, the pickle is only there for models that can't be written compactly
+        compact = os.path.join(self.folder, f"{name}.json")
+        return compact if os.path.exists(compact) else os.path.join(self.folder, f"{name}.pkl")
+
+    def stamp(self, name: str) -> Tuple[int, int, int]:
+        # publishing renames a new pointer into place, so its inode changes with every version
+        pointer = self.pointer(name)
+        stat = os.stat(pointer if os.path.exists(pointer) else self.path(name))
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def names(self) -> List[str]:
+        names = set()
+        for file in os.listdir(self.folder):
+            if file == MANIFEST:
+                continue
+            if file.endswith((".pkl", ".json")):
+                names.add(os.path.splitext(file)[0])
+            elif os.path.exists(self.pointer(file)):
+                names.add(file)
+        return sorted(names)
+
+    def load_all(self):
+        for name in self.names():
+            self.load(name)
+        print("Loaded models:", ", ".join(self.models))
+
+    def read(self, path: str) -> Any:
+        if path.endswith(".json"):
+            return compactModel.load(path)
+        with open(path, 'rb') as file:
+            return pickle.load(file)
+
+    def load(self, name: str) -> Any:
+        with self.lock, metrics.MODEL_LOAD_SECONDS.labels(name).time():
+            stamp = self.stamp(name)
+            current = self.current(name)
+            model = self.read(self.path(name))
+            if current is None and COMPACT_MODELS and self.path(name).endswith(".pkl") and \
+                    compactModel.exportable(model):
+                compactModel.write(os.path.join(self.folder, f"{name}.json"), model)
+                print("Converted", name, "to the compact model format")
+                stamp = self.stamp(name)
+                model = compactModel.load(self.path(name))
+
+            self.models[name] = model
+            self.stamps[name] = stamp
+            # published versions are numbered the same in every worker, flat files just count reloads
+            self.versions[name] = int(os.path.splitext(current)[0]) if current else self.versions.get(name, 0) + 1
+            return model
+
+    def get(self, name: str) -> Any:
+        # a single stat() per lookup, the model is only read again once a new version was published
+        if name not in self.models or self.stamps[name] != self.stamp(name):
+            return self.load(name)
+        return self.models[name]
+
+    def version(self, name: str) -> int:
+        self.get(name)
+        return self.versions[name]
+
+    @contextmanager
+    def exclusive(self, name: str):
+        # one writer per model across every process sharing the folder
+        os.makedirs(self.directory(name), exist_ok=True)
+        with self.lock, open(os.path.join(self.directory(name), ".lock"), 'w') as lockFile:
+            fcntl.flock(lockFile, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lockFile, fcntl.LOCK_UN)
+
+    def update(self, name: str, change: Callable[[Any], Optional[Any]]) -> Any:
+        # change gets the latest published model, None for a new one, and returns its successor or None to keep it
+        with self.exclusive(name):
+            model = self.get(name) if os.path.exists(self.path(name)) else None
+            updated = change(model)
+            if updated is None:
+                return model
+            self.publish(name, updated)
+            return updated
+
+    def replace(self, name: str, model: Any):
+        self.update(name, lambda current: model)
+
+    def publish(self, name: str, model: Any):
+        directory = self.directory(name)
+        versions = [int(os.path.splitext(file)[0]) for file in os.listdir(directory)
+                    if os.path.splitext(file)[0].isdigit()]
+        version = max(versions + [self.versions.get(name, 0)]) + 1
+        file = f"{version}.json" if compactModel.exportable(model) else f"{version}.pkl"
+
+        # the version file is complete before anything points at it and is never written again
+        temp = os.path.join(directory, f".{file}.{os.getpid()}.tmp")
+        if file.endswith(".json"):
+            compactModel.write(temp, model)
+        else:
+            with open(temp, 'wb') as output:
+                pickle.dump(model, output)
+        os.replace(temp, os.path.join(directory, file))
+
+        pointer = os.path.join(directory, f".CURRENT.{os.getpid()}.tmp")
+        with open(pointer, 'w') as output:
+            output.write(file)
+        os.replace(pointer, self.pointer(name))
+
+        self.models[name] = model
+        self.stamps[name] = self.stamp(name)
+        self.versions[name] = version
+
+        for old in sorted(versions)[:-MODEL_VERSIONS_KEPT]:
+            for extension in (".json", ".pkl"):
+                try:
+                    os.remove(os.path.join(directory, f"{old}{extension}"))
+                except FileNotFoundError:
+                    pass
@@ -0,0 +1,102 @@
+# least squares regression that keeps running sufficient statistics, so adding samples never refits the whole history
+import numpy
+
+
+class Moments:
+    # running mean and co-moment matrix of a stream of row vectors (Welford, merged in batches with Chan's formula)
+    def __init__(self, width: int):
+        self.count = 0
+        self.mean = numpy.zeros(width)
+        self.comoment = numpy.zeros((width, width))
+
+    def update(self, rows: numpy.ndarray):
+        batchCount = len(rows)
+        if batchCount == 0:
+            return
+
+        batchMean = rows.mean(axis=0)
+        centered = rows - batchMean
+        total = self.count + batchCount
+        delta = batchMean - self.mean
+
+        self.comoment += centered.T @ centered + numpy.outer(delta, delta) * (self.count * batchCount / total)
+        self.mean += delta * (batchCount / total)
+        self.count = total
+
+
+class OnlineLinearRegression:
+    """
+    Drop-in replacement for sklearn's LinearRegression (fit / predict / score, coef_ / intercept_) that can be
+    updated one sample at a time in O(features²).
+
+    Every sample is kept out of the fit with probability test_size, deterministically by arrival order, so
+    score() is still a held-out R² like the train_test_split + score the endpoints used to do.
+    """
+
+    def __init__(self, features: int = 1, test_size: float = 0.15):
+        self.features = features
+        self.test_size = test_size
+        self.reset()
+
+    def reset(self):
+        self.seen = 0
+        self.train = Moments(self.features + 1)
+        self.test = Moments(self.features + 1)
+        self.coef_ = numpy.zeros(self.features)
+        self.intercept_ = 0.0
+
+    def fit(self, X, y):
+        self.reset()
+        return self.partial_fit(X, y)
+
+    def partial_fit(self, X, y):
+        X = numpy.asarray(X, dtype=float).reshape(-1, self.features)
+        y = numpy.asarray(y, dtype=float).reshape(-1, 1)
+        rows = numpy.hstack([X, y])
+
+        index = numpy.arange(self.seen, self.seen + len(rows))
+        isTest = numpy.floor((index + 1) * self.test_size) > numpy.floor(index * self.test_size)
+
+        self.train.update(rows[~isTest])
+        self.test.update(rows[isTest])
+        self.seen += len(rows)
+        self.solve()
+        return self
+
+    def solve(self):
+        if self.train.count < 2:
+            return
+
+        xx = self.train.comoment[:-1, :-1]
+        xy = self.train.comoment[:-1, -1]
+
+        # standardise before solving, polynomial time features span ~18 orders of magnitude
+        scale = numpy.sqrt(numpy.diag(xx))
+        scale[scale == 0] = 1
+        coef = numpy.linalg.lstsq(xx / numpy.outer(scale, scale), xy / scale, rcond=None)[0] / scale
+
+        self.coef_ = coef
+        self.intercept_ = float(self.train.mean[-1] - self.train.mean[:-1] @ coef)
+
+    def predict(self, X):
+        return numpy.asarray(X, dtype=float).reshape(-1, self.features) @ self.coef_ + self.intercept_
+
+    def score(self, X=None, y=None) -> float:
+        # R² on the given data, or on the held-out samples when called without arguments
+        if X is not None:
+            moments = Moments(self.features + 1)
+            moments.update(numpy.hstack([numpy.asarray(X, dtype=float).reshape(-1, self.features),
+                                         numpy.asarray(y, dtype=float).reshape(-1, 1)]))
+        else:
+            moments = self.test
+
+        if moments.count < 2 or moments.comoment[-1, -1] == 0:
+            return 0.0
+
+        xx = moments.comoment[:-1, :-1]
+        xy = moments.comoment[:-1, -1]
+        yy = moments.comoment[-1, -1]
+        meanResidual = moments.mean[-1] - self.intercept_ - moments.mean[:-1] @ self.coef_
+
+        residualSumOfSquares = yy - 2 * self.coef_ @ xy + self.coef_ @ xx @ self.coef_ + moments.count * meanResidual ** 2
+        return float(1 - residualSumOfSquares / yy)
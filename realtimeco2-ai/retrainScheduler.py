@@ -0,0 +1,112 @@
+# retrains models in the background so ingest requests only have to append their sample
+import asyncio
+import fcntl
+import json
+import os
+import time
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, Iterable, Optional
+
+
+@dataclass
+class RetrainPolicy:
+    # retrain once any of these is reached, None disables that trigger
+    samples: Optional[int] = 20
+    seconds: Optional[float] = 300
+    drift: Optional[float] = 0.1
+
+
+def load_policies(names: Iterable[str]) -> Dict[str, RetrainPolicy]:
+    # RETRAIN_POLICIES='{"*": {"samples": 100}, "population": {"seconds": 60, "drift": null}}'
+    default = RetrainPolicy(
+        samples=int(os.getenv('RETRAIN_EVERY_SAMPLES', 20)) or None,
+        seconds=float(os.getenv('RETRAIN_EVERY_SECONDS', 300)) or None,
+        drift=float(os.getenv('RETRAIN_DRIFT_THRESHOLD', 0.1)) or None,
+    )
+    overrides = json.loads(os.getenv('RETRAIN_POLICIES', '{}'))
+    default = RetrainPolicy(**{**default.__dict__, **overrides.get("*", {})})
+    return {name: RetrainPolicy(**{**default.__dict__, **overrides.get(name, {})}) for name in names}
+
+
+class RetrainScheduler:
+    def __init__(self, policies: Dict[str, RetrainPolicy], pending: Callable[[str], int],
+                 drift: Callable[[str], float], retrain: Callable[[str], Awaitable], interval: float = 1,
+                 leaderLock: Optional[str] = None, offload: Optional[Callable[..., Awaitable]] = None):
+        self.policies = policies
+        self.pending = pending
+        self.drift = drift
+        self.retrain = retrain
+        self.interval = interval
+        # pending() and drift() read the datasets, they run wherever offload sends them
+        self.offload = offload or asyncio.to_thread
+        self.lastRetrain = {name: time.monotonic() for name in policies}
+        self.retrains = {name: 0 for name in policies}
+        self.task: Optional[asyncio.Task] = None
+        # with several workers sharing the model folder only the one holding this lock retrains
+        self.leaderLock = leaderLock
+        self.leaderFile = None
+
+    def leader(self) -> bool:
+        if self.leaderLock is None or self.leaderFile is not None:
+            return True
+        lockFile = open(self.leaderLock, 'w')
+        try:
+            fcntl.flock(lockFile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lockFile.close()
+            return False
+        # the lock goes away with the process, another worker takes over if we die
+        self.leaderFile = lockFile
+        print("Retraining models in this worker, pid", os.getpid())
+        return True
+
+    def due(self, name: str) -> bool:
+        policy = self.policies[name]
+        pending = self.pending(name)
+        if pending == 0:
+            return False
+        if policy.samples is not None and pending >= policy.samples:
+            return True
+        if policy.seconds is not None and time.monotonic() - self.lastRetrain[name] >= policy.seconds:
+            return True
+        return policy.drift is not None and self.drift(name) >= policy.drift
+
+    async def run(self):
+        while True:
+            if not self.leader():
+                await asyncio.sleep(self.interval * 10)
+                continue
+            for name in self.policies:
+                try:
+                    if await self.offload(self.due, name):
+                        await self.retrain(name)
+                        self.lastRetrain[name] = time.monotonic()
+                        self.retrains[name] += 1
+                except Exception as e:
+                    print("Retraining", name, "failed:", repr(e))
+            await asyncio.sleep(self.interval)
+
+    async def retrain_now(self, names: Iterable[str]) -> bool:
+        # a backfill refits right away instead of waiting for its turn, still only in the worker that retrains
+        if not self.leader():
+            return False
+        names = list(names)
+        await asyncio.gather(*(self.retrain(name) for name in names))
+        for name in names:
+            self.lastRetrain[name] = time.monotonic()
+            self.retrains[name] += 1
+        return True
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        if self.leaderFile is not None:
+            self.leaderFile.close()
+            self.leaderFile = None
@@ -0,0 +1,165 @@
+# append-only column files for the datasets in DATA_FOLDER
+#
+# every dataset lives in DATA_FOLDER/<name>.columns/ as one little endian float64 file per column plus a
+# columns.json holding the original csv header. the csv files are only read once, to seed a dataset that has no
+# column files yet, and can be regenerated at any time with:
+#
+#   python sampleStore.py export [dataset ...]
+#
+# several workers may share the folder, appends and repairs take an exclusive flock on DATA_FOLDER/<name>.lock so
+# rows are never interleaved, and readers only count rows that made it into every column
+import argparse
+import csv
+import fcntl
+import json
+import os
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Sequence, Union
+
+import numpy
+
+DTYPE = numpy.dtype('<f8')
+
+
+class Dataset:
+    def __init__(self, folder: str, name: str):
+        self.name = name
+        self.path = os.path.join(folder, f"{name}.columns")
+        self.csvPath = os.path.join(folder, f"{name}.csv")
+        self.lockPath = os.path.join(folder, f"{name}.lock")
+
+        with self.exclusive():
+            if not os.path.isdir(self.path):
+                self.seed()
+
+            with open(os.path.join(self.path, "columns.json")) as file:
+                self.columns: List[str] = json.load(file)
+            self.files = [open(self.column_path(i), 'ab') for i in range(len(self.columns))]
+            self.repair()
+
+    @contextmanager
+    def exclusive(self):
+        with open(self.lockPath, 'w') as lockFile:
+            fcntl.flock(lockFile, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lockFile, fcntl.LOCK_UN)
+
+    def column_path(self, index: int) -> str:
+        return os.path.join(self.path, f"{index}.f64")
+
+    def seed(self):
+        with open(self.csvPath, newline='') as file:
+            reader = csv.reader(file)
+            header = next(reader)
+            rows = numpy.array([[float(value) if value else numpy.nan for value in row] for row in reader],
+                               dtype=DTYPE).reshape(-1, len(header))
+
+        # build the column files in a scratch folder and rename it into place, a crash leaves no half seeded dataset
+        temp = f"{self.path}.{os.getpid()}.tmp"
+        os.makedirs(temp, exist_ok=True)
+        for i in range(len(header)):
+            rows[:, i].tofile(os.path.join(temp, f"{i}.f64"))
+        with open(os.path.join(temp, "columns.json"), 'w') as file:
+            json.dump(header, file)
+        os.replace(temp, self.path)
+
+    def repair(self):
+        # a crash between column writes can leave some columns a row ahead, drop rows that aren't in every column.
+        # only ever called under the lock, otherwise it would cut off another worker's append halfway through
+        length = len(self)
+        for file in self.files:
+            if os.fstat(file.fileno()).st_size != length * DTYPE.itemsize:
+                file.truncate(length * DTYPE.itemsize)
+
+    @property
+    def length(self) -> int:
+        # other workers append too, so the files are the only place that knows how many rows there are
+        return min(os.fstat(file.fileno()).st_size for file in self.files) // DTYPE.itemsize
+
+    def __len__(self) -> int:
+        return self.length
+
+    def append(self, row: Sequence[float]):
+        self.extend([row])
+
+    def extend(self, rows: Iterable[Sequence[float]]):
+        rows = numpy.asarray(rows, dtype=DTYPE).reshape(-1, len(self.columns))
+        with self.exclusive():
+            # a write that failed before, here or in another worker, may have left some columns ahead
+            self.repair()
+            length = self.length
+            try:
+                for i, file in enumerate(self.files):
+                    file.write(rows[:, i].tobytes())
+                    file.flush()
+            except BaseException:
+                self.rollback(length)
+                raise
+
+    def rollback(self, length: int):
+        # the files are reopened first, a buffer that failed to flush would otherwise be written out after the cut
+        for file in self.files:
+            try:
+                file.close()
+            except OSError:
+                pass
+        self.files = [open(self.column_path(i), 'ab') for i in range(len(self.columns))]
+        for file in self.files:
+            file.truncate(length * DTYPE.itemsize)
+
+    def column(self, column: Union[int, str]) -> numpy.ndarray:
+        # read only view straight onto the file, nothing is parsed or copied
+        index = self.columns.index(column) if isinstance(column, str) else column
+        length = self.length
+        if length == 0:
+            return numpy.empty(0, dtype=DTYPE)
+        return numpy.memmap(self.column_path(index), dtype=DTYPE, mode='r', shape=(length,))
+
+    def export_csv(self, path: str = None):
+        path = path or self.csvPath
+        temp = f"{path}.{os.getpid()}.tmp"
+        length = self.length
+        columns = [self.column(i)[:length] for i in range(len(self.columns))]
+        with open(temp, 'w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(self.columns)
+            for start in range(0, length, 65536):
+                writer.writerows(zip(*(column[start:start + 65536].tolist() for column in columns)))
+        os.replace(temp, path)
+
+
+class SampleStore:
+    def __init__(self, folder: str):
+        self.folder = folder
+        self.datasets: Dict[str, Dataset] = {}
+
+    def dataset(self, name: str) -> Dataset:
+        if name not in self.datasets:
+            self.datasets[name] = Dataset(self.folder, name)
+        return self.datasets[name]
+
+    def names(self) -> List[str]:
+        names = {file[:-len(".columns")] for file in os.listdir(self.folder) if file.endswith(".columns")}
+        names |= {file[:-len(".csv")] for file in os.listdir(self.folder) if file.endswith(".csv")}
+        return sorted(names)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the append-only datasets of the AI service")
+    parser.add_argument("--folder", default=os.getenv('DATA_FOLDER', 'data'))
+    commands = parser.add_subparsers(dest="command", required=True)
+    export = commands.add_parser("export", help="write datasets back out as csv")
+    export.add_argument("datasets", nargs="*", help="datasets to export, all of them by default")
+    export.add_argument("--output", help="folder to write the csv files to, defaults to the data folder")
+    args = parser.parse_args()
+
+    store = SampleStore(args.folder)
+    if args.output:
+        os.makedirs(args.output, exist_ok=True)
+    for name in args.datasets or store.names():
+        dataset = store.dataset(name)
+        output = os.path.join(args.output, f"{name}.csv") if args.output else None
+        dataset.export_csv(output)
+        print("Exported", name, len(dataset), "rows")
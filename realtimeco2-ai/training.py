@@ -0,0 +1,95 @@
+# what it takes to (re)train the online models, importable on its own so retrains can run in worker processes
+import copy
+import os
+from typing import Dict, Optional, Tuple
+
+import numpy
+
+from modelRegistry import ModelRegistry
+from onlineRegression import OnlineLinearRegression
+from sampleStore import SampleStore
+
+# models that learn from ingested samples: name -> (dataset, feature column, target column, polynomial, test size)
+TRAINABLE_MODELS = {
+    "population": ("population", 0, 1, True, 0.15),
+    "population-increase": ("population-increase", 0, 1, True, 0.15),
+    "population_increase_vs_annual_co2": ("population_increase_vs_annual_co2", 0, 1, False, 0.15),
+    "population_vs_total_co2": ("population_vs_total_co2", 0, 1, True, 0.3),
+    "population_increase_vs_total_fossil_energy": ("population_increase_vs_total_energy", 0, 2, False, 0.15),
+    "population_increase_vs_total_renewable_energy": ("population_increase_vs_total_energy", 0, 1, False, 0.15),
+}
+
+# one registry and store per worker process, kept between jobs
+stores: Dict[Tuple[str, str], Tuple[ModelRegistry, SampleStore]] = {}
+
+
+def polynomial(values) -> numpy.ndarray:
+    # [x, x²] for a single feature, what PolynomialFeatures(degree=2, include_bias=False) used to produce
+    values = numpy.asarray(values, dtype=float).reshape(-1, 1)
+    return numpy.hstack([values, values * values])
+
+
+def features(name: str, values) -> numpy.ndarray:
+    values = numpy.asarray(values, dtype=float).reshape(-1, 1)
+    return polynomial(values) if TRAINABLE_MODELS[name][3] else values
+
+
+def unseen(store: SampleStore, name: str, model: OnlineLinearRegression):
+    # samples appended to the model's dataset since it was last trained
+    dataset, featureColumn, targetColumn, polynomial, testSize = TRAINABLE_MODELS[name]
+    data = store.dataset(dataset)
+    # other workers may append between the two reads, both columns are cut to the same length
+    length = len(data)
+    return data.column(featureColumn)[model.seen:length], data.column(targetColumn)[model.seen:length]
+
+
+def seed(store: SampleStore, name: str, model) -> Optional[OnlineLinearRegression]:
+    if isinstance(model, OnlineLinearRegression):
+        return None
+
+    # a model straight out of the training notebooks, build its running statistics from the dataset once
+    dataset, featureColumn, targetColumn, polynomial, testSize = TRAINABLE_MODELS[name]
+    data = store.dataset(dataset)
+    length = len(data)
+    model = OnlineLinearRegression(features=2 if polynomial else 1, test_size=testSize)
+    model.fit(features(name, data.column(featureColumn)[:length]), data.column(targetColumn)[:length])
+    return model
+
+
+def fold(store: SampleStore, name: str, current) -> Optional[OnlineLinearRegression]:
+    # fold the unseen samples into a copy of the latest published version, requests keep using that until the
+    # registry publishes the copy as the next one
+    seeded = seed(store, name, current)
+    current = seeded or current
+    featureAxis, targetAxis = unseen(store, name, current)
+    if len(targetAxis) == 0:
+        return seeded
+    model = copy.deepcopy(current)
+    model.partial_fit(features(name, featureAxis), targetAxis)
+    return model
+
+
+def worker_stores(modelsFolder: str, dataFolder: str) -> Tuple[ModelRegistry, SampleStore]:
+    key = (modelsFolder, dataFolder)
+    if key not in stores:
+        stores[key] = ModelRegistry(modelsFolder), SampleStore(dataFolder)
+    return stores[key]
+
+
+def seed_job(modelsFolder: str, dataFolder: str, name: str) -> int:
+    # runs in a training process, publishes through the shared model folder and returns the live version
+    registry, store = worker_stores(modelsFolder, dataFolder)
+    registry.update(name, lambda current: seed(store, name, current))
+    return registry.version(name)
+
+
+def retrain_job(modelsFolder: str, dataFolder: str, name: str) -> int:
+    registry, store = worker_stores(modelsFolder, dataFolder)
+    registry.update(name, lambda current: fold(store, name, current))
+    return registry.version(name)
+
+
+def lower_priority(niceness: int):
+    # training processes yield the cpu to the workers answering requests
+    if niceness:
+        os.nice(niceness)
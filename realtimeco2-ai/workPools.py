@@ -0,0 +1,86 @@
+# keep blocking work off the event loop: file i/o goes to a thread pool, training to a pool of lower priority
+# processes, and both record how long jobs waited in the queue versus how long they ran
+import asyncio
+import multiprocessing
+import time
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Deque, Tuple
+
+import numpy
+
+import metrics
+from training import lower_priority
+
+
+def timed(function: Callable, *arguments) -> Tuple[Any, float, float]:
+    # runs inside the pool, wall clock so the times compare across processes
+    started = time.time()
+    result = function(*arguments)
+    return result, started, time.time()
+
+
+class PoolStats:
+    def __init__(self, samples: int = 1000):
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.waits: Deque[float] = deque(maxlen=samples)
+        self.runs: Deque[float] = deque(maxlen=samples)
+
+    def summary(self) -> dict:
+        def percentiles(values: Deque[float]) -> dict:
+            if not values:
+                return {"mean": 0, "p50": 0, "p99": 0, "max": 0}
+            values = numpy.fromiter(values, dtype=float)
+            return {"mean": float(values.mean()), "p50": float(numpy.percentile(values, 50)),
+                    "p99": float(numpy.percentile(values, 99)), "max": float(values.max())}
+
+        return {
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "inFlight": self.submitted - self.completed - self.failed,
+            "waitSeconds": percentiles(self.waits),
+            "runSeconds": percentiles(self.runs)
+        }
+
+
+class WorkPools:
+    def __init__(self, ioThreads: int = 4, trainProcesses: int = 1, trainNice: int = 10):
+        self.ioPool = ThreadPoolExecutor(ioThreads, thread_name_prefix="io")
+        # spawned rather than forked, forking a process that already runs threads and an event loop isn't safe
+        self.trainPool = ProcessPoolExecutor(trainProcesses, mp_context=multiprocessing.get_context("spawn"),
+                                             initializer=lower_priority, initargs=(trainNice,))
+        self.stats = {"io": PoolStats(), "train": PoolStats()}
+
+    async def submit(self, pool: str, executor: Executor, function: Callable, *arguments) -> Any:
+        stats = self.stats[pool]
+        stats.submitted += 1
+        submitted = time.time()
+        try:
+            result, started, finished = await asyncio.get_running_loop().run_in_executor(
+                executor, timed, function, *arguments)
+        except BaseException:
+            stats.failed += 1
+            raise
+        stats.completed += 1
+        stats.waits.append(max(started - submitted, 0))
+        stats.runs.append(finished - started)
+        metrics.POOL_WAIT_SECONDS.labels(pool).observe(stats.waits[-1])
+        metrics.POOL_RUN_SECONDS.labels(pool, getattr(function, "__name__", "job")).observe(stats.runs[-1])
+        return result
+
+    async def io(self, function: Callable, *arguments) -> Any:
+        return await self.submit("io", self.ioPool, function, *arguments)
+
+    async def train(self, function: Callable, *arguments) -> Any:
+        # function and arguments are pickled over to the training process, pass folders and names, not objects
+        return await self.submit("train", self.trainPool, function, *arguments)
+
+    def summary(self) -> dict:
+        return {name: stats.summary() for name, stats in self.stats.items()}
+
+    def shutdown(self):
+        self.ioPool.shutdown(wait=True)
+        self.trainPool.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,81 @@
+# sample the counters we use as often as configured, but only pass a reading on once something actually moved
+import json
+import os
+import time
+from typing import Dict, Optional, Union
+
+# reading field -> worldometer rts_counters name
+COUNTERS = {
+    "population": "current_population",
+    "populationGrowthThisYear": "absolute_growth_year",
+    "populationGrowthToday": "absolute_growth",
+    "currentCo2Emissions": "co2_emissions",
+    "fossilEnergyMWh": "energy_nonren",
+    "renewableEnergyMWh": "energy_ren"
+}
+
+
+def load_thresholds() -> Dict[str, float]:
+    # CHANGE_THRESHOLD is relative (0.001 = 0.1%) and applies to every field, CHANGE_THRESHOLDS overrides it per field
+    default = float(os.getenv("CHANGE_THRESHOLD", 0))
+    thresholds = {field: default for field in COUNTERS}
+    thresholds.update(json.loads(os.getenv("CHANGE_THRESHOLDS", "{}")))
+    return thresholds
+
+
+class MissingValues:
+    # worldometer reports a counter it hasn't loaded (yet) as null and db-collector rejects readings with one, so a
+    # missing value is filled with the field's last value for up to maxAge samples, after that the reading is dropped
+    def __init__(self, maxAge: int = 10):
+        self.maxAge = maxAge
+        self.last: Dict[str, Union[int, float]] = {}
+        self.age: Dict[str, int] = {}
+        self.repaired = 0
+        self.dropped = 0
+
+    def fill(self, values: Dict[str, Union[int, float, None]]) -> Optional[Dict[str, Union[int, float]]]:
+        missing = [field for field, value in values.items() if value is None]
+        for field, value in values.items():
+            if value is None:
+                self.age[field] = self.age.get(field, 0) + 1
+            else:
+                self.last[field] = value
+                self.age[field] = 0
+        if not missing:
+            return dict(values)
+        if any(field not in self.last or self.age[field] > self.maxAge for field in missing):
+            self.dropped += 1
+            return None
+        self.repaired += 1
+        return {field: self.last[field] if value is None else value for field, value in values.items()}
+
+
+class ChangeDetector:
+    def __init__(self, thresholds: Dict[str, float], maxSilence: float = 30):
+        self.thresholds = thresholds
+        # a reading goes out at least this often even if nothing moved enough, so downstream knows we're alive
+        self.maxSilence = maxSilence
+        self.last: Optional[Dict[str, Union[int, float]]] = None
+        self.lastTime = 0.0
+        self.sampled = 0
+        self.emitted = 0
+
+    def changed(self, values: Dict[str, Union[int, float]]) -> bool:
+        for field, value in values.items():
+            previous = self.last[field]
+            if value is None or previous is None:
+                if value != previous:
+                    return True
+            elif abs(value - previous) > self.thresholds.get(field, 0) * abs(previous):
+                return True
+        return False
+
+    def offer(self, values: Dict[str, Union[int, float]], now: Optional[float] = None) -> bool:
+        now = time.monotonic() if now is None else now
+        self.sampled += 1
+        if self.last is not None and now - self.lastTime < self.maxSilence and not self.changed(values):
+            return False
+        self.last = dict(values)
+        self.lastTime = now
+        self.emitted += 1
+        return True
@@ -0,0 +1,133 @@
+# append-only local spool of readings, they stay on disk until db-collector acknowledged them
+import json
+import os
+import threading
+from datetime import datetime, timezone
+from typing import List, Optional, Tuple
+
+SPOOL_COMPACT_BYTES = int(os.getenv("SPOOL_COMPACT_BYTES", 1024 * 1024))
+# readings are stored as differences to the previous one, with a full reading every so often
+SPOOL_KEYFRAME_EVERY = int(os.getenv("SPOOL_KEYFRAME_EVERY", 100))
+
+
+def to_millis(time: str) -> int:
+    return round(datetime.fromisoformat(time).timestamp() * 1000)
+
+
+def from_millis(millis: int) -> str:
+    return datetime.fromtimestamp(millis / 1000, timezone.utc).isoformat()
+
+
+def apply_delta(base: dict, delta: dict) -> dict:
+    return {field: value + delta.get(field, 0) for field, value in base.items()}
+
+
+class Spool:
+    def __init__(self, folder: str, keyframeEvery: int = SPOOL_KEYFRAME_EVERY):
+        os.makedirs(folder, exist_ok=True)
+        self.path = os.path.join(folder, "readings.jsonl")
+        self.offsetPath = os.path.join(folder, "offset")
+        self.keyframeEvery = keyframeEvery
+        self.lock = threading.Lock()
+        self.repair()
+        self.offset, self.base = self.read_offset()
+        # what the decoder will reconstruct for the last appended record, unknown until we write a keyframe
+        self.last: Optional[dict] = None
+        self.sinceKeyframe = 0
+
+    def repair(self):
+        # a reading that was half written when we crashed is cut off, the next append would run into it otherwise
+        if not os.path.exists(self.path):
+            open(self.path, "wb").close()
+            return
+        with open(self.path, "rb+") as file:
+            data = file.read()
+            if data and not data.endswith(b"\n"):
+                file.truncate(data.rfind(b"\n") + 1)
+
+    def read_offset(self) -> Tuple[int, Optional[dict]]:
+        # the offset file also keeps the decoded reading right before the offset, deltas after it build on that
+        try:
+            with open(self.offsetPath) as file:
+                state = json.loads(file.read() or "0")
+        except FileNotFoundError:
+            state = 0
+        if isinstance(state, int):
+            state = {"offset": state, "base": None}
+        # the spool was compacted but we died before the offset was reset
+        if state["offset"] > os.path.getsize(self.path):
+            return 0, state["base"]
+        return state["offset"], state["base"]
+
+    def write_offset(self, offset: int, base: Optional[dict]):
+        temp = f"{self.offsetPath}.tmp"
+        with open(temp, "w") as file:
+            file.write(json.dumps({"offset": offset, "base": base}))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp, self.offsetPath)
+        self.offset = offset
+        self.base = base
+
+    def encode(self, reading: dict) -> dict:
+        values = {field: value for field, value in reading.items() if field != "time"}
+        values["t"] = to_millis(reading["time"])
+        keyframe = self.last is None or self.sinceKeyframe >= self.keyframeEvery or \
+            self.last.keys() != values.keys() or any(value is None for value in values.values()) or \
+            any(value is None for value in self.last.values())
+        if keyframe:
+            self.last = values
+            self.sinceKeyframe = 0
+            return {"k": values}
+
+        # the delta is taken against what the decoder will have, so float rounding never accumulates
+        delta = {field: value - self.last[field] for field, value in values.items() if value != self.last[field]}
+        self.last = apply_delta(self.last, delta)
+        self.sinceKeyframe += 1
+        return {"d": delta}
+
+    def append(self, reading: dict):
+        with self.lock:
+            line = (json.dumps(self.encode(reading)) + "\n").encode()
+            with open(self.path, "ab") as file:
+                file.write(line)
+                file.flush()
+                os.fsync(file.fileno())
+
+    def read_batch(self, maxReadings: int) -> Tuple[List[dict], Tuple[int, Optional[dict]]]:
+        # returns the next unacknowledged readings and the position to commit once they were accepted
+        with self.lock:
+            readings = []
+            state = self.base
+            with open(self.path, "rb") as file:
+                file.seek(self.offset)
+                end = self.offset
+                for line in file:
+                    if len(readings) >= maxReadings or not line.endswith(b"\n"):
+                        break
+                    end += len(line)
+                    record = json.loads(line)
+                    if "k" in record:
+                        state = record["k"]
+                    elif state is not None:
+                        state = apply_delta(state, record["d"])
+                    else:
+                        print("Skipping a spooled reading without a keyframe before it")
+                        continue
+                    readings.append({"time": from_millis(state["t"]),
+                                     **{field: value for field, value in state.items() if field != "t"}})
+            return readings, (end, state)
+
+    def commit(self, position: Tuple[int, Optional[dict]]):
+        offset, base = position
+        with self.lock:
+            # once everything was uploaded the file can start over instead of growing forever
+            if offset == os.path.getsize(self.path) and offset >= SPOOL_COMPACT_BYTES:
+                with open(self.path, "rb+") as file:
+                    file.truncate(0)
+                offset = 0
+            self.write_offset(offset, base)
+
+    def pending(self) -> int:
+        with self.lock:
+            return os.path.getsize(self.path) - self.offset
@@ -0,0 +1,151 @@
+# the uploader against a local stand-in for db-collector's /bulk, run with `python -m pytest test_uploader.py`
+import asyncio
+import socket
+import tempfile
+
+import aiohttp
+from aiohttp import web
+
+from spool import Spool
+from uploader import Uploader
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class StandIn:
+    # accepts readings like /bulk does, answers with status while it's set and rejects readings with a null
+    def __init__(self, port: int):
+        self.port = port
+        self.received = []
+        self.status = None
+        self.runner = None
+
+    async def bulk(self, request: web.Request) -> web.Response:
+        readings = await request.json()
+        if self.status is not None:
+            return web.Response(status=self.status)
+        if any(value is None for reading in readings for value in reading.values()):
+            return web.Response(status=422, text="null value")
+        self.received += readings
+        return web.json_response({"status": "ok", "accepted": len(readings)})
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post("/bulk", self.bulk)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, "127.0.0.1", self.port).start()
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+
+def reading(i: int, population=None) -> dict:
+    return {"time": f"2024-01-01T00:{i // 60:02d}:{i % 60:02d}+00:00",
+            "population": 8000000000 + i if population is None else population, "populationGrowthThisYear": i}
+
+
+def spool_with(folder: str, count: int) -> Spool:
+    spool = Spool(folder)
+    for i in range(count):
+        spool.append(reading(i))
+    return spool
+
+
+async def upload_all(uploader: Uploader, session: aiohttp.ClientSession):
+    while await uploader.upload(session) == uploader.batchSize:
+        pass
+
+
+def test_outage_and_server_restart_lose_nothing():
+    async def run():
+        port = free_port()
+        server = StandIn(port)
+        spool = spool_with(tempfile.mkdtemp(), 30)
+        uploader = Uploader(spool, f"http://127.0.0.1:{port}/bulk", batchSize=10)
+        async with aiohttp.ClientSession() as session:
+            # nothing listening yet
+            try:
+                await uploader.upload(session)
+                raise AssertionError("upload to a closed port succeeded")
+            except aiohttp.ClientConnectionError:
+                pass
+            assert spool.pending() > 0
+
+            await server.start()
+            assert await uploader.upload(session) == 10
+            await server.stop()
+            try:
+                await uploader.upload(session)
+                raise AssertionError("upload to a stopped server succeeded")
+            except aiohttp.ClientConnectionError:
+                pass
+
+            await server.start()
+            await upload_all(uploader, session)
+            await server.stop()
+        assert [r["populationGrowthThisYear"] for r in server.received] == list(range(30))
+        assert spool.pending() == 0
+    asyncio.run(run())
+
+
+def test_collector_restart_resends_unacknowledged_readings():
+    async def run():
+        port = free_port()
+        server = StandIn(port)
+        folder = tempfile.mkdtemp()
+        spool_with(folder, 25)
+        await server.start()
+        # a new spool on the same folder is what the collector finds after a restart
+        uploader = Uploader(Spool(folder), f"http://127.0.0.1:{port}/bulk", batchSize=10)
+        async with aiohttp.ClientSession() as session:
+            await uploader.upload(session)
+            uploader = Uploader(Spool(folder), f"http://127.0.0.1:{port}/bulk", batchSize=10)
+            await upload_all(uploader, session)
+        await server.stop()
+        assert [r["populationGrowthThisYear"] for r in server.received] == list(range(25))
+    asyncio.run(run())
+
+
+def test_404_keeps_the_spool():
+    async def run():
+        port = free_port()
+        server = StandIn(port)
+        server.status = 404
+        spool = spool_with(tempfile.mkdtemp(), 15)
+        uploader = Uploader(spool, f"http://127.0.0.1:{port}/bulk", batchSize=10)
+        await server.start()
+        async with aiohttp.ClientSession() as session:
+            try:
+                await uploader.upload(session)
+                raise AssertionError("a 404 was taken as accepted")
+            except aiohttp.ClientResponseError as e:
+                assert e.status == 404
+            assert uploader.rejected == 0
+
+            server.status = None
+            await upload_all(uploader, session)
+        await server.stop()
+        assert len(server.received) == 15
+    asyncio.run(run())
+
+
+def test_a_null_reading_only_drops_itself():
+    async def run():
+        port = free_port()
+        server = StandIn(port)
+        spool = Spool(tempfile.mkdtemp())
+        for i in range(20):
+            spool.append(reading(i, population=None) if i != 7 else {**reading(i), "population": None})
+        uploader = Uploader(spool, f"http://127.0.0.1:{port}/bulk", batchSize=20)
+        await server.start()
+        async with aiohttp.ClientSession() as session:
+            await uploader.upload(session)
+        await server.stop()
+        assert uploader.rejected == 1
+        assert [r["populationGrowthThisYear"] for r in server.received] == [i for i in range(20) if i != 7]
+    asyncio.run(run())
@@ -0,0 +1,95 @@
+# drain the spool to db-collector's bulk endpoint in the background, so a slow or down db-collector never stalls sampling
+import asyncio
+import threading
+from typing import List, Optional
+
+import aiohttp
+
+from spool import Spool
+
+# db-collector's answers to readings it can't validate, any other error is retried with the batch as a whole
+REJECTED_STATUSES = (400, 422)
+
+
+class Uploader:
+    def __init__(self, spool: Spool, url: str, batchSize: int = 20, poolSize: int = 4, timeout: float = 60,
+                 interval: float = 5, maxRetryDelay: float = 300):
+        self.spool = spool
+        self.url = url
+        self.batchSize = batchSize
+        self.poolSize = poolSize
+        self.timeout = timeout
+        self.interval = interval
+        self.maxRetryDelay = maxRetryDelay
+        self.thread: Optional[threading.Thread] = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.wakeup: Optional[asyncio.Event] = None
+        self.uploaded = 0
+        self.rejected = 0
+        self.failures = 0
+
+    def notify(self):
+        # called from the sampling thread after each reading was spooled
+        if self.loop is not None and self.wakeup is not None:
+            self.loop.call_soon_threadsafe(self.wakeup.set)
+
+    async def upload(self, session: aiohttp.ClientSession) -> int:
+        readings, position = self.spool.read_batch(self.batchSize)
+        if not readings:
+            return 0
+        rejected = await self.send(session, readings)
+        # only acknowledged readings leave the spool, a failed batch is sent again as a whole
+        self.spool.commit(position)
+        self.uploaded += len(readings) - rejected
+        self.rejected += rejected
+        return len(readings)
+
+    async def send(self, session: aiohttp.ClientSession, readings: List[dict]) -> int:
+        # returns how many readings db-collector refused for good
+        async with session.post(self.url, json=readings) as response:
+            if response.status not in REJECTED_STATUSES:
+                # a 404 or 401 from a proxy or an older db-collector says nothing about the readings
+                response.raise_for_status()
+                return 0
+            reason = await response.text()
+        if len(readings) == 1:
+            # db-collector will never accept it, sending it again would block everything behind it
+            print("db-collector rejected a reading:", response.status, reason, readings[0])
+            return 1
+        # one bad reading shouldn't take the good ones with it, the halves are sent on their own until it's found
+        middle = len(readings) // 2
+        return await self.send(session, readings[:middle]) + await self.send(session, readings[middle:])
+
+    async def drain(self, session: aiohttp.ClientSession):
+        retryDelay = 1.0
+        while True:
+            try:
+                if await self.upload(session) < self.batchSize:
+                    return
+                retryDelay = 1.0
+            except Exception as e:
+                self.failures += 1
+                print("Uploading readings failed, retrying in", retryDelay, "seconds:", repr(e))
+                await asyncio.sleep(retryDelay)
+                retryDelay = min(retryDelay * 2, self.maxRetryDelay)
+
+    async def run(self):
+        self.wakeup = asyncio.Event()
+        connector = aiohttp.TCPConnector(limit=self.poolSize)
+        async with aiohttp.ClientSession(connector=connector,
+                                         timeout=aiohttp.ClientTimeout(total=self.timeout)) as session:
+            while True:
+                await self.drain(session)
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), self.interval)
+                except asyncio.TimeoutError:
+                    pass
+                self.wakeup.clear()
+
+    def start(self):
+        def serve():
+            self.loop = asyncio.new_event_loop()
+            self.loop.run_until_complete(self.run())
+
+        self.thread = threading.Thread(target=serve, name="uploader", daemon=True)
+        self.thread.start()
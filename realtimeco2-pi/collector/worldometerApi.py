@@ -1,8 +1,12 @@
 # use playwright to scrape data from worldometer website
-from typing import Dict, Union
+from typing import Dict, List, Union
 
 from playwright.sync_api import Playwright
 
+GET_VALUES = """(names) => Object.fromEntries(
+    names.map(name => [name, rts_counters[name] ? rts_counters[name].last_value : null])
+)"""
+
 
 class Api:
     def __init__(self, playwright: Playwright):
@@ -16,3 +20,7 @@ class Api:
 
     def get_data(self) -> Dict[str, Union[int, float, None]]:
         return self.page.evaluate("() => rts_counters")
+
+    def get_values(self, counters: List[str]) -> Dict[str, Union[int, float, None]]:
+        # only the counters asked for cross back from the browser, not the whole rts_counters object
+        return self.page.evaluate(GET_VALUES, counters)
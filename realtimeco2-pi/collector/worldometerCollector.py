@@ -1,32 +1,48 @@
 import time
+from datetime import datetime, timezone
 
 import os
-import requests
 from playwright.sync_api import sync_playwright
 
+from sampler import COUNTERS, ChangeDetector, MissingValues, load_thresholds
+from spool import Spool
+from uploader import Uploader
 from worldometerApi import Api
 
 DATA_URL = os.getenv("DATA_URL", "http://127.0.0.1:8001")
+# readings are written here first and uploaded in the background, so nothing is lost while db-collector is down
+SPOOL_FOLDER = os.getenv("SPOOL_FOLDER", "spool")
+UPLOAD_BATCH_SIZE = int(os.getenv("UPLOAD_BATCH_SIZE", 20))
+UPLOAD_POOL_SIZE = int(os.getenv("UPLOAD_POOL_SIZE", 4))
+UPLOAD_TIMEOUT = float(os.getenv("UPLOAD_TIMEOUT", 60))
+# counters can be sampled far more often than readings are sent, see CHANGE_THRESHOLD in sampler.py
+SAMPLE_INTERVAL = float(os.getenv("SAMPLE_INTERVAL", 30))
+MAX_SILENCE = float(os.getenv("MAX_SILENCE", 30))
+# how many samples in a row a counter may be missing and still be filled in with its last value
+MAX_MISSING_SAMPLES = int(os.getenv("MAX_MISSING_SAMPLES", 10))
+
+spool = Spool(SPOOL_FOLDER)
+uploader = Uploader(spool, f"{DATA_URL}/bulk", UPLOAD_BATCH_SIZE, UPLOAD_POOL_SIZE, UPLOAD_TIMEOUT)
+uploader.start()
+detector = ChangeDetector(load_thresholds(), MAX_SILENCE)
+missing = MissingValues(MAX_MISSING_SAMPLES)
 
 with sync_playwright() as p:
     api = Api(p)
 
+    nextSample = time.monotonic()
     while True:
-        data = api.get_data()
-        population = data["current_population"]["last_value"]
-        populationGrowth = data["absolute_growth_year"]["last_value"]
-        populationGrowthToday = data["absolute_growth"]["last_value"]
-        currentCo2Emissions = data["co2_emissions"]["last_value"]
-        fossilEnergyMWh = data["energy_nonren"]["last_value"]
-        renewableEnergyMWh = data["energy_ren"]["last_value"]
-
-        print("Population:", population, "Population Growth:", populationGrowth, "Current Co2 Emissions:",
-              currentCo2Emissions)
-
-        url = (
-            f"{DATA_URL}/?population={population}&populationGrowthThisYear={populationGrowth}"
-            f"&populationGrowthToday={populationGrowthToday}&currentCo2Emissions={currentCo2Emissions}"
-            f"&fossilEnergyMWh={fossilEnergyMWh}&renewableEnergyMWh={renewableEnergyMWh}")
-        requests.post(url)
-
-        time.sleep(30)
+        values = api.get_values(list(COUNTERS.values()))
+        reading = missing.fill({field: values[counter] for field, counter in COUNTERS.items()})
+
+        if reading is None:
+            print("Skipping a reading, worldometer has had no value for a counter for too long:", values)
+        elif detector.offer(reading):
+            print("Population:", reading["population"], "Population Growth:", reading["populationGrowthThisYear"],
+                  "Current Co2 Emissions:", reading["currentCo2Emissions"])
+            spool.append({"time": datetime.now(timezone.utc).isoformat(), **reading})
+            uploader.notify()
+
+        # sample on a fixed cadence however long scraping took, without trying to catch up once we fell behind
+        nextSample = max(nextSample + SAMPLE_INTERVAL, time.monotonic())
+        time.sleep(nextSample - time.monotonic())
@@ -0,0 +1,2 @@
+# code shared by db-collector and the interface. their images are built from realtimeco2-pi so this folder is copied
+# next to each service's own modules, run a service from its folder with PYTHONPATH=.. to get the same layout
@@ -0,0 +1,72 @@
+# one long lived prisma client per process, with a bounded connection pool and reconnect on failure
+import asyncio
+import os
+from typing import Optional
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from prisma import Prisma
+
+DATABASE_POOL_SIZE = int(os.getenv("DATABASE_POOL_SIZE", 5))
+DATABASE_POOL_TIMEOUT = int(os.getenv("DATABASE_POOL_TIMEOUT", 10))
+DATABASE_HEALTH_INTERVAL = float(os.getenv("DATABASE_HEALTH_INTERVAL", 30))
+
+
+def pooled_url(url: str) -> str:
+    # prisma's query engine takes its pool settings from the connection string
+    parts = urlsplit(url)
+    query = dict(parse_qsl(parts.query))
+    query.setdefault("connection_limit", str(DATABASE_POOL_SIZE))
+    query.setdefault("pool_timeout", str(DATABASE_POOL_TIMEOUT))
+    return urlunsplit(parts._replace(query=urlencode(query)))
+
+
+class Database:
+    def __init__(self):
+        url = os.getenv("DATABASE_URL")
+        self.client = Prisma(datasource={"url": pooled_url(url)}) if url else Prisma()
+        # created on first use so it belongs to the server's event loop, python 3.9 binds it at creation
+        self.lock: Optional[asyncio.Lock] = None
+        self.monitorTask: Optional[asyncio.Task] = None
+        self.reconnects = 0
+
+    async def connect(self):
+        await self.client.connect()
+        self.monitorTask = asyncio.create_task(self.monitor())
+
+    async def disconnect(self):
+        if self.monitorTask is not None:
+            self.monitorTask.cancel()
+        if self.client.is_connected():
+            await self.client.disconnect()
+
+    async def healthy(self) -> bool:
+        try:
+            await self.client.query_raw("SELECT 1")
+            return True
+        except Exception:
+            return False
+
+    async def reconnect(self):
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            # someone else may have already reconnected while we waited for the lock
+            if await self.healthy():
+                return
+            print("Database connection lost, reconnecting...")
+            try:
+                if self.client.is_connected():
+                    await self.client.disconnect()
+            except Exception:
+                pass
+            await self.client.connect()
+            self.reconnects += 1
+
+    async def monitor(self):
+        while True:
+            await asyncio.sleep(DATABASE_HEALTH_INTERVAL)
+            if not await self.healthy():
+                try:
+                    await self.reconnect()
+                except Exception as e:
+                    print("Reconnecting to the database failed:", repr(e))
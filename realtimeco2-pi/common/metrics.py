@@ -0,0 +1,96 @@
+# request timing for GET /metrics and an optional profiler for slow requests, shared by db-collector and the interface
+#
+# with several uvicorn workers point PROMETHEUS_MULTIPROC_DIR at an empty folder they share, a scrape then adds up
+# every worker instead of showing whichever one answered it.
+# PROFILE_SLOW_REQUESTS=<seconds> profiles a sample of requests with pyinstrument (when it's installed) and keeps
+# the ones that took longer as html in PROFILE_FOLDER
+import asyncio
+import os
+import random
+import re
+import time
+from datetime import datetime
+from typing import Callable, Optional
+
+from fastapi import Request
+from fastapi.responses import Response
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest,
+                               multiprocess)
+
+PROFILE_SLOW_REQUESTS = float(os.getenv("PROFILE_SLOW_REQUESTS", 0))
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", 0.1))
+PROFILE_FOLDER = os.getenv("PROFILE_FOLDER", "profiles")
+PROFILES_KEPT = int(os.getenv("PROFILES_KEPT", 50))
+
+# cached responses take well under a millisecond and a slow AI call seconds, the default buckets start at 5ms
+BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5,
+           10, 30, 60)
+
+profilerMissing = False
+
+
+def route_of(request: Request) -> str:
+    # the route template rather than the raw path, so every distinct url doesn't become its own series
+    route = request.scope.get("route")
+    return getattr(route, "path", "unmatched")
+
+
+def start_profiler():
+    global profilerMissing
+    if not PROFILE_SLOW_REQUESTS or profilerMissing or random.random() >= PROFILE_SAMPLE_RATE:
+        return None
+    try:
+        from pyinstrument import Profiler
+    except ImportError:
+        print("pyinstrument is not installed, slow requests won't be profiled")
+        profilerMissing = True
+        return None
+    profiler = Profiler(async_mode="enabled", interval=0.001)
+    profiler.start()
+    return profiler
+
+
+def save_profile(profiler, route: str, seconds: float):
+    html = profiler.output_html()
+    os.makedirs(PROFILE_FOLDER, exist_ok=True)
+    slug = re.sub(r"[^A-Za-z0-9]+", "_", route)
+    name = f"{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}{slug}-{int(seconds * 1000)}ms.html"
+    with open(os.path.join(PROFILE_FOLDER, name), "w") as file:
+        file.write(html)
+    for old in sorted(os.listdir(PROFILE_FOLDER))[:-PROFILES_KEPT]:
+        os.remove(os.path.join(PROFILE_FOLDER, old))
+
+
+def request_instrument(service: str) -> Callable:
+    # the middleware, its series are prefixed with the service so they don't collide on a shared prometheus
+    requestSeconds = Histogram(f"{service}_request_seconds", "Time to answer a request", ["method", "route", "status"],
+                               buckets=BUCKETS)
+    slowRequests = Counter(f"{service}_slow_requests_total", "Profiled requests slower than PROFILE_SLOW_REQUESTS",
+                           ["route"])
+
+    async def instrument(request: Request, call_next):
+        profiler = start_profiler()
+        started = time.perf_counter()
+        status = 500
+        try:
+            response = await call_next(request)
+            status = response.status_code
+            return response
+        finally:
+            seconds = time.perf_counter() - started
+            route = route_of(request)
+            requestSeconds.labels(request.method, route, str(status)).observe(seconds)
+            if profiler is not None:
+                profiler.stop()
+                if seconds >= PROFILE_SLOW_REQUESTS:
+                    slowRequests.labels(route).inc()
+                    await asyncio.to_thread(save_profile, profiler, route, seconds)
+
+    return instrument
+
+
+def render(registry: Optional[CollectorRegistry] = None) -> Response:
+    if registry is None and os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return Response(generate_latest(registry or REGISTRY), media_type=CONTENT_TYPE_LATEST)
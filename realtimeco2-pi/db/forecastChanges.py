@@ -0,0 +1,127 @@
+# the 2030/2050 forecasts barely move between ticks, so a forecast is only written again once one of its values
+# drifted past FORECAST_TOLERANCE. a retrain of a model the table depends on is only a change when it moved a value
+# that far too. until then the row that is already stored is kept and its validUntil moved up to the latest tick,
+# every row covers the ticks from its time up to its validUntil.
+# the held rows live in this process, so the ticks have to go through a single db-collector worker
+import math
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+TABLES = ["energyproductionby", "populationby", "co2emissionsby"]
+# the AI models each table's forecasts are predicted with
+TABLE_MODELS = {
+    "populationby": ["population", "population-increase"],
+    "energyproductionby": ["population", "population-increase", "population_increase_vs_total_fossil_energy",
+                           "population_increase_vs_total_renewable_energy", "population_increase_vs_wind",
+                           "population_increase_vs_hydropower", "population_increase_vs_solar",
+                           "population_increase_vs_other_renewables"],
+    "co2emissionsby": ["population", "population-increase", "population_vs_total_co2",
+                       "population_increase_vs_annual_co2", "annualtemp-annualco2"]
+}
+# rows of the validUntil updates, {"table", "time" and "year" of the held row, "validUntil"}
+VALIDITY = "validity"
+
+
+def table_versions(table: str, versions: Optional[Dict[str, int]]) -> Optional[Dict[str, int]]:
+    return {name: versions.get(name) for name in TABLE_MODELS[table]} if versions is not None else None
+
+
+class HeldForecast:
+    def __init__(self, row: dict, versions: Optional[Dict[str, int]]):
+        self.row = row
+        self.versions = versions
+        self.validUntil: datetime = row["time"]
+
+
+class ForecastTracker:
+    def __init__(self, tolerance: float = 0.0001):
+        self.tolerance = tolerance
+        self.held: Dict[Tuple[str, int], HeldForecast] = {}
+        # the run a backfill older than the held rows is currently extending
+        self.earlier: Dict[Tuple[str, int], HeldForecast] = {}
+        self.written = 0
+        self.extended = 0
+        # retrains of a table's models that didn't move its forecasts
+        self.refitsAbsorbed = 0
+
+    def unchanged(self, held: HeldForecast, row: dict) -> bool:
+        for column, value in row.items():
+            if column in ("time", "validUntil"):
+                continue
+            before = held.row.get(column)
+            if isinstance(value, (int, float)) and isinstance(before, (int, float)):
+                if not math.isclose(value, before, rel_tol=self.tolerance, abs_tol=1e-9):
+                    return False
+            elif value != before:
+                return False
+        return True
+
+    def extends(self, held: HeldForecast, table: str, row: dict, versions: Optional[Dict[str, int]]) -> bool:
+        # the chained endpoints don't report model versions, the values decide either way
+        if not self.unchanged(held, row):
+            return False
+        versions = table_versions(table, versions)
+        if versions is not None:
+            if held.versions is not None and versions != held.versions:
+                self.refitsAbsorbed += 1
+            held.versions = versions
+        return True
+
+    def fold(self, held: Dict[Tuple[str, int], HeldForecast], table: str, row: dict,
+             versions: Optional[Dict[str, int]], kept: List[dict], validity: List[dict]):
+        key = (table, row["year"])
+        current = held.get(key)
+        if current is not None and row["time"] <= current.validUntil:
+            # older than the newest tick seen, like readings the collector spooled while we were away.
+            # covered already when the held row was valid back then, otherwise stored on its own
+            if current.row["time"] <= row["time"] and self.unchanged(current, row):
+                self.extended += 1
+            else:
+                kept.append({**row, "validUntil": row["time"]})
+                self.written += 1
+            return
+        if current is not None and self.extends(current, table, row, versions):
+            current.validUntil = row["time"]
+            validity.append({"table": table, "time": current.row["time"], "year": row["year"],
+                             "validUntil": row["time"]})
+            self.extended += 1
+            return
+        row = {**row, "validUntil": row["time"]}
+        held[key] = HeldForecast(row, table_versions(table, versions))
+        kept.append(row)
+        self.written += 1
+
+    def filter(self, rows: Dict[str, List[dict]], versions: Optional[Dict[str, int]]) -> Dict[str, List[dict]]:
+        # a tick's rows with the unchanged forecasts swapped for validUntil updates of the rows that hold them.
+        # rows from before the held row, a backfill, are folded into runs of their own
+        validity = []
+        for table in TABLES:
+            kept = []
+            for row in rows.get(table, []):
+                current = self.held.get((table, row["year"]))
+                if current is not None and row["time"] < current.row["time"]:
+                    earlier = self.earlier.get((table, row["year"]))
+                    # a backfill reaching back past the run starts a new one
+                    if earlier is not None and row["time"] < earlier.row["time"]:
+                        del self.earlier[(table, row["year"])]
+                    self.fold(self.earlier, table, row, versions, kept, validity)
+                else:
+                    self.fold(self.held, table, row, versions, kept, validity)
+            rows[table] = kept
+        if validity:
+            rows[VALIDITY] = validity
+        return rows
+
+    def forget(self):
+        # after a failed write the held rows may not exist, the next tick writes its forecasts in full
+        self.held.clear()
+        self.earlier.clear()
+
+    def stats(self) -> dict:
+        return {
+            "tolerance": self.tolerance,
+            "held": len(self.held),
+            "written": self.written,
+            "extended": self.extended,
+            "refitsAbsorbed": self.refitsAbsorbed
+        }
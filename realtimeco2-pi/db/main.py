@@ -1,13 +1,74 @@
-from datetime import datetime
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+from urllib.parse import urlsplit
 
-from prisma import Prisma
+import prisma.engine.errors
 from fastapi import FastAPI
-import aiohttp, os
+from fastapi.encoders import jsonable_encoder
+from pydantic import BaseModel
+import aiohttp, os, time
+
+import metrics
+import timescale
+from common.database import Database
+from forecastChanges import ForecastTracker
+from taskGraph import TaskGraph
+from writeBuffer import WriteBehindBuffer, write_rows
 
 AI_URL = os.getenv("AI_URL", "http://127.0.0.1:8000")
+# one /tick request per reading instead of the chain of per-model calls, turn off for an AI service without /tick
+AI_FUSED_TICK = os.getenv("AI_FUSED_TICK", "1") == "1"
+# how many AI calls of a tick may be in flight at once, and how long each one may take
+TICK_CONCURRENCY = int(os.getenv("TICK_CONCURRENCY", 8))
+TICK_CALL_TIMEOUT = float(os.getenv("TICK_CALL_TIMEOUT", 30))
+# an upload is predicted in one call, a big backfill has the AI refit the models over everything it brings
+BULK_CALL_TIMEOUT = float(os.getenv("BULK_CALL_TIMEOUT", 600))
+# keep-alive connections kept open to the AI service
+AI_POOL_SIZE = int(os.getenv("AI_POOL_SIZE", 16))
+AI_KEEPALIVE = float(os.getenv("AI_KEEPALIVE", 75))
+# buffer ticks and bulk insert them together, flushing every WRITE_BEHIND_INTERVAL seconds or WRITE_BEHIND_TICKS ticks
+WRITE_BEHIND = os.getenv("WRITE_BEHIND", "0") == "1"
+WRITE_BEHIND_TICKS = int(os.getenv("WRITE_BEHIND_TICKS", 10))
+WRITE_BEHIND_INTERVAL = float(os.getenv("WRITE_BEHIND_INTERVAL", 60))
+# only write a 2030/2050 forecast again once a value moved by more than FORECAST_TOLERANCE (relative), a retrain
+# included, until then the stored row's validUntil is moved up. FORECAST_CHANGES_ONLY=0 writes every tick
+FORECAST_CHANGES_ONLY = os.getenv("FORECAST_CHANGES_ONLY", "1") == "1"
+FORECAST_TOLERANCE = float(os.getenv("FORECAST_TOLERANCE", 0.0001))
+
+database = Database()
+forecasts = ForecastTracker(FORECAST_TOLERANCE) if FORECAST_CHANGES_ONLY else None
+session: aiohttp.ClientSession
+writeBuffer: Optional[WriteBehindBuffer] = None
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global session, writeBuffer
+    await database.connect()
+    if timescale.TIMESCALE_SETUP:
+        try:
+            await timescale.setup(database.client)
+        except Exception as e:
+            print("Setting up the timescale hypertables failed:", repr(e))
+    session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=AI_POOL_SIZE, keepalive_timeout=AI_KEEPALIVE))
+    if WRITE_BEHIND:
+        writeBuffer = WriteBehindBuffer(database.client, WRITE_BEHIND_TICKS, WRITE_BEHIND_INTERVAL)
+        writeBuffer.start()
+    yield
+    if writeBuffer is not None:
+        await writeBuffer.stop()
+    await session.close()
+    await database.disconnect()
 
-app = FastAPI()
 
+app = FastAPI(lifespan=lifespan)
+app.middleware("http")(metrics.instrument)
+
+URL_TICK = (f"{AI_URL}/tick?population=POPULATION&populationGrowthThisYear=POP_GROWTH_THIS_YEAR&"
+            "populationGrowthToday=POP_GROWTH_TODAY&currentCo2Emissions=CURR_CO2_EMISSIONS&"
+            "fossilEnergyMWh=FOSSIL_ENERGY&renewableEnergyMWh=RENEWABLE_ENERGY")
+URL_TICK_BULK = f"{AI_URL}/tick/bulk"
 URL_POPULATION = f"{AI_URL}/population?population=POPULATION&populationGrowthThisYear=POP_GROWTH_THIS_YEAR"
 URL_ANNUAL_EMISSIONS = (f"{AI_URL}/annualEmissions?currentPopulationGrowth=POP_GROWTH_CURRENT&"
                         "endOfYearPopulationGrowth=POP_GROWTH_END_YEAR&currentCo2Emissions=CURR_CO2_EMISSIONS")
@@ -22,150 +83,323 @@ URL_ENERGY_PRODUCTION = (f"{AI_URL}/energyProductionBy/YEAR?fossilEnergyTWh=FOSS
 YEARS = ["2030", "2050"]
 
 
-@app.post("/")
-async def main(population: int, populationGrowthThisYear: int, populationGrowthToday: int, currentCo2Emissions: float,
-               fossilEnergyMWh: float, renewableEnergyMWh: float):
+async def fetch(session: aiohttp.ClientSession, method: str, url: str, body=None,
+                timeout: Optional[float] = None) -> dict:
+    # timed by endpoint, populationBy rather than populationBy/2030 but tick/bulk apart from tick
+    call = "/".join(part for part in urlsplit(url).path.split("/")[1:] if not part.lstrip("-")[:1].isdigit())
+    started = time.perf_counter()
+    outcome = "error"
+    options = {"timeout": aiohttp.ClientTimeout(total=timeout)} if timeout else {}
+    try:
+        async with session.request(method, url, json=body, **options) as response:
+            result = await response.json()
+            outcome = str(response.status)
+            return result
+    finally:
+        metrics.AI_CALL_SECONDS.labels(call, outcome).observe(time.perf_counter() - started)
+
+
+async def resolved(value):
+    return value
+
+
+# what a tick is predicted into, by the chained calls or taken apart from a /tick result
+PREDICTIONS = ["population", "annualEmissions", "totalEmissions", "modelVersions"] + [
+    f"{part}{year}" for year in YEARS for part in ("energy", "populationBy", "co2EmissionsBy")]
+
+
+def tick_predictions(tick: dict) -> dict:
+    predictions = {
+        "population": tick["population"],
+        "annualEmissions": tick["annualEmissions"],
+        "totalEmissions": tick["totalEmissions"],
+        "modelVersions": tick.get("modelVersions")
+    }
+    for i, year in enumerate(YEARS):
+        predictions[f"energy{year}"] = {
+            **tick["forecasts"][i]["energyProduction"],
+            "totalFossilEnergyAccuracy": tick["totalFossilEnergyAccuracy"],
+            "totalRenewableEnergyAccuracy": tick["totalRenewableEnergyAccuracy"]
+        }
+        predictions[f"populationBy{year}"] = tick["forecasts"][i]["populationBy"]
+        predictions[f"co2EmissionsBy{year}"] = tick["forecasts"][i]["co2EmissionsBy"]
+    return predictions
+
+
+def add_fused_predictions(graph: TaskGraph, session: aiohttp.ClientSession, population: int,
+                          populationGrowthThisYear: int, populationGrowthToday: int, currentCo2Emissions: float,
+                          fossilEnergyMWh: float, renewableEnergyMWh: float):
+    url = URL_TICK.replace("POPULATION", str(population)).replace(
+        "POP_GROWTH_THIS_YEAR", str(populationGrowthThisYear)).replace(
+        "POP_GROWTH_TODAY", str(populationGrowthToday)).replace(
+        "CURR_CO2_EMISSIONS", str(currentCo2Emissions)).replace(
+        "FOSSIL_ENERGY", str(fossilEnergyMWh)).replace(
+        "RENEWABLE_ENERGY", str(renewableEnergyMWh))
+    url += "".join(f"&years={year}" for year in YEARS)
+
+    graph.add("tick", lambda url=url: fetch(session, "POST", url))
+    for name in PREDICTIONS:
+        graph.add(name, lambda tick, name=name: resolved(tick_predictions(tick)[name]), "tick")
+
+
+def add_chained_predictions(graph: TaskGraph, session: aiohttp.ClientSession, population: int,
+                            populationGrowthThisYear: int, populationGrowthToday: int, currentCo2Emissions: float,
+                            fossilEnergyMWh: float, renewableEnergyMWh: float):
+    # the same results as /tick, assembled from the individual endpoints
     fossilEnergyTWh = fossilEnergyMWh / 1000000
     renewableEnergyTWh = renewableEnergyMWh / 1000000
 
-    db = Prisma()
-    await db.connect()
-
-    accuracy = [0, 0, 0, 0, 0, 0]
-    async with aiohttp.ClientSession() as session:
-        url = URL_POPULATION.replace("POPULATION", str(population)).replace("POP_GROWTH_THIS_YEAR",
-                                                                            str(populationGrowthThisYear))
-        async with session.post(url) as response:
-            prediction_population = await response.json()
-
-            await db.population.create(
-                {
-                    "population": population,
-                    "populationGrowthThisYear": populationGrowthThisYear,
-                    "populationPredicted": prediction_population["populationPredicted"],
-                    "populationGrowthThisYearPredicted": prediction_population["populationGrowthThisYearPredicted"],
-                    "endOfYearPopulationPredicted": prediction_population["endOfYearPopulationPredicted"],
-                    "endOfYearPopulationGrowthPredicted": prediction_population["endOfYearPopulationGrowthPredicted"],
-                }
-            )
-            accuracy[0] = prediction_population["populationAccuracy"]
-            accuracy[1] = prediction_population["growthAccuracy"]
+    url = URL_POPULATION.replace("POPULATION", str(population)).replace("POP_GROWTH_THIS_YEAR",
+                                                                        str(populationGrowthThisYear))
+    graph.add("population", lambda url=url: fetch(session, "POST", url))
 
+    def annual_emissions(prediction_population):
         url = URL_ANNUAL_EMISSIONS.replace("POP_GROWTH_CURRENT", str(populationGrowthThisYear)).replace(
             "POP_GROWTH_END_YEAR", str(prediction_population["endOfYearPopulationGrowthPredicted"])).replace(
             "CURR_CO2_EMISSIONS", str(currentCo2Emissions)
         )
-        async with session.post(url) as response:
-            prediction_annualemissions = await response.json()
-
-            await db.annualco2emissions.create(
-                {
-                    "Population": {
-                        "connect": {"populationGrowthThisYear": populationGrowthThisYear}
-                    },
-                    "currentCo2Emissions": prediction_annualemissions["currentEmissions"],
-                    "currentCo2EmissionsPredicted": prediction_annualemissions["currentEmissionsPredicted"],
-                    "annualCo2EmissionsPredicted": prediction_annualemissions["endOfYearEmissionsPredicted"]
-                }
-            )
-            accuracy[2] = prediction_annualemissions["accuracy"]
-
-        url = URL_TOTAL_EMISSIONS.replace("POPULATION", str(population)).replace("END_POP",
-                                                                                 str(prediction_population[
-                                                                                         "endOfYearPopulationPredicted"]))
-        async with session.post(url) as response:
-            prediction_totalemissions = await response.json()
-
-            await db.totalco2emissions.create(
-                {
-                    "Population": {
-                        "connect": {"population": population}
-                    },
-                    "totalCo2EmissionsPredicted": prediction_totalemissions["totalCo2EmissionsPredicted"],
-                    "endOfYearTotalCo2EmissionsPredicted": prediction_totalemissions[
-                        "endOfYearTotalCo2EmissionsPredicted"]
-                }
-            )
-            accuracy[3] = prediction_totalemissions["accuracy"]
-
-        for year in YEARS:
-            url = URL_ENERGY_PRODUCTION.replace("YEAR", year).replace("FOSSIL_ENERGY", str(fossilEnergyTWh)).replace(
-                "RENEWABLE_ENERGY", str(renewableEnergyTWh)).replace("POP_GROWTH_TODAY",
-                                                                     str(populationGrowthToday))
-            async with session.get(url) as response:
-                prediction_energy = await response.json()
-
-                await db.energyproductionby.create(
-                    {
-                        "year": int(year),
-                        "totalFossilFuelProduction": prediction_energy["totalFossilEnergyPredicted"],
-                        "totalRenewableProduction": prediction_energy["totalRenewableEnergyPredicted"],
-                        "hydropowerProduction": prediction_energy["hydroEnergyPredicted"],
-                        "windPowerProduction": prediction_energy["windEnergyPredicted"],
-                        "solarPowerProduction": prediction_energy["solarEnergyPredicted"],
-                        "otherRenewablePowerProduction": prediction_energy["otherRenewablesEnergyPredicted"],
-                    }
-                )
-
-                accuracy[4] = prediction_energy["totalFossilEnergyAccuracy"]
-                accuracy[5] = prediction_energy["totalRenewableEnergyAccuracy"]
-
-            url = URL_PREDICT_POPULATION.replace("YEAR", year).replace("POPULATION", str(population))
-            async with session.get(url) as response:
-                prediction_population = await response.json()
-
-                await db.populationby.create(
-                    {
-                        "year": int(year),
-                        "populationPredicted": prediction_population["populationPredicted"],
-                        "populationGrowthPredicted": prediction_population["populationGrowthPredicted"],
-                        "populationGrowthCalculated": prediction_population["populationGrowthCalculated"],
-                        "populationGrowthPredictedFromNow": prediction_population["populationGrowthPredictedFromNow"],
-                        "populationGrowthCalculatedFromNow": prediction_population["populationGrowthCalculatedFromNow"],
-                        "populationGrowthPercent": prediction_population["populationGrowthPercent"],
-                        "calculatedPopulationGrowthPercent": prediction_population["calculatedPopulationGrowthPercent"]
-                    }
-                )
+        return fetch(session, "POST", url)
+
+    def total_emissions(prediction_population):
+        url = URL_TOTAL_EMISSIONS.replace("POPULATION", str(population)).replace(
+            "END_POP", str(prediction_population["endOfYearPopulationPredicted"]))
+        return fetch(session, "POST", url)
+
+    graph.add("annualEmissions", annual_emissions, "population")
+    graph.add("totalEmissions", total_emissions, "population")
+    # the single endpoints don't say which model version answered
+    graph.add("modelVersions", lambda: resolved(None))
+
+    for year in YEARS:
+        url = URL_ENERGY_PRODUCTION.replace("YEAR", year).replace("FOSSIL_ENERGY", str(fossilEnergyTWh)).replace(
+            "RENEWABLE_ENERGY", str(renewableEnergyTWh)).replace("POP_GROWTH_TODAY",
+                                                                 str(populationGrowthToday))
+        graph.add(f"energy{year}", lambda url=url: fetch(session, "GET", url))
+
+        url = URL_PREDICT_POPULATION.replace("YEAR", year).replace("POPULATION", str(population))
+        graph.add(f"populationBy{year}", lambda url=url: fetch(session, "GET", url))
 
+        def total_emissions_future(prediction_totalemissions, year=year):
             url = URL_PREDICT_TOTAL_EMISSIONS.replace("YEAR", str(year)).replace("NOW_CO2_EMISSIONS", str(
                 prediction_totalemissions["totalCo2EmissionsPredicted"]))
+            return fetch(session, "GET", url)
 
-            async with session.get(url) as response:
-                prediction_totalemission_future = await response.json()
+        def annual_emissions_future(prediction_population_future):
+            url = URL_PREDICT_ANNUAL_EMISSIONS.replace("POP_GROWTH", str(
+                prediction_population_future["populationGrowthCalculated"]))
+            return fetch(session, "GET", url)
 
-            url_annual_emissions = URL_PREDICT_ANNUAL_EMISSIONS.replace("YEAR", str(year)).replace("POP_GROWTH",
-                                                                                                   str(
-                                                                                                       prediction_population[
-                                                                                                           "populationGrowthCalculated"]))
+        def temp_anomaly(prediction_annualemission_future):
+            url = URL_PREDICT_TEMP_ANOMALY.replace("ANNUAL_EMISSIONS", str(
+                prediction_annualemission_future["emissionsPredicted"]))
+            return fetch(session, "GET", url)
 
-            async with session.get(url_annual_emissions) as response:
-                prediction_annualemission_future = await response.json()
+        graph.add(f"totalCo2EmissionsBy{year}", total_emissions_future, "totalEmissions")
+        graph.add(f"annualEmissionsBy{year}", annual_emissions_future, f"populationBy{year}")
+        graph.add(f"tempAnomaly{year}", temp_anomaly, f"annualEmissionsBy{year}")
+        graph.add(f"co2EmissionsBy{year}", lambda total, annual, temp: resolved({
+            "totalCo2EmissionsPredicted": total["totalCo2EmissionsPredicted"],
+            "annualCo2EmissionsPredicted": annual["emissionsPredicted"],
+            "tempAnomalyPredicted": temp["annualTempAnomalyPredicted"]
+        }), f"totalCo2EmissionsBy{year}", f"annualEmissionsBy{year}", f"tempAnomaly{year}")
 
-            url_temp_anomaly = URL_PREDICT_TEMP_ANOMALY.replace("ANNUAL_EMISSIONS", str(
-                prediction_annualemission_future["emissionsPredicted"]))
 
-            async with session.get(url_temp_anomaly) as response:
-                prediction_temp_anomaly = await response.json()
-
-            await db.co2emissionsby.create(
-                {
-                    "year": int(year),
-                    "totalCo2EmissionsPredicted": prediction_totalemission_future["totalCo2EmissionsPredicted"],
-                    "annualCo2EmissionsPredicted": prediction_annualemission_future["emissionsPredicted"],
-                    "tempAnomalyPredicted": prediction_temp_anomaly["annualTempAnomalyPredicted"]
-                }
-            )
-
-        await db.predictorstats.create(
-            {
-                "populationPrecision": accuracy[0],
-                "populationGrowthPrecision": accuracy[1],
-                "annualCo2EmissionsPrecision": accuracy[2],
-                "totalCo2EmissionsPrecision": accuracy[3],
-                "totalFossilEnergyAccuracy": accuracy[4],
-                "totalRenewableEnergyAccuracy": accuracy[5]
-            }
-        )
+def tick_rows(predictions: dict, tickTime: datetime, population: int, populationGrowthThisYear: int) -> dict:
+    prediction_population = predictions["population"]
+    prediction_annualemissions = predictions["annualEmissions"]
+    prediction_totalemissions = predictions["totalEmissions"]
+    prediction_energy = predictions[f"energy{YEARS[-1]}"]
+
+    rows = {
+        "population": [{
+            "time": tickTime,
+            "population": population,
+            "populationGrowthThisYear": populationGrowthThisYear,
+            "populationPredicted": prediction_population["populationPredicted"],
+            "populationGrowthThisYearPredicted": prediction_population["populationGrowthThisYearPredicted"],
+            "endOfYearPopulationPredicted": prediction_population["endOfYearPopulationPredicted"],
+            "endOfYearPopulationGrowthPredicted": prediction_population["endOfYearPopulationGrowthPredicted"],
+        }],
+        "annualco2emissions": [{
+            "time": tickTime,
+            "populationGrowthThisYear": populationGrowthThisYear,
+            "currentCo2Emissions": prediction_annualemissions["currentEmissions"],
+            "currentCo2EmissionsPredicted": prediction_annualemissions["currentEmissionsPredicted"],
+            "annualCo2EmissionsPredicted": prediction_annualemissions["endOfYearEmissionsPredicted"]
+        }],
+        "totalco2emissions": [{
+            "time": tickTime,
+            "population": population,
+            "totalCo2EmissionsPredicted": prediction_totalemissions["totalCo2EmissionsPredicted"],
+            "endOfYearTotalCo2EmissionsPredicted": prediction_totalemissions["endOfYearTotalCo2EmissionsPredicted"]
+        }],
+        "energyproductionby": [],
+        "populationby": [],
+        "co2emissionsby": [],
+        "predictorstats": [{
+            "time": tickTime,
+            "populationPrecision": prediction_population["populationAccuracy"],
+            "populationGrowthPrecision": prediction_population["growthAccuracy"],
+            "annualCo2EmissionsPrecision": prediction_annualemissions["accuracy"],
+            "totalCo2EmissionsPrecision": prediction_totalemissions["accuracy"],
+            "totalFossilEnergyAccuracy": prediction_energy["totalFossilEnergyAccuracy"],
+            "totalRenewableEnergyAccuracy": prediction_energy["totalRenewableEnergyAccuracy"]
+        }]
+    }
+
+    for year in YEARS:
+        prediction_energy = predictions[f"energy{year}"]
+        prediction_population = predictions[f"populationBy{year}"]
+
+        rows["energyproductionby"].append({
+            "time": tickTime,
+            "year": int(year),
+            "totalFossilFuelProduction": prediction_energy["totalFossilEnergyPredicted"],
+            "totalRenewableProduction": prediction_energy["totalRenewableEnergyPredicted"],
+            "hydropowerProduction": prediction_energy["hydroEnergyPredicted"],
+            "windPowerProduction": prediction_energy["windEnergyPredicted"],
+            "solarPowerProduction": prediction_energy["solarEnergyPredicted"],
+            "otherRenewablePowerProduction": prediction_energy["otherRenewablesEnergyPredicted"],
+        })
+        rows["populationby"].append({
+            "time": tickTime,
+            "year": int(year),
+            "populationPredicted": prediction_population["populationPredicted"],
+            "populationGrowthPredicted": prediction_population["populationGrowthPredicted"],
+            "populationGrowthCalculated": prediction_population["populationGrowthCalculated"],
+            "populationGrowthPredictedFromNow": prediction_population["populationGrowthPredictedFromNow"],
+            "populationGrowthCalculatedFromNow": prediction_population["populationGrowthCalculatedFromNow"],
+            "populationGrowthPercent": prediction_population["populationGrowthPercent"],
+            "calculatedPopulationGrowthPercent": prediction_population["calculatedPopulationGrowthPercent"]
+        })
+        rows["co2emissionsby"].append({
+            "time": tickTime,
+            "year": int(year),
+            **predictions[f"co2EmissionsBy{year}"]
+        })
+
+    return rows
+
+
+async def predict_rows(tickTime: datetime, population: int, populationGrowthThisYear: int, populationGrowthToday: int,
+                       currentCo2Emissions: float, fossilEnergyMWh: float, renewableEnergyMWh: float):
+    # independent prediction branches run concurrently
+    graph = TaskGraph(TICK_CONCURRENCY, TICK_CALL_TIMEOUT)
+    (add_fused_predictions if AI_FUSED_TICK else add_chained_predictions)(
+        graph, session, population, populationGrowthThisYear, populationGrowthToday, currentCo2Emissions,
+        fossilEnergyMWh, renewableEnergyMWh)
+    with metrics.TICK_SECONDS.labels("predict").time():
+        predictions = await graph.run()
+    rows = tick_rows(predictions, tickTime, population, populationGrowthThisYear)
+    return forecasts.filter(rows, predictions["modelVersions"]) if forecasts is not None else rows
+
+
+async def store_rows(rows):
+    # all of a tick's rows go in one transaction, or into the write-behind buffer when it's enabled
+    if writeBuffer is not None:
+        writeBuffer.enqueue(rows)
+        return {"status": "queued", "queueDepth": len(writeBuffer.queue)}
+
+    try:
+        with metrics.TICK_SECONDS.labels("store").time():
+            await write_rows(database.client, rows)
+    except BaseException as e:
+        if forecasts is not None:
+            forecasts.forget()
+        if isinstance(e, prisma.engine.errors.EngineConnectionError):
+            await database.reconnect()
+        raise
 
-    await db.disconnect()
     return {"status": "ok"}
+
+
+@app.post("/")
+async def main(population: int, populationGrowthThisYear: int, populationGrowthToday: int, currentCo2Emissions: float,
+               fossilEnergyMWh: float, renewableEnergyMWh: float):
+    rows = await predict_rows(datetime.now(timezone.utc), population, populationGrowthThisYear, populationGrowthToday,
+                              currentCo2Emissions, fossilEnergyMWh, renewableEnergyMWh)
+    return await store_rows(rows)
+
+
+class Reading(BaseModel):
+    time: datetime
+    population: int
+    populationGrowthThisYear: int
+    populationGrowthToday: int
+    currentCo2Emissions: float
+    fossilEnergyMWh: float
+    renewableEnergyMWh: float
+
+
+def utc_time(reading: Reading) -> datetime:
+    return reading.time if reading.time.tzinfo else reading.time.replace(tzinfo=timezone.utc)
+
+
+async def predict_bulk_rows(readings: List[Reading]) -> Dict[str, List[dict]]:
+    # one /tick/bulk call predicts them all, the AI appends every sample at once
+    body = {"readings": jsonable_encoder(readings), "years": [int(year) for year in YEARS]}
+    with metrics.TICK_SECONDS.labels("predict").time():
+        result = await fetch(session, "POST", URL_TICK_BULK, body, BULK_CALL_TIMEOUT)
+
+    # folded into the forecasts held from earlier uploads, an unchanged forecast only moves a stored validUntil
+    merged: Dict[str, List[dict]] = {}
+    for reading, tick in zip(readings, result["ticks"]):
+        rows = tick_rows(tick_predictions(tick), utc_time(reading), reading.population,
+                         reading.populationGrowthThisYear)
+        if forecasts is not None:
+            rows = forecasts.filter(rows, result["modelVersions"])
+        for table, tableRows in rows.items():
+            merged.setdefault(table, []).extend(tableRows)
+    return merged
+
+
+@app.post("/bulk")
+async def bulk(readings: List[Reading]):
+    # readings spooled by the collector or replayed from a file, stored under the time they were sampled rather
+    # than when they arrived, all of them written together in one transaction
+    readings = sorted(readings, key=utc_time)
+    if not readings:
+        return {"status": "ok", "accepted": 0}
+
+    if AI_FUSED_TICK:
+        merged = await predict_bulk_rows(readings)
+    else:
+        # the chained calls have no bulk version, every reading is predicted in order and the AI learns from each
+        merged = {}
+        for reading in readings:
+            rows = await predict_rows(utc_time(reading), reading.population, reading.populationGrowthThisYear,
+                                      reading.populationGrowthToday, reading.currentCo2Emissions,
+                                      reading.fossilEnergyMWh, reading.renewableEnergyMWh)
+            for table, tableRows in rows.items():
+                merged.setdefault(table, []).extend(tableRows)
+
+    result = await store_rows(merged)
+    # rollups that were already materialized over the backfilled range don't see the new rows on their own
+    if timescale.TIMESCALE_SETUP and result["status"] == "ok":
+        try:
+            await timescale.refresh(database.client, utc_time(readings[0]), utc_time(readings[-1]))
+        except Exception as e:
+            print("Refreshing the rollups after a backfill failed:", repr(e))
+    return {**result, "accepted": len(readings)}
+
+
+@app.get("/health")
+async def health():
+    return {"database": await database.healthy(), "reconnects": database.reconnects}
+
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    metrics.QUEUED_TICKS.set(len(writeBuffer.queue) if writeBuffer is not None else 0)
+    metrics.RECONNECTS.set(database.reconnects)
+    return metrics.render()
+
+
+@app.get("/forecasts")
+async def forecast_stats():
+    return forecasts.stats() if forecasts is not None else {"enabled": False}
+
+
+@app.get("/buffer")
+async def buffer_stats():
+    return writeBuffer.stats() if writeBuffer is not None else {"enabled": False}
@@ -0,0 +1,21 @@
+# db-collector's prometheus metrics for GET /metrics, request timing and the slow request profiler are in
+# common/metrics.py
+from prometheus_client import Counter, Gauge, Histogram
+
+from common.metrics import BUCKETS, render, request_instrument
+
+instrument = request_instrument("dbcollector")
+
+TICK_SECONDS = Histogram("dbcollector_tick_seconds", "Time a reading spent in each stage of a tick", ["stage"],
+                         buckets=BUCKETS)
+AI_CALL_SECONDS = Histogram("dbcollector_ai_call_seconds", "Round trip of a call to the AI service",
+                            ["call", "outcome"], buckets=BUCKETS)
+WRITE_SECONDS = Histogram("dbcollector_database_write_seconds", "Time to commit a batch of rows", ["outcome"],
+                          buckets=BUCKETS)
+ROWS_WRITTEN = Counter("dbcollector_rows_written_total", "Rows sent to the database", ["table"])
+ROWS_EXTENDED = Counter("dbcollector_rows_extended_total", "Held forecast rows whose validUntil was moved up",
+                        ["table"])
+QUEUED_TICKS = Gauge("dbcollector_write_behind_ticks", "Ticks waiting in the write-behind buffer",
+                     multiprocess_mode="livesum")
+RECONNECTS = Gauge("dbcollector_database_reconnects", "Times the database connection was reopened",
+                   multiprocess_mode="livesum")
@@ -0,0 +1,42 @@
+# run a tick's AI calls and database writes as a dependency graph, independent branches run concurrently
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, List, Tuple
+
+
+class TaskGraph:
+    def __init__(self, concurrency: int = 8, timeout: float = 30):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.timeout = timeout
+        self.nodes: Dict[str, Tuple[Callable[..., Awaitable[Any]], List[str]]] = {}
+
+    def add(self, name: str, function: Callable[..., Awaitable[Any]], *dependencies: str):
+        # function is called with the results of its dependencies, in order
+        self.nodes[name] = (function, list(dependencies))
+
+    async def execute(self, name: str, tasks: Dict[str, "asyncio.Task"]) -> Any:
+        function, dependencies = self.nodes[name]
+        arguments = [await tasks[dependency] for dependency in dependencies]
+        async with self.semaphore:
+            try:
+                return await asyncio.wait_for(function(*arguments), self.timeout)
+            except asyncio.TimeoutError:
+                raise TimeoutError(f"{name} took longer than {self.timeout}s")
+
+    async def run(self) -> Dict[str, Any]:
+        for name, (_, dependencies) in self.nodes.items():
+            for dependency in dependencies:
+                if dependency not in self.nodes:
+                    raise KeyError(f"{name} depends on unknown task {dependency}")
+
+        tasks: Dict[str, asyncio.Task] = {}
+        for name in self.nodes:
+            tasks[name] = asyncio.ensure_future(self.execute(name, tasks))
+
+        try:
+            results = await asyncio.gather(*tasks.values())
+        except BaseException:
+            for task in tasks.values():
+                task.cancel()
+            await asyncio.gather(*tasks.values(), return_exceptions=True)
+            raise
+        return dict(zip(tasks, results))
@@ -0,0 +1,224 @@
+# turn the tick tables into timescale hypertables: chunks sized to the tick rate, old chunks compressed, optional
+# retention and continuous aggregate rollups the interface reads long ranges from.
+# every statement is idempotent and the policies are replaced with the current settings, so this runs on every
+# db-collector start (TIMESCALE_SETUP=1) or by hand with `python timescale.py`. `python timescale.py --refresh`
+# rebuilds the rollups over everything, db-collector's /bulk refreshes the range it backfilled by itself.
+# durations are written like the interface's buckets: 30s, 15m, 1h, 7d
+import asyncio
+import os
+import re
+import sys
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional
+
+from prisma import Prisma
+
+TIMESCALE_SETUP = os.getenv("TIMESCALE_SETUP", "0") == "1"
+# a chunk holds TIMESCALE_CHUNK_TICKS ticks, a week of 30 second ticks by default
+TIMESCALE_TICK_SECONDS = float(os.getenv("TIMESCALE_TICK_SECONDS", 30))
+TIMESCALE_CHUNK_TICKS = int(os.getenv("TIMESCALE_CHUNK_TICKS", 20160))
+# empty turns the policy off
+TIMESCALE_COMPRESS_AFTER = os.getenv("TIMESCALE_COMPRESS_AFTER", "7d")
+TIMESCALE_RETENTION = os.getenv("TIMESCALE_RETENTION", "")
+TIMESCALE_ROLLUPS = os.getenv("TIMESCALE_ROLLUPS", "1h,1d")
+TIMESCALE_ROLLUP_RETENTION = os.getenv("TIMESCALE_ROLLUP_RETENTION", "")
+
+# table -> columns compressed chunks are segmented (and rollups grouped) by
+HYPERTABLES: Dict[str, List[str]] = {
+    "Population": [],
+    "AnnualCo2Emissions": [],
+    "TotalCo2Emissions": [],
+    "PredictorStats": [],
+    "PopulationBy": ["year"],
+    "Co2EmissionsBy": ["year"],
+    "EnergyProductionBy": ["year"]
+}
+
+UNITS = {"s": 1, "m": 60, "h": 60 * 60, "d": 24 * 60 * 60, "w": 7 * 24 * 60 * 60}
+NUMERIC = "'bigint', 'integer', 'double precision', 'real', 'numeric'"
+
+# a database created from the schema before the tables were hypertables: timescale wants time in every unique key,
+# and the foreign keys between the tables have to go
+KEYS = [
+    'ALTER TABLE "AnnualCo2Emissions" DROP CONSTRAINT IF EXISTS "AnnualCo2Emissions_populationGrowthThisYear_fkey"',
+    'ALTER TABLE "TotalCo2Emissions" DROP CONSTRAINT IF EXISTS "TotalCo2Emissions_population_fkey"',
+    'DROP INDEX IF EXISTS "AnnualCo2Emissions_populationGrowthThisYear_key"',
+    'DROP INDEX IF EXISTS "TotalCo2Emissions_population_key"',
+    'DROP INDEX IF EXISTS "Population_populationGrowthThisYear_key"',
+    'CREATE UNIQUE INDEX IF NOT EXISTS "Population_time_populationGrowthThisYear_key" '
+    'ON "Population" ("time", "populationGrowthThisYear")'
+]
+PRIMARY_KEYS = {
+    "Population": ["time", "population"],
+    "PopulationBy": ["time", "year"],
+    "Co2EmissionsBy": ["time", "year"],
+    "EnergyProductionBy": ["time", "year"]
+}
+
+
+def naive_utc(value: datetime) -> datetime:
+    # prisma's DateTime columns are timestamps without a time zone, in utc
+    return value.astimezone(timezone.utc).replace(tzinfo=None) if value.tzinfo else value
+
+
+def duration(setting: str) -> Optional[int]:
+    setting = setting.strip()
+    if not setting:
+        return None
+    match = re.fullmatch(r"(\d+)([smhdw])", setting)
+    if match is None or int(match.group(1)) == 0:
+        raise ValueError(f"Invalid duration {setting}, expected something like 30s, 15m, 1h or 7d")
+    return int(match.group(1)) * UNITS[match.group(2)]
+
+
+def interval(seconds: float) -> str:
+    return f"INTERVAL '{int(seconds)} seconds'"
+
+
+def quoted(columns: List[str]) -> str:
+    return ", ".join(f'"{column}"' for column in columns)
+
+
+def rollup_buckets() -> List[str]:
+    buckets = [bucket.strip() for bucket in TIMESCALE_ROLLUPS.split(",") if bucket.strip()]
+    for bucket in buckets:
+        duration(bucket)
+    return buckets
+
+
+def primary_key(table: str, columns: List[str]) -> str:
+    # replaced only while the key still has the old columns, rebuilding it on a big table isn't free
+    return f'''DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_constraint
+                   WHERE conname = '{table}_pkey' AND array_length(conkey, 1) = {len(columns)}) THEN
+        ALTER TABLE "{table}" DROP CONSTRAINT IF EXISTS "{table}_pkey";
+        ALTER TABLE "{table}" ADD CONSTRAINT "{table}_pkey" PRIMARY KEY ({quoted(columns)});
+    END IF;
+END $$'''
+
+
+def hypertable(table: str, segmentBy: List[str]) -> List[str]:
+    chunk = interval(TIMESCALE_TICK_SECONDS * TIMESCALE_CHUNK_TICKS)
+    # the primary keys start with time already, timescale's own time index would only duplicate them
+    statements = [
+        f"SELECT create_hypertable('\"{table}\"', 'time', chunk_time_interval => {chunk}, if_not_exists => TRUE, "
+        f"migrate_data => TRUE, create_default_indexes => FALSE)",
+        # only chunks created from now on get the new size
+        f"SELECT set_chunk_time_interval('\"{table}\"', {chunk})"
+    ]
+
+    settings = "timescaledb.compress, timescaledb.compress_orderby = '\"time\" DESC'"
+    if segmentBy:
+        settings += f", timescaledb.compress_segmentby = '{quoted(segmentBy)}'"
+    # compression settings can't be changed once chunks are compressed
+    statements.append(f'''DO $$
+BEGIN
+    IF NOT (SELECT compression_enabled FROM timescaledb_information.hypertables
+            WHERE hypertable_name = '{table}') THEN
+        ALTER TABLE "{table}" SET ({settings});
+    END IF;
+END $$''')
+    statements.append(f"SELECT remove_compression_policy('\"{table}\"', if_exists => TRUE)")
+    compressAfter = duration(TIMESCALE_COMPRESS_AFTER)
+    if compressAfter:
+        statements.append(f"SELECT add_compression_policy('\"{table}\"', {interval(compressAfter)})")
+
+    statements.append(f"SELECT remove_retention_policy('\"{table}\"', if_exists => TRUE)")
+    retention = duration(TIMESCALE_RETENTION)
+    if retention:
+        statements.append(f"SELECT add_retention_policy('\"{table}\"', {interval(retention)})")
+    return statements
+
+
+def rollup_name(table: str, bucket: str) -> str:
+    # the interface finds the rollups by this name
+    return f"{table}_{bucket}"
+
+
+def rollup(table: str, groups: List[str], columns: List[str], bucket: str) -> List[str]:
+    # avg, min, max and last of every column per bucket, with the number of rows so averages can be combined.
+    # a view keeps the columns it was created with, drop it to pick up new ones
+    seconds = duration(bucket)
+    view = rollup_name(table, bucket)
+    bucketed = f'time_bucket({interval(seconds)}, "time")'
+    selected = [f'{bucketed} AS "time"'] + [f'"{group}"' for group in groups] + ['count(*) AS "samples"']
+    for column in columns:
+        selected += [f'avg("{column}")::float8 AS "{column}_avg"', f'min("{column}") AS "{column}_min"',
+                     f'max("{column}") AS "{column}_max"', f'last("{column}", "time") AS "{column}_last"']
+    grouped = ", ".join([bucketed] + [f'"{group}"' for group in groups])
+
+    statements = [
+        # created empty, the refresh policy fills it in the background and recent rows are read from the table
+        f'CREATE MATERIALIZED VIEW IF NOT EXISTS "{view}" '
+        f'WITH (timescaledb.continuous, timescaledb.materialized_only = false) AS '
+        f'SELECT {", ".join(selected)} FROM "{table}" GROUP BY {grouped} WITH NO DATA',
+        f"SELECT remove_continuous_aggregate_policy('\"{view}\"', if_exists => TRUE)",
+        f"SELECT add_continuous_aggregate_policy('\"{view}\"', start_offset => {interval(seconds * 3)}, "
+        f"end_offset => {interval(seconds)}, schedule_interval => {interval(seconds)})",
+        f"SELECT remove_retention_policy('\"{view}\"', if_exists => TRUE)"
+    ]
+    retention = duration(TIMESCALE_ROLLUP_RETENTION)
+    if retention:
+        statements.append(f"SELECT add_retention_policy('\"{view}\"', {interval(retention)})")
+    return statements
+
+
+async def numeric_columns(db: Prisma, table: str, groups: List[str]) -> List[str]:
+    found = await db.query_raw(
+        "SELECT column_name FROM information_schema.columns WHERE table_schema = current_schema() "
+        f"AND table_name = $1 AND data_type IN ({NUMERIC}) ORDER BY ordinal_position", table)
+    return [row["column_name"] for row in found if row["column_name"] not in groups]
+
+
+async def setup(db: Prisma):
+    buckets = rollup_buckets()
+    statements = ["CREATE EXTENSION IF NOT EXISTS timescaledb"] + KEYS
+    statements += [primary_key(table, columns) for table, columns in PRIMARY_KEYS.items()]
+    for table, segmentBy in HYPERTABLES.items():
+        statements += hypertable(table, segmentBy)
+    for statement in statements:
+        await db.execute_raw(statement)
+
+    for table, groups in HYPERTABLES.items():
+        columns = await numeric_columns(db, table, groups)
+        for bucket in buckets:
+            for statement in rollup(table, groups, columns, bucket):
+                await db.execute_raw(statement)
+
+
+async def refresh(db: Prisma, start: Optional[datetime] = None, end: Optional[datetime] = None):
+    # only buckets entirely inside the window are refreshed, so it's widened by a bucket on both sides.
+    # continuous aggregates can't be refreshed inside a transaction, each call runs on its own
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    for table in HYPERTABLES:
+        for bucket in rollup_buckets():
+            view = rollup_name(table, bucket)
+            if start is None or end is None:
+                print("Refreshing", view)
+                await db.execute_raw(f"CALL refresh_continuous_aggregate('\"{view}\"', NULL, NULL)")
+                continue
+            widen = timedelta(seconds=duration(bucket))
+            # recent rows are still inside the window the refresh policy goes over next
+            if naive_utc(start) >= now - 2 * widen:
+                continue
+            await db.execute_raw(f"CALL refresh_continuous_aggregate('\"{view}\"', $1::timestamp, $2::timestamp)",
+                                 naive_utc(start) - widen, naive_utc(end) + widen)
+
+
+async def main(arguments: List[str]):
+    from common.database import Database
+
+    database = Database()
+    await database.client.connect()
+    try:
+        await setup(database.client)
+        if "--refresh" in arguments:
+            await refresh(database.client)
+    finally:
+        await database.client.disconnect()
+    print("Timescale setup done")
+
+
+if __name__ == "__main__":
+    asyncio.run(main(sys.argv[1:]))
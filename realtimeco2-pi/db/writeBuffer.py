@@ -0,0 +1,173 @@
+# write a tick's rows in a single transaction, optionally buffering several ticks and flushing them together
+import asyncio
+import json
+import os
+import time
+from collections import deque
+from datetime import datetime
+from typing import Deque, Dict, List, Optional, Tuple
+
+from prisma import Prisma
+
+import metrics
+from forecastChanges import VALIDITY
+
+# a tick's rows all share its time, the forecast tables have a row per year
+TABLES = ["population", "annualco2emissions", "totalco2emissions", "energyproductionby", "populationby",
+          "co2emissionsby", "predictorstats"]
+
+# the interface listens here to drop cached responses as soon as new rows are committed
+TICK_CHANNEL = os.getenv("TICK_CHANNEL", "ticks")
+
+
+# (table, time, year) of a held forecast row -> its new validUntil
+Updates = Dict[Tuple[str, datetime, int], datetime]
+
+
+def fold_validity(rows: Dict[str, List[dict]]) -> Tuple[Dict[str, List[dict]], Updates]:
+    # a held forecast row that is created in the same write just gets the later validUntil itself, the rest of the
+    # updates are collapsed to the latest one per row
+    updates: Updates = {}
+    for update in rows.get(VALIDITY, []):
+        key = (update["table"], update["time"], update["year"])
+        updates[key] = max(updates.get(key, update["validUntil"]), update["validUntil"])
+    if not updates:
+        return rows, updates
+
+    folded = dict(rows)
+    for table in TABLES:
+        if rows.get(table):
+            folded[table] = [
+                {**row, "validUntil": max(row["validUntil"], updates.pop((table, row["time"], row["year"])))}
+                if (table, row["time"], row.get("year")) in updates else row for row in rows[table]]
+    return folded, updates
+
+
+def group_updates(updates: Updates) -> Dict[Tuple[str, datetime], List[dict]]:
+    # the years of a tick are all moved up to the same time, one update per table and tick
+    grouped: Dict[Tuple[str, datetime], List[dict]] = {}
+    for (table, rowTime, year), validUntil in updates.items():
+        grouped.setdefault((table, validUntil), []).append({"time": rowTime, "year": year})
+    return grouped
+
+
+async def write_rows(db: Prisma, rows: Dict[str, List[dict]]):
+    # duplicates are skipped so a flush that is retried after it actually committed doesn't fail forever
+    started = time.perf_counter()
+    rows, updates = fold_validity(rows)
+    try:
+        async with db.batch_() as batcher:
+            for table in TABLES:
+                if rows.get(table):
+                    getattr(batcher, table).create_many(rows[table], skip_duplicates=True)
+            for (table, validUntil), keys in group_updates(updates).items():
+                getattr(batcher, table).update_many(where={"OR": keys}, data={"validUntil": validUntil})
+    except BaseException:
+        metrics.WRITE_SECONDS.labels("error").observe(time.perf_counter() - started)
+        raise
+    metrics.WRITE_SECONDS.labels("ok").observe(time.perf_counter() - started)
+    for table in TABLES:
+        if rows.get(table):
+            metrics.ROWS_WRITTEN.labels(table).inc(len(rows[table]))
+    for table, _, _ in updates:
+        metrics.ROWS_EXTENDED.labels(table).inc()
+
+    # only after the commit, a listener that queries right away has to see the new rows
+    if TICK_CHANNEL:
+        changed = {table for table, _, _ in updates}
+        try:
+            await db.execute_raw("SELECT pg_notify($1, $2)", TICK_CHANNEL,
+                                 json.dumps([table for table in TABLES if rows.get(table) or table in changed]))
+        except Exception as e:
+            print("Notifying", TICK_CHANNEL, "failed:", repr(e))
+
+
+class WriteBehindBuffer:
+    def __init__(self, db: Prisma, maxTicks: int = 10, interval: float = 60, maxRetryDelay: float = 300):
+        self.db = db
+        self.maxTicks = maxTicks
+        self.interval = interval
+        self.maxRetryDelay = maxRetryDelay
+        self.queue: Deque[Dict[str, List[dict]]] = deque()
+        self.wakeup = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+        self.flushes = 0
+        self.failures = 0
+        self.lastFlushSeconds = 0.0
+        self.totalFlushSeconds = 0.0
+        self.lastError: Optional[str] = None
+
+    def enqueue(self, rows: Dict[str, List[dict]]):
+        self.queue.append(rows)
+        if len(self.queue) >= self.maxTicks:
+            self.wakeup.set()
+
+    async def flush(self):
+        # ticks only leave the queue once their transaction committed, a failed flush is retried as a whole
+        ticks = list(self.queue)[:self.maxTicks]
+        if not ticks:
+            return
+
+        rows: Dict[str, List[dict]] = {}
+        for tick in ticks:
+            for table, tableRows in tick.items():
+                rows.setdefault(table, []).extend(tableRows)
+
+        start = time.perf_counter()
+        await write_rows(self.db, rows)
+        self.lastFlushSeconds = time.perf_counter() - start
+        self.totalFlushSeconds += self.lastFlushSeconds
+        self.flushes += 1
+
+        for _ in ticks:
+            self.queue.popleft()
+
+    async def run(self):
+        retryDelay = 1.0
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+
+            while self.queue:
+                try:
+                    await self.flush()
+                    retryDelay = 1.0
+                except Exception as e:
+                    self.failures += 1
+                    self.lastError = repr(e)
+                    print("Flushing", len(self.queue), "buffered ticks failed:", repr(e))
+                    await asyncio.sleep(retryDelay)
+                    retryDelay = min(retryDelay * 2, self.maxRetryDelay)
+                if len(self.queue) < self.maxTicks:
+                    break
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        # last chance to get whatever is still buffered into the database
+        while self.queue:
+            try:
+                await self.flush()
+            except Exception as e:
+                print("Dropping", len(self.queue), "buffered ticks on shutdown:", repr(e))
+                break
+
+    def stats(self) -> dict:
+        return {
+            "queueDepth": len(self.queue),
+            "flushes": self.flushes,
+            "failures": self.failures,
+            "lastFlushSeconds": self.lastFlushSeconds,
+            "averageFlushSeconds": self.totalFlushSeconds / self.flushes if self.flushes else 0,
+            "lastError": self.lastError
+        }
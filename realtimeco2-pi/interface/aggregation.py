@@ -0,0 +1,224 @@
+# downsample a table into time buckets inside timescale so the payload is bounded by chart resolution, not data age
+import math
+import os
+import re
+import time
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+
+from prisma import Prisma
+
+# query parameter name -> (table, columns that can be aggregated, columns that are grouped on)
+TABLES: Dict[str, Tuple[str, List[str], List[str]]] = {
+    "annualCo2Emissions": ("AnnualCo2Emissions",
+                           ["populationGrowthThisYear", "currentCo2Emissions", "currentCo2EmissionsPredicted",
+                            "annualCo2EmissionsPredicted"], []),
+    "totalCo2Emissions": ("TotalCo2Emissions",
+                          ["population", "totalCo2EmissionsPredicted", "endOfYearTotalCo2EmissionsPredicted"], []),
+    "population": ("Population",
+                   ["population", "populationGrowthThisYear", "populationPredicted",
+                    "populationGrowthThisYearPredicted", "endOfYearPopulationPredicted",
+                    "endOfYearPopulationGrowthPredicted"], []),
+    "populationBy": ("PopulationBy",
+                     ["populationPredicted", "populationGrowthPredicted", "populationGrowthCalculated",
+                      "populationGrowthPredictedFromNow", "populationGrowthCalculatedFromNow",
+                      "populationGrowthPercent", "calculatedPopulationGrowthPercent"], ["year"]),
+    "co2EmissionsBy": ("Co2EmissionsBy",
+                       ["totalCo2EmissionsPredicted", "annualCo2EmissionsPredicted", "tempAnomalyPredicted"],
+                       ["year"]),
+    "energyProductionBy": ("EnergyProductionBy",
+                           ["totalFossilFuelProduction", "totalRenewableProduction", "hydropowerProduction",
+                            "windPowerProduction", "solarPowerProduction", "otherRenewablePowerProduction"],
+                           ["year"])
+}
+
+AGGREGATES = {
+    "avg": 'avg("{column}")::float8',
+    "min": 'min("{column}")',
+    "max": 'max("{column}")',
+    "last": 'last("{column}", "time")'
+}
+
+# the same aggregates read from a rollup db-collector keeps (db/timescale.py), averages weighted by their row count
+ROLLUP_AGGREGATES = {
+    "avg": '(sum("{column}_avg" * "samples") / sum("samples"))::float8',
+    "min": 'min("{column}_min")',
+    "max": 'max("{column}_max")',
+    "last": 'last("{column}_last", "time")'
+}
+# how often to look for rollups that were added or dropped
+ROLLUP_CHECK_INTERVAL = float(os.getenv("ROLLUP_CHECK_INTERVAL", 300))
+
+UNITS = {"s": 1, "m": 60, "h": 60 * 60, "d": 24 * 60 * 60, "w": 7 * 24 * 60 * 60}
+
+# bucket sizes max_points picks from, so neighbouring ranges share buckets and the chart doesn't jitter
+STEPS = ["30s", "1m", "5m", "15m", "30m", "1h", "3h", "6h", "12h", "1d", "7d", "30d", "365d"]
+
+
+# table -> (bucket seconds, view) of its rollups
+rollups: Dict[str, List[Tuple[int, str]]] = {}
+rollupsChecked = -math.inf
+
+
+def bucket_seconds(bucket: str) -> int:
+    match = re.fullmatch(r"(\d+)([smhdw])", bucket)
+    if match is None or int(match.group(1)) == 0:
+        raise ValueError(f"Invalid bucket {bucket}, expected something like 30s, 5m, 1h or 1d")
+    return int(match.group(1)) * UNITS[match.group(2)]
+
+
+def bucket_for(start: datetime, end: datetime, maxPoints: int) -> str:
+    seconds = max((end - start).total_seconds(), 0)
+    for step in STEPS:
+        if math.ceil(seconds / bucket_seconds(step)) <= maxPoints:
+            return step
+    return STEPS[-1]
+
+
+def timestamp(value) -> datetime:
+    # raw queries hand timestamps back as iso strings
+    if not isinstance(value, datetime):
+        value = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    return utc(value)
+
+
+def utc(value: Optional[datetime]) -> Optional[datetime]:
+    # prisma stores naive utc timestamps
+    if value is None or value.tzinfo is None:
+        return value
+    return value.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def source(name: str, fill: bool) -> str:
+    # db-collector keeps a forecast row until the forecast changes and moves its validUntil up instead of writing
+    # the same row every tick. filled, the row is repeated at every tick (a Population row) from its time up to
+    # its validUntil, the series every tick used to write. a changed row stored inside another row's range (a
+    # reading that arrived late) overlaps it, the newest row wins each tick so every (tick, year) appears once
+    table, columns, groups = TABLES[name]
+    if not fill or "year" not in groups:
+        return f'"{table}"'
+    selected = ", ".join(f'f."{column}"' for column in groups + columns)
+    grouped = ", ".join(f'f."{group}"' for group in groups)
+    return (f'(SELECT DISTINCT ON (p."time", {grouped}) p."time", {selected} FROM "Population" p JOIN "{table}" f '
+            f'ON p."time" >= f."time" AND p."time" <= coalesce(f."validUntil", f."time") '
+            f'ORDER BY p."time", {grouped}, f."time" DESC) AS "{table}"')
+
+
+def time_conditions(arguments: list, fromDate: Optional[datetime], toDate: Optional[datetime]) -> List[str]:
+    where = []
+    if fromDate is not None:
+        arguments.append(fromDate)
+        where.append(f'"time" >= ${len(arguments)}::timestamp')
+    if toDate is not None:
+        arguments.append(toDate)
+        where.append(f'"time" <= ${len(arguments)}::timestamp')
+    return where
+
+
+async def find_rollups(db: Prisma) -> Dict[str, List[Tuple[int, str]]]:
+    global rollups, rollupsChecked
+    if time.monotonic() - rollupsChecked < ROLLUP_CHECK_INTERVAL:
+        return rollups
+    rollupsChecked = time.monotonic()
+    try:
+        views = await db.query_raw("SELECT view_name FROM timescaledb_information.continuous_aggregates")
+    except Exception as e:
+        # plain postgres, or timescale without any rollups
+        print("Looking for rollups failed:", repr(e))
+        views = []
+
+    found: Dict[str, List[Tuple[int, str]]] = {}
+    tables = {table for table, _, _ in TABLES.values()}
+    for view in views:
+        match = re.fullmatch(r"(\w+)_(\d+[smhdw])", view["view_name"])
+        if match and match.group(1) in tables:
+            found.setdefault(match.group(1), []).append((bucket_seconds(match.group(2)), view["view_name"]))
+    rollups = found
+    return rollups
+
+
+def rollup_for(available: Dict[str, List[Tuple[int, str]]], table: str, seconds: int) -> Optional[str]:
+    # the coarsest rollup whose buckets add up to the asked for one exactly, time_bucket aligns them all the same way
+    fitting = [(rollupSeconds, view) for rollupSeconds, view in available.get(table, [])
+               if seconds % rollupSeconds == 0]
+    return max(fitting)[1] if fitting else None
+
+
+async def time_range(db: Prisma, source: str) -> Tuple[Optional[datetime], Optional[datetime]]:
+    result = await db.query_first(f'SELECT min("time") AS "start", max("time") AS "end" FROM {source}')
+    if not result or result["start"] is None:
+        return None, None
+    return timestamp(result["start"]), timestamp(result["end"])
+
+
+async def aggregate(db: Prisma, name: str, bucket: Optional[str], agg: str, maxPoints: Optional[int],
+                    sort: str, rows: int, fromDate: Optional[datetime], toDate: Optional[datetime],
+                    fill: bool = False) -> List[dict]:
+    # every identifier spliced into the sql comes from the whitelists above, values are passed as parameters
+    if name not in TABLES:
+        raise ValueError("Invalid table")
+    if agg not in AGGREGATES:
+        raise ValueError(f"Invalid agg {agg}, expected one of {', '.join(AGGREGATES)}")
+    if bucket is None and (maxPoints is None or maxPoints < 1):
+        raise ValueError("max_points has to be at least 1")
+    if sort not in ("asc", "desc"):
+        raise ValueError("Invalid sort")
+    table, columns, groups = TABLES[name]
+    fromDate, toDate = utc(fromDate), utc(toDate)
+    rowSource = source(name, fill)
+
+    if bucket is None:
+        start, end = fromDate, toDate
+        if start is None or end is None:
+            first, last = await time_range(db, rowSource)
+            if first is None:
+                return []
+            start, end = start or first, end or last
+        bucket = bucket_for(start, end, maxPoints)
+    seconds = bucket_seconds(bucket)
+
+    # long ranges read the pre-aggregated buckets instead of every tick, a range that starts or ends inside one of
+    # them takes it as a whole or not at all
+    aggregates = AGGREGATES
+    view = rollup_for(await find_rollups(db), table, seconds) if not fill else None
+    if view is not None:
+        aggregates, rowSource = ROLLUP_AGGREGATES, f'"{view}"'
+
+    arguments: list = [f"{seconds} seconds"]
+    where = time_conditions(arguments, fromDate, toDate)
+
+    selected = ['time_bucket($1::interval, "time") AS "time"'] + [f'"{group}"' for group in groups]
+    selected += [f'{aggregates[agg].format(column=column)} AS "{column}"' for column in columns]
+    query = f'SELECT {", ".join(selected)} FROM {rowSource}'
+    if where:
+        query += f' WHERE {" AND ".join(where)}'
+    query += f' GROUP BY 1{"".join(f", {i + 2}" for i in range(len(groups)))}'
+    query += f' ORDER BY 1 {sort}{"".join(f", {i + 2}" for i in range(len(groups)))}'
+    if rows != -1:
+        arguments.append(rows)
+        query += f' LIMIT ${len(arguments)}::int'
+
+    return await db.query_raw(query, *arguments)
+
+
+async def filled(db: Prisma, name: str, sort: str, rows: int, fromDate: Optional[datetime],
+                 toDate: Optional[datetime]) -> List[dict]:
+    # the raw rows of a forecast table as one row per tick and year
+    if name not in TABLES or "year" not in TABLES[name][2]:
+        raise ValueError("Only the populationBy, co2EmissionsBy and energyProductionBy tables can be filled")
+    if sort not in ("asc", "desc"):
+        raise ValueError("Invalid sort")
+    fromDate, toDate = utc(fromDate), utc(toDate)
+
+    arguments: list = []
+    where = time_conditions(arguments, fromDate, toDate)
+    query = f'SELECT * FROM {source(name, True)}'
+    if where:
+        query += f' WHERE {" AND ".join(where)}'
+    query += f' ORDER BY "time" {sort}, "year"'
+    # like the plain queries, the latest 50 unless a range or a row count was asked for
+    if rows != -1 or not where:
+        arguments.append(rows if rows != -1 else 50)
+        query += f' LIMIT ${len(arguments)}::int'
+
+    return await db.query_raw(query, *arguments)
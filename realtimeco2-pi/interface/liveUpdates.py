@@ -0,0 +1,178 @@
+# push every committed tick to all subscribers, fetched once from the database no matter how many are connected
+import asyncio
+import json
+import os
+from datetime import datetime, timezone
+from typing import AsyncIterator, Dict, List, Optional, Set
+
+from fastapi.encoders import jsonable_encoder
+from prisma import Prisma
+
+from responseCache import TickListener
+
+LIVE_QUEUE_SIZE = int(os.getenv("LIVE_QUEUE_SIZE", 32))
+LIVE_POLL_INTERVAL = float(os.getenv("LIVE_POLL_INTERVAL", 5))
+LIVE_HEARTBEAT = float(os.getenv("LIVE_HEARTBEAT", 15))
+LIVE_RESUME_LIMIT = int(os.getenv("LIVE_RESUME_LIMIT", 1000))
+
+TABLES = ["population", "annualco2emissions", "totalco2emissions", "energyproductionby", "populationby",
+          "co2emissionsby", "predictorstats"]
+
+
+def utc(value: datetime) -> datetime:
+    return value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value.astimezone(timezone.utc)
+
+
+class Subscriber:
+    def __init__(self):
+        self.queue: "asyncio.Queue[dict]" = asyncio.Queue(LIVE_QUEUE_SIZE)
+        self.lagging = False
+
+
+class TickHub:
+    def __init__(self, db: Prisma, listener: TickListener):
+        self.db = db
+        self.listener = listener
+        self.subscribers: Set[Subscriber] = set()
+        self.wakeup: Optional[asyncio.Event] = None
+        self.lastTime: Optional[datetime] = None
+        self.task: Optional[asyncio.Task] = None
+        self.published = 0
+        self.dropped = 0
+        listener.handlers.append(self.notify)
+
+    def notify(self, tables: Optional[List[str]]):
+        # a burst of notifications turns into a single fetch
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+    async def fetch(self, since: datetime, limit: int = LIVE_RESUME_LIMIT) -> Dict[str, list]:
+        rows = {}
+        cut = None
+        for table in TABLES:
+            found = await getattr(self.db, table).find_many(
+                where={"time": {"gt": since}},
+                order={"time": "asc"},
+                take=limit
+            )
+            if found:
+                rows[table] = found
+            if len(found) == limit:
+                cut = min(cut, utc(found[-1].time)) if cut else utc(found[-1].time)
+
+        # a table that hit the limit may have more rows, so nothing newer than its last row can be sent yet.
+        # its last rows can also stop partway through a tick (the 2030 row without the 2050 one), and a resume only
+        # looks past the time, so the tick at the cut is fetched whole
+        if cut is not None:
+            rows = {table: [row for row in found if utc(row.time) < cut] for table, found in rows.items()}
+            for table in TABLES:
+                rows.setdefault(table, []).extend(await getattr(self.db, table).find_many(where={"time": cut}))
+            rows = {table: found for table, found in rows.items() if found}
+        return rows
+
+    def message(self, rows: Dict[str, list]) -> dict:
+        # the id is the newest row's time, a client sends it back to resume after it
+        newest = max(utc(row.time) for tableRows in rows.values() for row in tableRows)
+        return {"id": newest.isoformat(), "time": newest, "rows": jsonable_encoder(rows)}
+
+    async def latest(self) -> datetime:
+        times = [datetime.fromtimestamp(0, timezone.utc)]
+        for table in TABLES:
+            row = await getattr(self.db, table).find_first(order={"time": "desc"})
+            if row is not None:
+                times.append(utc(row.time))
+        return max(times)
+
+    def publish(self, message: dict):
+        for subscriber in list(self.subscribers):
+            try:
+                subscriber.queue.put_nowait(message)
+            except asyncio.QueueFull:
+                # a client that can't keep up is cut off rather than buffered forever, it resumes from its last id
+                subscriber.lagging = True
+                self.subscribers.discard(subscriber)
+                self.dropped += 1
+        self.published += 1
+
+    async def run(self):
+        while True:
+            # without a working listener nobody tells us about ticks, so look for new rows every so often
+            timeout = None if self.listener.cache.listening else LIVE_POLL_INTERVAL
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            if not self.subscribers:
+                continue
+
+            try:
+                if self.lastTime is None:
+                    self.lastTime = await self.latest()
+                    continue
+                rows = await self.fetch(self.lastTime)
+            except Exception as e:
+                print("Fetching new rows for live subscribers failed:", repr(e))
+                await asyncio.sleep(LIVE_POLL_INTERVAL)
+                continue
+            if rows:
+                message = self.message(rows)
+                self.lastTime = message["time"]
+                self.publish(message)
+
+    async def subscribe(self, since: Optional[datetime]) -> AsyncIterator[str]:
+        subscriber = Subscriber()
+        self.subscribers.add(subscriber)
+        if self.lastTime is None:
+            self.notify(None)
+        try:
+            # catch up from the database first, anything already queued that is older gets skipped below
+            sent = utc(since) if since is not None else None
+            while sent is not None:
+                rows = await self.fetch(sent)
+                if not rows:
+                    break
+                message = self.message(rows)
+                sent = message["time"]
+                yield event(message)
+
+            while not subscriber.lagging or not subscriber.queue.empty():
+                try:
+                    message = await asyncio.wait_for(subscriber.queue.get(), LIVE_HEARTBEAT)
+                except asyncio.TimeoutError:
+                    if subscriber.lagging:
+                        break
+                    yield ": keepalive\n\n"
+                    continue
+                if sent is not None and message["time"] <= sent:
+                    continue
+                sent = message["time"]
+                yield event(message)
+            yield "event: lagging\ndata: {}\n\n"
+        finally:
+            self.subscribers.discard(subscriber)
+
+    def start(self):
+        # created here so it belongs to the server's event loop
+        self.wakeup = asyncio.Event()
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+    def stats(self) -> dict:
+        return {
+            "subscribers": len(self.subscribers),
+            "published": self.published,
+            "dropped": self.dropped,
+            "lastTime": self.lastTime
+        }
+
+
+def event(message: dict) -> str:
+    return f"id: {message['id']}\nevent: tick\ndata: {json.dumps(message['rows'])}\n\n"
@@ -1,20 +1,77 @@
+from contextlib import asynccontextmanager
 from datetime import datetime
+from typing import Optional
 
 import prisma.engine.errors
-from fastapi import FastAPI
-from prisma import Prisma
+from fastapi import FastAPI, Request
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import Response, StreamingResponse
 
-app = FastAPI()
+import metrics
+from aggregation import aggregate, filled
+from common.database import Database
+from liveUpdates import TickHub
+from pagination import key_columns, page, stream
+from responseCache import ResponseCache, TickListener
+
+database = Database()
+responses = ResponseCache()
+listener = TickListener(responses)
+hub = TickHub(database.client, listener)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await database.connect()
+    listener.start()
+    hub.start()
+    yield
+    await hub.stop()
+    await listener.stop()
+    await database.disconnect()
+
+
+app = FastAPI(lifespan=lifespan)
+app.middleware("http")(metrics.instrument)
 
 
 @app.get("/")
 # date from 1 day ago to now by default
-async def main(table: str, sort: str = "desc", rows: int = -1,
+async def main(request: Request, table: str, sort: str = "desc", rows: int = -1,
                from_date: datetime = datetime.fromtimestamp(-1),
-               to_date: datetime = datetime.now()):
-    db = Prisma()
+               to_date: datetime = datetime.now(),
+               bucket: Optional[str] = None, agg: str = "avg", max_points: Optional[int] = None,
+               cursor: Optional[str] = None, page_size: Optional[int] = None, format: str = "json",
+               fill: bool = False):
+    db = database.client
     try:
-        await db.connect()
+        # bucket (e.g. 1m, 1h, 1d) or max_points downsample in the database instead of returning every raw row
+        if bucket is not None or max_points is not None:
+            ranged = from_date != datetime.fromtimestamp(-1)
+            try:
+                with metrics.QUERY_SECONDS.labels("aggregate").time():
+                    return await aggregate(db, table, bucket, agg, max_points, sort, rows,
+                                           from_date if ranged else None, to_date if ranged else None, fill)
+            except ValueError as e:
+                return str(e)
+
+        # forecasts are only stored when they change, fill repeats each one at every tick it stayed valid for
+        if fill:
+            ranged = from_date != datetime.fromtimestamp(-1)
+
+            async def filled_query():
+                with metrics.QUERY_SECONDS.labels("fill").time():
+                    return jsonable_encoder(await filled(db, table, sort, rows, from_date if ranged else None,
+                                                         to_date if ranged else None))
+
+            try:
+                cached = await responses.get(table.lower(), ("fill", sort, rows, from_date, to_date), filled_query)
+            except ValueError as e:
+                return str(e)
+            if request.headers.get("if-none-match") == cached.etag:
+                return Response(status_code=304, headers={"ETag": cached.etag})
+            return Response(content=cached.body, media_type="application/json",
+                            headers={"ETag": cached.etag, "Cache-Control": "no-cache"})
 
         if table == "annualCo2Emissions":
             dbTable = db.annualco2emissions
@@ -29,30 +86,95 @@ async def main(table: str, sort: str = "desc", rows: int = -1,
         elif table == "energyProductionBy":
             dbTable = db.energyproductionby
         else:
-            toReturn = "Invalid table"
-
-        if rows != -1:
-            print("taking", rows)
-            toReturn = await dbTable.find_many(
-                order={"time": sort},
-                take=rows
-            )
-        elif from_date != datetime.fromtimestamp(-1):
-            print("taking from", from_date, "to", to_date)
-            toReturn = await dbTable.find_many(
-                where={"time": {"gte": from_date, "lte": to_date}},
-                order={"time": sort}
-            )
-        else:
-            print("taking 50")
-            toReturn = await dbTable.find_many(
-                order={"time": sort},
-                take=50
-            )
+            return "Invalid table"
+
+        ranged = from_date != datetime.fromtimestamp(-1)
+        if format == "ndjson":
+            # rows are read in fixed size batches and written out as they arrive
+            if sort not in ("asc", "desc"):
+                return "Invalid sort"
+            return StreamingResponse(stream(dbTable, key_columns(table.lower()), sort, from_date if ranged else None,
+                                            to_date if ranged else None), media_type="application/x-ndjson")
+        if cursor is not None or page_size is not None:
+            try:
+                with metrics.QUERY_SECONDS.labels("page").time():
+                    return await page(dbTable, key_columns(table.lower()), sort,
+                                      page_size or (rows if rows > 0 else 50), cursor,
+                                      from_date if ranged else None, to_date if ranged else None)
+            except ValueError as e:
+                return str(e)
+
+        async def query():
+            with metrics.QUERY_SECONDS.labels("find").time():
+                if rows != -1:
+                    print("taking", rows)
+                    result = await dbTable.find_many(
+                        order={"time": sort},
+                        take=rows
+                    )
+                elif from_date != datetime.fromtimestamp(-1):
+                    print("taking from", from_date, "to", to_date)
+                    result = await dbTable.find_many(
+                        where={"time": {"gte": from_date, "lte": to_date}},
+                        order={"time": sort}
+                    )
+                else:
+                    print("taking 50")
+                    result = await dbTable.find_many(
+                        order={"time": sort},
+                        take=50
+                    )
+                return jsonable_encoder(result)
+
+        # the plain queries only change when db-collector commits a tick, so viewers share one cached response
+        cached = await responses.get(table.lower(), (sort, rows, from_date, to_date), query)
+        if request.headers.get("if-none-match") == cached.etag:
+            return Response(status_code=304, headers={"ETag": cached.etag})
+        return Response(content=cached.body, media_type="application/json",
+                        headers={"ETag": cached.etag, "Cache-Control": "no-cache"})
     except prisma.engine.errors.EngineConnectionError:
         toReturn = "Connection error"
-
-    finally:
-        await db.disconnect()
+        try:
+            await database.reconnect()
+        except prisma.engine.errors.EngineConnectionError:
+            pass
 
     return toReturn
+
+
+@app.get("/live")
+async def live(request: Request, since: Optional[datetime] = None):
+    # server sent events, a reconnecting EventSource sends the last id it saw and resumes right after it
+    lastEventId = request.headers.get("last-event-id")
+    if lastEventId:
+        try:
+            since = datetime.fromisoformat(lastEventId)
+        except ValueError:
+            pass
+    return StreamingResponse(hub.subscribe(since), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.get("/live/stats")
+async def live_stats():
+    return hub.stats()
+
+
+@app.get("/health")
+async def health():
+    return {"database": await database.healthy(), "reconnects": database.reconnects}
+
+
+@app.get("/cache")
+async def cache():
+    return responses.stats()
+
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    cacheStats, liveStats = responses.stats(), hub.stats()
+    for stat in ("size", "hits", "misses"):
+        metrics.RESPONSE_CACHE.labels(stat).set(cacheStats[stat])
+    for stat in ("subscribers", "published", "dropped"):
+        metrics.LIVE.labels(stat).set(liveStats[stat])
+    return metrics.render()
@@ -0,0 +1,13 @@
+# the interface's prometheus metrics for GET /metrics, request timing and the slow request profiler are in
+# common/metrics.py
+from prometheus_client import Gauge, Histogram
+
+from common.metrics import BUCKETS, render, request_instrument
+
+instrument = request_instrument("interface")
+
+QUERY_SECONDS = Histogram("interface_query_seconds", "Time to read rows from the database", ["kind"],
+                          buckets=BUCKETS)
+RESPONSE_CACHE = Gauge("interface_response_cache", "Response cache counters", ["stat"],
+                       multiprocess_mode="liveall")
+LIVE = Gauge("interface_live", "Live update subscribers and events", ["stat"], multiprocess_mode="liveall")
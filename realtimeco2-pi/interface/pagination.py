@@ -0,0 +1,107 @@
+# keyset pagination and ndjson streaming on each table's primary key, so large ranges never have to be held in
+# memory at once
+import base64
+import json
+import os
+from datetime import datetime
+from typing import AsyncIterator, List, Optional
+
+from fastapi.encoders import jsonable_encoder
+
+STREAM_BATCH_SIZE = int(os.getenv("STREAM_BATCH_SIZE", 1000))
+MAX_PAGE_SIZE = int(os.getenv("MAX_PAGE_SIZE", 1000))
+
+
+# the columns after time in each table's primary key: the forecasts have a row per year at every tick and
+# population is keyed on its value too, the others have one row per tick
+KEYS = {
+    "population": ["population"],
+    "populationby": ["year"],
+    "co2emissionsby": ["year"],
+    "energyproductionby": ["year"]
+}
+
+
+def key_columns(table: str) -> List[str]:
+    return ["time"] + KEYS.get(table, [])
+
+
+def key_of(row, key: List[str]) -> list:
+    return [getattr(row, column) for column in key]
+
+
+def encode_cursor(values: list) -> str:
+    return base64.urlsafe_b64encode(json.dumps(jsonable_encoder(values)).encode()).decode()
+
+
+def decode_cursor(cursor: str, key: List[str]) -> list:
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+        if not isinstance(values, list) or len(values) != len(key):
+            raise ValueError("Invalid cursor")
+        return [datetime.fromisoformat(values[0])] + values[1:]
+    except (ValueError, TypeError, UnicodeDecodeError):
+        raise ValueError("Invalid cursor")
+
+
+def time_filter(sort: str, key: List[str], after: Optional[list], fromDate: Optional[datetime],
+                toDate: Optional[datetime]) -> dict:
+    # keyset on the whole primary key, time alone would skip the rest of a tick's rows at a page boundary
+    conditions = []
+    timeRange = {}
+    if fromDate is not None:
+        timeRange["gte"] = fromDate
+    if toDate is not None:
+        timeRange["lte"] = toDate
+    if timeRange:
+        conditions.append({"time": timeRange})
+    if after is not None:
+        # (time, year) > (t, y) is time > t, or time = t and year > y
+        operator = "lt" if sort == "desc" else "gt"
+        conditions.append({"OR": [
+            {**{column: value for column, value in zip(key[:i], after[:i])}, key[i]: {operator: after[i]}}
+            for i in range(len(key))
+        ]})
+    if not conditions:
+        return {}
+    return conditions[0] if len(conditions) == 1 else {"AND": conditions}
+
+
+def key_order(sort: str, key: List[str]) -> List[dict]:
+    return [{column: sort} for column in key]
+
+
+async def page(dbTable, key: List[str], sort: str, size: int, cursor: Optional[str],
+               fromDate: Optional[datetime], toDate: Optional[datetime]) -> dict:
+    if sort not in ("asc", "desc"):
+        raise ValueError("Invalid sort")
+    size = max(1, min(size, MAX_PAGE_SIZE))
+    after = decode_cursor(cursor, key) if cursor else None
+
+    # one extra row tells us whether there is another page without a count query
+    rows = await dbTable.find_many(
+        where=time_filter(sort, key, after, fromDate, toDate),
+        order=key_order(sort, key),
+        take=size + 1
+    )
+    more = len(rows) > size
+    rows = rows[:size]
+    return {"rows": rows, "nextCursor": encode_cursor(key_of(rows[-1], key)) if more else None}
+
+
+async def stream(dbTable, key: List[str], sort: str, fromDate: Optional[datetime], toDate: Optional[datetime],
+                 batchSize: int = STREAM_BATCH_SIZE) -> AsyncIterator[str]:
+    if sort not in ("asc", "desc"):
+        raise ValueError("Invalid sort")
+    after = None
+    while True:
+        rows = await dbTable.find_many(
+            where=time_filter(sort, key, after, fromDate, toDate),
+            order=key_order(sort, key),
+            take=batchSize
+        )
+        if rows:
+            yield "".join(json.dumps(jsonable_encoder(row)) + "\n" for row in rows)
+        if len(rows) < batchSize:
+            return
+        after = key_of(rows[-1], key)
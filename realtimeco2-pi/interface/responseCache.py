@@ -0,0 +1,169 @@
+# cache serialized query responses until db-collector announces a new tick, so every viewer shares one query per tick
+import asyncio
+import hashlib
+import json
+import os
+import time
+from typing import Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
+from urllib.parse import urlsplit, urlunsplit
+
+import asyncpg
+
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", 5))
+RESPONSE_CACHE_MAX_AGE = float(os.getenv("RESPONSE_CACHE_MAX_AGE", 300))
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", 1024))
+TICK_CHANNEL = os.getenv("TICK_CHANNEL", "ticks")
+
+
+class CachedResponse:
+    def __init__(self, body: bytes, generation: Tuple[int, int]):
+        self.body = body
+        self.etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+        self.generation = generation
+        self.created = time.monotonic()
+
+
+class ResponseCache:
+    def __init__(self, ttl: float = RESPONSE_CACHE_TTL, maxAge: float = RESPONSE_CACHE_MAX_AGE,
+                 maxsize: int = RESPONSE_CACHE_SIZE):
+        self.ttl = ttl
+        self.maxAge = maxAge
+        self.maxsize = maxsize
+        self.entries: Dict[Tuple[str, Hashable], CachedResponse] = {}
+        self.pending: Dict[Tuple[str, Hashable], asyncio.Future] = {}
+        self.generations: Dict[str, int] = {}
+        self.epoch = 0
+        self.listening = False
+        self.hits = 0
+        self.misses = 0
+
+    def invalidate(self, table: Optional[str] = None):
+        # entries stay in the dict but no longer match the current generation
+        if table is None:
+            self.epoch += 1
+            self.entries.clear()
+        else:
+            self.generations[table] = self.generations.get(table, 0) + 1
+
+    def generation(self, table: str) -> Tuple[int, int]:
+        return self.epoch, self.generations.get(table, 0)
+
+    def fresh(self, table: str, entry: CachedResponse) -> bool:
+        # without notifications we can't know when the data changed, so only trust entries for a short while
+        age = time.monotonic() - entry.created
+        return entry.generation == self.generation(table) and \
+            age < (self.maxAge if self.listening else self.ttl)
+
+    async def get(self, table: str, key: Hashable, compute: Callable[[], Awaitable[object]]) -> CachedResponse:
+        cacheKey = (table, key)
+        entry = self.entries.get(cacheKey)
+        if entry is not None and self.fresh(table, entry):
+            self.hits += 1
+            return entry
+
+        # concurrent misses for the same key wait on the first one's query instead of running their own
+        if cacheKey in self.pending:
+            self.hits += 1
+            return await asyncio.shield(self.pending[cacheKey])
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self.pending[cacheKey] = future
+        try:
+            generation = self.generation(table)
+            body = json.dumps(await compute()).encode()
+            entry = CachedResponse(body, generation)
+            if len(self.entries) >= self.maxsize:
+                self.entries.pop(next(iter(self.entries)))
+            self.entries[cacheKey] = entry
+            future.set_result(entry)
+            return entry
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # nobody else may be waiting, don't let the loop complain about an unretrieved exception
+            future.exception()
+            raise
+        finally:
+            del self.pending[cacheKey]
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "listening": self.listening,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hitRate": self.hits / total if total else 0
+        }
+
+
+def asyncpg_url(url: str) -> str:
+    # asyncpg rejects prisma's own query parameters like schema or connection_limit
+    return urlunsplit(urlsplit(url)._replace(query=""))
+
+
+class TickListener:
+    def __init__(self, cache: ResponseCache, url: Optional[str] = os.getenv("DATABASE_URL"),
+                 channel: str = TICK_CHANNEL, retryDelay: float = 10):
+        self.cache = cache
+        self.url = url
+        self.channel = channel
+        self.retryDelay = retryDelay
+        self.task: Optional[asyncio.Task] = None
+        # also told about every tick, with the tables it wrote or None if that's unknown
+        self.handlers: List[Callable[[Optional[List[str]]], None]] = []
+
+    def notified(self, connection, pid, channel, payload):
+        try:
+            tables = json.loads(payload)
+        except ValueError:
+            tables = None
+        if not isinstance(tables, list):
+            tables = None
+            self.cache.invalidate()
+        else:
+            for table in tables:
+                self.cache.invalidate(table)
+        for handler in self.handlers:
+            handler(tables)
+
+    async def run(self):
+        while True:
+            connection = None
+            try:
+                connection = await asyncpg.connect(asyncpg_url(self.url))
+                await connection.add_listener(self.channel, self.notified)
+                # anything committed while we weren't listening has to be assumed stale
+                self.cache.invalidate()
+                self.cache.listening = True
+                while not connection.is_closed():
+                    await asyncio.sleep(self.retryDelay)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print("Listening for", self.channel, "failed:", repr(e))
+            finally:
+                self.cache.listening = False
+                if connection is not None and not connection.is_closed():
+                    await connection.close()
+            await asyncio.sleep(self.retryDelay)
+
+    def start(self):
+        # TICK_CHANNEL= turns listening off on purpose, cached responses then expire after RESPONSE_CACHE_TTL
+        if not self.channel:
+            print("Not listening for ticks, cached responses expire after", self.cache.ttl, "seconds")
+            return
+        if not self.url:
+            raise RuntimeError("DATABASE_URL has to be set to listen for ticks on " + self.channel)
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
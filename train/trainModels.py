@@ -0,0 +1,285 @@
+# rebuild every model the AI service uses from the csv files in this folder, what the notebooks used to do by hand
+#
+#   python trainModels.py --models ../realtimeco2-ai/models --data ../realtimeco2-ai/data [model ...]
+#
+# every model is scored on a held-out split and with k-fold cross validation, and all the fits of all the models run
+# side by side in a process pool. the parsed csv files are cached as .npy next to them, keyed by their content, so
+# only a changed file is parsed again. models are published as new versions into the AI service's model folder
+# (MODELS_FOLDER/<name>/<version>.json and CURRENT, see modelRegistry.py) and the scores of the run go into
+# MODELS_FOLDER/manifest.json. the models the service keeps learning from ingested samples (TRAINABLE_MODELS) are
+# published with their running moments, counting every sample already in the service's DATA_FOLDER as seen. needs
+# the AI service's requirements, plus scikit-learn for the random forest
+import argparse
+import csv
+import hashlib
+import json
+import math
+import os
+import re
+import sys
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from datetime import datetime, timezone
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import numpy
+
+TRAIN_FOLDER = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TRAIN_FOLDER, "..", "realtimeco2-ai"))
+
+import compactModel
+from modelRegistry import MANIFEST, ModelRegistry
+from onlineRegression import OnlineLinearRegression
+from sampleStore import SampleStore
+from training import TRAINABLE_MODELS, polynomial
+
+# the notebooks' random forest search, and its score: a good test score matters ten times more than the train one
+FOREST_ESTIMATORS = [10, 20, 50, 100, 250, 500, 750, 1000]
+
+
+class ModelSpec(NamedTuple):
+    dataset: str
+    feature: int
+    target: int
+    kind: str  # linear, polynomial or forest
+    testSize: float
+
+
+MODELS: Dict[str, ModelSpec] = {
+    "population": ModelSpec("population.csv", 0, 1, "polynomial", 0.15),
+    "population-increase": ModelSpec("population-increase.csv", 0, 1, "polynomial", 0.15),
+    "population_increase_vs_annual_co2": ModelSpec("population_increase_vs_annual_co2.csv", 0, 1, "linear", 0.15),
+    "population_vs_total_co2": ModelSpec("population_vs_total_co2.csv", 0, 1, "polynomial", 0.3),
+    "population_increase_vs_total_renewable_energy": ModelSpec("population_increase_vs_total_energy.csv", 0, 1,
+                                                               "linear", 0.15),
+    "population_increase_vs_total_fossil_energy": ModelSpec("population_increase_vs_total_energy.csv", 0, 2,
+                                                            "linear", 0.15),
+    "population_increase_vs_other_renewables": ModelSpec("population_increase_vs_renewable_energies.csv", 0, 1,
+                                                         "linear", 0.15),
+    "population_increase_vs_solar": ModelSpec("population_increase_vs_renewable_energies.csv", 0, 2, "linear", 0.15),
+    "population_increase_vs_wind": ModelSpec("population_increase_vs_renewable_energies.csv", 0, 3, "linear", 0.15),
+    "population_increase_vs_hydropower": ModelSpec("population_increase_vs_renewable_energies.csv", 0, 4, "linear",
+                                                   0.15),
+    "annualtemp-annualco2": ModelSpec("annualCo2_annualTempAnomaly.csv", 0, 1, "forest", 0.1),
+}
+
+
+def cached_dataset(path: str, cacheFolder: str) -> str:
+    # csv -> float64 matrix, stored under the hash of the csv so an edited file is never read from a stale cache
+    with open(path, 'rb') as file:
+        digest = hashlib.sha1(file.read()).hexdigest()[:16]
+    stem = os.path.splitext(os.path.basename(path))[0]
+    cachePath = os.path.join(cacheFolder, f"{stem}-{digest}.npy")
+    if os.path.exists(cachePath):
+        return cachePath
+
+    with open(path, newline='') as file:
+        reader = csv.reader(file)
+        header = next(reader)
+        rows = numpy.array([[float(value) if value else numpy.nan for value in row] for row in reader],
+                           dtype=float).reshape(-1, len(header))
+    os.makedirs(cacheFolder, exist_ok=True)
+    # older versions of the same file, population-increase-*.npy isn't a version of population.csv
+    for old in os.listdir(cacheFolder):
+        if re.fullmatch(rf"{re.escape(stem)}-[0-9a-f]{{16}}\.npy", old):
+            os.remove(os.path.join(cacheFolder, old))
+    temp = f"{cachePath}.{os.getpid()}.tmp"
+    with open(temp, 'wb') as file:
+        numpy.save(file, rows)
+    os.replace(temp, cachePath)
+    return cachePath
+
+
+def samples(cachePath: str, spec: ModelSpec) -> Tuple[numpy.ndarray, numpy.ndarray]:
+    data = numpy.load(cachePath, mmap_mode='r')
+    rows = data[~numpy.isnan(data[:, spec.feature]) & ~numpy.isnan(data[:, spec.target])]
+    X = rows[:, spec.feature].reshape(-1, 1)
+    return (polynomial(X) if spec.kind == "polynomial" else numpy.array(X)), numpy.array(rows[:, spec.target])
+
+
+def holdout_split(count: int, testSize: float, seed: int) -> Tuple[numpy.ndarray, numpy.ndarray]:
+    # the same split train_test_split(test_size, random_state=seed) makes
+    permutation = numpy.random.RandomState(seed).permutation(count)
+    testCount = math.ceil(testSize * count)
+    return permutation[testCount:], permutation[:testCount]
+
+
+def fold_split(count: int, folds: int, fold: int, seed: int) -> Tuple[numpy.ndarray, numpy.ndarray]:
+    # shuffled k-fold, the csv files are sorted by year and unshuffled folds would only ever score extrapolation
+    permutation = numpy.random.RandomState(seed).permutation(count)
+    sizes = numpy.full(folds, count // folds)
+    sizes[:count % folds] += 1
+    start = int(sizes[:fold].sum())
+    test = permutation[start:start + sizes[fold]]
+    return numpy.setdiff1d(permutation, test), test
+
+
+def fit_linear(X: numpy.ndarray, y: numpy.ndarray) -> compactModel.LinearModel:
+    # ordinary least squares on centered data like sklearn's LinearRegression, x² of a unix timestamp is ~1e19
+    xMean, yMean = X.mean(axis=0), y.mean()
+    coef = numpy.linalg.lstsq(X - xMean, y - yMean, rcond=None)[0]
+    return compactModel.LinearModel(yMean - xMean @ coef, coef)
+
+
+def fit_online(X: numpy.ndarray, y: numpy.ndarray, testSize: float) -> OnlineLinearRegression:
+    # the same fit the service seeds a model with, holding out testSize of the samples for its running score
+    return OnlineLinearRegression(features=X.shape[1], test_size=testSize).fit(X, y)
+
+
+def fit_forest(X: numpy.ndarray, y: numpy.ndarray, estimators: int, seed: int):
+    from sklearn.ensemble import RandomForestRegressor
+
+    # a single thread per fit, the pool already keeps every core busy
+    return RandomForestRegressor(n_estimators=estimators, random_state=seed, n_jobs=1).fit(X, y)
+
+
+def evaluate(model, X: numpy.ndarray, y: numpy.ndarray) -> Dict[str, float]:
+    predicted = model.predict(X)
+    error = y - predicted
+    total = ((y - y.mean()) ** 2).sum()
+    return {"r2": float(1 - (error ** 2).sum() / total) if total else 0.0, "mae": float(numpy.abs(error).mean()),
+            "rmse": float(numpy.sqrt((error ** 2).mean()))}
+
+
+def fit(name: str, spec: ModelSpec, X: numpy.ndarray, y: numpy.ndarray, estimators: Optional[int], seed: int):
+    if spec.kind == "forest":
+        return fit_forest(X, y, estimators, seed)
+    # a plain LinearModel of a trainable model would be thrown away and refitted by the service on first use
+    return fit_online(X, y, spec.testSize) if name in TRAINABLE_MODELS else fit_linear(X, y)
+
+
+def score_job(cachePath: str, name: str, spec: ModelSpec, split: Tuple, estimators: Optional[int],
+              seed: int) -> dict:
+    # one fit on the train part of a split, scored on both parts. split is ("holdout",) or ("fold", folds, fold)
+    started = time.perf_counter()
+    X, y = samples(cachePath, spec)
+    train, test = holdout_split(len(y), spec.testSize, seed) if split[0] == "holdout" else \
+        fold_split(len(y), split[1], split[2], seed)
+    model = fit(name, spec, X[train], y[train], estimators, seed)
+    return {"train": evaluate(model, X[train], y[train]), "test": evaluate(model, X[test], y[test]),
+            "seconds": time.perf_counter() - started}
+
+
+def final_job(cachePath: str, spec: ModelSpec, estimators: Optional[int], seed: int, modelsFolder: str,
+              dataFolder: str, name: str) -> dict:
+    # the published model is fitted on every sample, the scores above say how well that generalizes
+    started = time.perf_counter()
+    X, y = samples(cachePath, spec)
+    model = fit(name, spec, X, y, estimators, seed)
+    if isinstance(model, OnlineLinearRegression):
+        # the service only folds in the samples of its dataset past `seen`, the ones ingested after this run
+        model.seen = len(SampleStore(dataFolder).dataset(TRAINABLE_MODELS[name][0]))
+    registry = ModelRegistry(modelsFolder)
+    registry.replace(name, model)
+    return {"version": registry.versions[name], "file": registry.current(name), "rows": len(y),
+            "coef": compactModel.to_dict(model)["coef"] if compactModel.exportable(model) else None,
+            "seconds": time.perf_counter() - started}
+
+
+def forest_score(result: dict) -> float:
+    return result["train"]["r2"] / 2 + result["test"]["r2"] * 5
+
+
+def summary(folds: List[dict]) -> dict:
+    scores = numpy.array([fold["test"]["r2"] for fold in folds])
+    return {"folds": [fold["test"] for fold in folds], "meanR2": float(scores.mean()), "stdR2": float(scores.std())}
+
+
+def train(names: List[str], modelsFolder: str, dataFolder: str, cacheFolder: str, folds: int, seed: int,
+          jobs: int) -> dict:
+    started = time.perf_counter()
+    datasets = {name: cached_dataset(os.path.join(TRAIN_FOLDER, MODELS[name].dataset), cacheFolder)
+                for name in names}
+    os.makedirs(modelsFolder, exist_ok=True)
+
+    with ProcessPoolExecutor(jobs) as pool:
+        def scores(name: str, estimators: Optional[int]) -> Tuple[Future, List[Future]]:
+            spec, path = MODELS[name], datasets[name]
+            return (pool.submit(score_job, path, name, spec, ("holdout",), estimators, seed),
+                    [pool.submit(score_job, path, name, spec, ("fold", folds, fold), estimators, seed)
+                     for fold in range(folds)])
+
+        # everything that doesn't depend on anything else is queued at once, the forest first picks its size
+        pending: Dict[str, Tuple[Optional[int], Future, List[Future], Future]] = {}
+        candidates = {}
+        for name in names:
+            if MODELS[name].kind == "forest":
+                candidates[name] = {estimators: pool.submit(score_job, datasets[name], name, MODELS[name],
+                                                            ("holdout",), estimators, seed)
+                                    for estimators in FOREST_ESTIMATORS}
+            else:
+                pending[name] = (None, *scores(name, None),
+                                 pool.submit(final_job, datasets[name], MODELS[name], None, seed, modelsFolder,
+                                             dataFolder, name))
+
+        for name, futures in candidates.items():
+            estimators = max(futures, key=lambda estimators: forest_score(futures[estimators].result()))
+            pending[name] = (estimators, *scores(name, estimators),
+                             pool.submit(final_job, datasets[name], MODELS[name], estimators, seed, modelsFolder,
+                                         dataFolder, name))
+
+        models = {}
+        for name in names:
+            estimators, holdout, foldFutures, final = pending[name]
+            spec = MODELS[name]
+            result = final.result()
+            models[name] = {
+                "kind": spec.kind,
+                "dataset": spec.dataset,
+                "datasetCache": os.path.basename(datasets[name]),
+                "feature": spec.feature,
+                "target": spec.target,
+                "testSize": spec.testSize,
+                **({"estimators": estimators} if estimators is not None else {}),
+                **result,
+                "holdout": holdout.result(),
+                "crossValidation": summary([future.result() for future in foldFutures])
+            }
+            crossValidation = models[name]["crossValidation"]
+            print(f"{name:<48} v{result['version']:<4} holdout r2 {models[name]['holdout']['test']['r2']:8.4f}  "
+                  f"cv r2 {crossValidation['meanR2']:8.4f} ± {crossValidation['stdR2']:.4f}")
+
+    return {
+        "created": datetime.now(timezone.utc).isoformat(),
+        "seed": seed,
+        "folds": folds,
+        "seconds": time.perf_counter() - started,
+        "models": models
+    }
+
+
+def write_manifest(modelsFolder: str, manifest: dict):
+    # models that weren't rebuilt this time keep their entry from the last run
+    path = os.path.join(modelsFolder, MANIFEST)
+    try:
+        with open(path) as file:
+            previous = json.load(file)
+    except FileNotFoundError:
+        previous = {"models": {}}
+    manifest = {**manifest, "models": {**previous.get("models", {}), **manifest["models"]}}
+    temp = f"{path}.{os.getpid()}.tmp"
+    with open(temp, "w") as file:
+        json.dump(manifest, file, indent=1)
+    os.replace(temp, path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Rebuild the AI service's models from the csv files in train/")
+    parser.add_argument("names", nargs="*", metavar="model", help="models to rebuild, all of them by default")
+    parser.add_argument("--models", default=os.getenv("MODELS_FOLDER", "models"), help="the AI's model folder")
+    parser.add_argument("--data", default=os.getenv("DATA_FOLDER", "data"),
+                        help="the AI's data folder, trainable models start learning after its samples")
+    parser.add_argument("--cache", default=os.path.join(TRAIN_FOLDER, ".cache"), help="parsed csv files")
+    parser.add_argument("--folds", type=int, default=10, help="cross validation folds")
+    parser.add_argument("--seed", type=int, default=1, help="random state of the splits and the random forest")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="training processes")
+    arguments = parser.parse_args()
+
+    unknown = [name for name in arguments.names if name not in MODELS]
+    if unknown:
+        parser.error(f"unknown model(s) {', '.join(unknown)}, pick from {', '.join(MODELS)}")
+
+    manifest = train(arguments.names or list(MODELS), arguments.models, arguments.data, arguments.cache,
+                     arguments.folds, arguments.seed, arguments.jobs)
+    write_manifest(arguments.models, manifest)
+    print(f"Trained {len(manifest['models'])} model(s) in {manifest['seconds']:.1f}s")